@@ -0,0 +1,14 @@
+"""
+Celery app for background tasks (see main/tasks.py). Run a worker with:
+
+    celery -A cabportal worker -l info
+"""
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cabportal.settings')
+
+app = Celery('cabportal')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
@@ -47,12 +47,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware', 
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'main.routers.ReplicaPinMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -93,6 +95,45 @@ DATABASES = {
         }
 }
 
+# Read replicas, e.g. DATABASE_REPLICA_HOSTS=db-replica-1,db-replica-2. Search and
+# listing views read from them (see main/routers.py); writes, transactions and
+# users who wrote in the last REPLICA_PIN_SECONDS stay on the primary.
+DATABASE_REPLICAS = []
+for index, host in enumerate(filter(None, os.getenv('DATABASE_REPLICA_HOSTS', '').split(',')), start=1):
+    alias = f"replica{index}"
+    DATABASES[alias] = {**DATABASES["default"], "HOST": host.strip(), "TEST": {"MIRROR": "default"}}
+    DATABASE_REPLICAS.append(alias)
+if not DATABASE_REPLICAS:
+    # The primary under a second alias, so the router tests in main/tests.py run
+    # against two connections. Nothing is routed to it unless listed above.
+    DATABASES["replica"] = {**DATABASES["default"], "TEST": {"MIRROR": "default"}}
+DATABASE_ROUTERS = ['main.routers.ReplicaRouter']
+REPLICA_PIN_SECONDS = 5
+
+
+# Cache
+# Version counters, rate limit buckets and cached route data are shared by every
+# gunicorn worker and web container. Redis keeps them in one place and updates
+# counters atomically, so concurrent bumps are never lost. Without REDIS_URL
+# (tests, a single local runserver) each process keeps its own memory cache.
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# How long shared caches (the bundled nginx) may serve public read APIs such as
+# stops and routes before revalidating them; see main/conditional.py.
+PUBLIC_CACHE_SECONDS = int(os.getenv('PUBLIC_CACHE_SECONDS', 30))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -146,7 +187,7 @@ REST_FRAMEWORK = {
         # "rest_framework.authentication.SessionAuthentication",
         "rest_framework.authentication.BasicAuthentication",
     ),
-    "DEFAULT_RENDERER_CLASSES": ("rest_framework.renderers.JSONRenderer",),
+    "DEFAULT_RENDERER_CLASSES": ("main.renderers.FastJSONRenderer",),
     "DEFAULT_PARSER_CLASSES": (
         "rest_framework.parsers.JSONParser",
         "rest_framework.parsers.FormParser",
@@ -170,3 +211,48 @@ LOGIN_REDIRECT_URL = '/vendor-cab-bookings/'
 # After logout, redirect users to the login page
 LOGOUT_REDIRECT_URL = '/login/'
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
+
+# Bearer token Prometheus sends to /metrics; the endpoint is off without one.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Per-route, per-day stop time fragments reused between GTFS feed exports.
+GTFS_CACHE_DIR = os.path.join(BASE_DIR, 'gtfs_cache')
+
+# Admission control for expensive API views (see main/admission.py).
+# Rates are requests per second; bursts are how many may arrive at once.
+# max_concurrent caps the requests in progress across all workers (per process
+# without Redis); a slot held longer than max_request_seconds (default 60) by a
+# killed worker is freed.
+ADMISSION_CONTROL = {
+    'search': {
+        'user_rate': 1, 'user_burst': 10,
+        'global_rate': 20, 'global_burst': 40,
+        'max_concurrent': 4,
+    },
+    'journeys': {
+        'user_rate': 0.5, 'user_burst': 5,
+        'global_rate': 10, 'global_burst': 20,
+        'max_concurrent': 2,
+    },
+}
+
+# Background tasks for booking side effects (see main/tasks.py), run by a
+# Celery worker off the Redis broker. Use the 'eager' backend in tests to run
+# tasks as soon as their transaction commits.
+TASKS = {
+    'BACKEND': os.getenv('TASKS_BACKEND', 'celery'),
+    'MAX_RETRIES': 3,
+    'RETRY_DELAY': 5,  # seconds, doubled on each retry
+}
+CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://redis:6379/1')
+# Acknowledge a job only once it has run, so a worker that dies mid-job hands it
+# to another worker instead of losing it.
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_REJECT_ON_WORKER_LOST = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TASK_IGNORE_RESULT = True
+
+# Booking notifications. Set EMAIL_BACKEND to 'django_ses.SESBackend' (with the
+# AWS_* settings) in production; the console backend just prints the messages.
+EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'noreply@cabportal.local')
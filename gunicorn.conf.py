@@ -0,0 +1,31 @@
+# Loaded by gunicorn from the working directory. Workers share Prometheus
+# metrics through memory-mapped files in PROMETHEUS_MULTIPROC_DIR (see
+# main/metrics.py); the directory is emptied when the server starts and each
+# dead worker's live values are dropped. Exiting workers save buffered position
+# pings first.
+import os
+import shutil
+import sys
+
+# prometheus_client picks its storage when first imported, and workers inherit
+# the master's import, so the directory must be set first.
+METRICS_DIR = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/cabportal-metrics')
+
+from prometheus_client import multiprocess  # noqa: E402
+
+
+def on_starting(server):
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    os.makedirs(METRICS_DIR)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    # Save the position pings this worker still buffers (see main/tracking.py).
+    # Nothing is buffered if no ping reached it, so don't import it just for this.
+    tracking = sys.modules.get('main.tracking')
+    if tracking is not None:
+        tracking.flush()
@@ -1,6 +1,8 @@
 from django.contrib import admin
+from django.db.models import Case, IntegerField, When
 from .models import Vendor, Customer, Stop, Route, RouteStop, Travellor, Booking
 from .models import Car, CabBooking
+from .stop_index import get_stop_index
 
 # To enhance the Route management, we'll show the stops inline
 class RouteStopInline(admin.TabularInline):
@@ -44,9 +46,22 @@ class BookingAdmin(admin.ModelAdmin):
 @admin.register(Stop)
 class StopAdmin(admin.ModelAdmin):
     """Custom admin configuration for the Stop model."""
-    list_display = ('name', 'description')
+    list_display = ('name', 'description', 'latitude', 'longitude')
     search_fields = ('name',)
 
+    def get_search_results(self, request, queryset, search_term):
+        # Resolve searches (including the RouteStop/Booking autocompletes) from the
+        # in-memory stop index instead of an icontains scan.
+        # Every match is returned, best first; sorting by a column overrides this.
+        if not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        index = get_stop_index()
+        ids = [stop['id'] for stop in index.search(search_term, limit=len(index.stops))]
+        if not ids:
+            return queryset.none(), False
+        relevance = Case(*[When(id=stop_id, then=rank) for rank, stop_id in enumerate(ids)], output_field=IntegerField())
+        return queryset.filter(id__in=ids).order_by(relevance), False
+
 
 @admin.register(Vendor)
 class VendorAdmin(admin.ModelAdmin):
@@ -0,0 +1,243 @@
+"""
+Admission control for expensive API views.
+
+Each scope in `settings.ADMISSION_CONTROL` gets:
+
+* a per-user token bucket, enforced as a DRF throttle (`429` with `Retry-After`),
+* a global token bucket shared by all users, and
+* a cap on requests in flight across all workers,
+
+the last two shedding load with `503` and `Retry-After`. Buckets use GCRA, so
+each one is a single timestamp. In-flight requests are members of a sorted set
+scored by when their slot lapses, so a worker killed mid-request frees its slot
+after `max_request_seconds` instead of holding it forever.
+
+With the Redis cache both are updated by Lua scripts, atomically and on the
+Redis clock, so concurrent workers never over-admit. Other cache backends are
+per process, and so is the state kept for them here.
+"""
+import math
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.redis import RedisCache
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.throttling import BaseThrottle
+
+OUTCOMES = ('admitted', 'throttled', 'shed')
+DEFAULT_MAX_REQUEST_SECONDS = 60
+
+
+def get_limits(scope):
+    return getattr(settings, 'ADMISSION_CONTROL', {}).get(scope)
+
+
+GCRA_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local interval, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or now), now)
+local wait = tat - now - (burst - 1) * interval
+if wait > 0 then
+    return tostring(wait)
+end
+redis.call('SET', KEYS[1], tostring(tat + interval), 'PX', math.ceil((burst * interval + 1) * 1000))
+return '0'
+"""
+
+ACQUIRE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local limit, lifetime = tonumber(ARGV[1]), tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + lifetime, ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(lifetime))
+return 1
+"""
+
+
+# State for cache backends other than Redis, which are per process anyway.
+_local_slots = {}
+_local_lock = threading.Lock()
+
+
+def _redis():
+    """The Redis client behind the default cache, or None for other cache backends."""
+    if isinstance(cache, RedisCache):
+        return cache._cache.get_client(write=True)
+    return None
+
+
+class TokenBucket:
+    """`burst` requests at once, refilled at `rate` requests per second."""
+
+    def __init__(self, key, rate, burst):
+        self.key = f"admission:bucket:{key}"
+        self.interval = 1 / rate
+        self.burst = burst
+
+    def take(self):
+        """Takes a token; returns 0 if one was available, else the seconds until one is."""
+        client = _redis()
+        if client is not None:
+            script = client.register_script(GCRA_SCRIPT)
+            return float(script(keys=[cache.make_key(self.key)], args=[self.interval, self.burst]))
+
+        with _local_lock:
+            now = time.time()
+            tat = max(cache.get(self.key, now), now)
+            wait = tat - now - (self.burst - 1) * self.interval
+            if wait > 0:
+                return wait
+            cache.set(self.key, tat + self.interval, math.ceil(self.burst * self.interval) + 1)
+            return 0
+
+
+class ServiceOverloaded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'The service is busy. Please retry shortly.'
+    default_code = 'service_overloaded'
+
+    def __init__(self, wait=1):
+        super().__init__()
+        self.wait = math.ceil(wait)
+
+
+def record(scope, outcome):
+    key = f"admission:count:{scope}:{outcome}"
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass
+
+
+def stats():
+    """Admission counters and current in-flight requests per configured scope."""
+    result = {}
+    for scope in getattr(settings, 'ADMISSION_CONTROL', {}):
+        keys = [f"admission:count:{scope}:{outcome}" for outcome in OUTCOMES]
+        counts = cache.get_many(keys)
+        result[scope] = {outcome: counts.get(key, 0) for outcome, key in zip(OUTCOMES, keys)}
+        result[scope]['in_flight'] = ConcurrencySlots(scope).in_flight()
+    return result
+
+
+class UserTokenBucketThrottle(BaseThrottle):
+    """Per-user (or per-IP for anonymous requests) bucket for the view's `admission_scope`."""
+
+    def allow_request(self, request, view):
+        limits = get_limits(getattr(view, 'admission_scope', None))
+        if not limits or 'user_rate' not in limits:
+            return True
+        ident = request.user.pk if request.user and request.user.is_authenticated else self.get_ident(request)
+        self.delay = TokenBucket(
+            f"{view.admission_scope}:user:{ident}", limits['user_rate'], limits.get('user_burst', 1),
+        ).take()
+        if self.delay:
+            record(view.admission_scope, 'throttled')
+        return not self.delay
+
+    def wait(self):
+        return self.delay
+
+
+class ConcurrencySlots:
+    """
+    At most `limit` requests of one scope in progress at once. A slot lapses
+    `lifetime` seconds after it was taken if it has not been released.
+    """
+
+    def __init__(self, scope, limit=None, lifetime=DEFAULT_MAX_REQUEST_SECONDS):
+        self.key = f"admission:inflight:{scope}"
+        self.limit = limit
+        self.lifetime = lifetime
+
+    def acquire(self):
+        """Takes a slot; returns its token, or None if all slots are taken."""
+        token = uuid.uuid4().hex
+        client = _redis()
+        if client is not None:
+            script = client.register_script(ACQUIRE_SCRIPT)
+            acquired = script(keys=[cache.make_key(self.key)], args=[self.limit, self.lifetime, token])
+            return token if acquired else None
+
+        with _local_lock:
+            slots = self._live_local_slots()
+            if len(slots) >= self.limit:
+                return None
+            slots[token] = time.time() + self.lifetime
+            return token
+
+    def release(self, token):
+        client = _redis()
+        if client is not None:
+            client.zrem(cache.make_key(self.key), token)
+        else:
+            with _local_lock:
+                self._live_local_slots().pop(token, None)
+
+    def in_flight(self):
+        client = _redis()
+        if client is not None:
+            seconds, microseconds = client.time()
+            return client.zcount(cache.make_key(self.key), f"({seconds + microseconds / 1e6}", '+inf')
+        with _local_lock:
+            return len(self._live_local_slots())
+
+    def _live_local_slots(self):
+        slots = _local_slots.setdefault(self.key, {})
+        now = time.time()
+        for token in [token for token, lapses in slots.items() if lapses <= now]:
+            del slots[token]
+        return slots
+
+
+class AdmissionControlMixin:
+    """
+    APIView mixin applying the limits of `admission_scope`. Per-user limits run
+    with the other throttles; the global bucket and the concurrency cap are
+    checked last, so rejected users never take a shared slot.
+    """
+    admission_scope = None
+    throttle_classes = [UserTokenBucketThrottle]
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        limits = get_limits(self.admission_scope)
+        if not limits:
+            return
+        if 'global_rate' in limits:
+            wait = TokenBucket(
+                f"{self.admission_scope}:global", limits['global_rate'], limits.get('global_burst', 1),
+            ).take()
+            if wait:
+                record(self.admission_scope, 'shed')
+                raise ServiceOverloaded(wait)
+        if 'max_concurrent' in limits:
+            slots = ConcurrencySlots(
+                self.admission_scope, limits['max_concurrent'],
+                limits.get('max_request_seconds', DEFAULT_MAX_REQUEST_SECONDS),
+            )
+            token = slots.acquire()
+            if token is None:
+                record(self.admission_scope, 'shed')
+                raise ServiceOverloaded()
+            self._slot = slots, token
+        record(self.admission_scope, 'admitted')
+
+    def dispatch(self, request, *args, **kwargs):
+        self._slot = None
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            if self._slot is not None:
+                slots, token = self._slot
+                slots.release(token)
@@ -0,0 +1,91 @@
+"""
+Conditional GET support for read APIs.
+
+A response's `ETag` is derived from the version counters of the data it shows
+(see `versioning`), so a client that sends back a current `If-None-Match` or
+`If-Modified-Since` gets `304 Not Modified` after a couple of cache reads,
+without running the view's query or serializer. Writers already bump those
+counters, so nothing has to be invalidated by hand.
+
+Counters are read before the view runs. A write that lands in between can only
+make the body newer than its ETag, which costs the client one more full
+response, never a stale 304.
+
+A counter holds no time, so `Last-Modified` is the first time a worker saw each
+version, stored next to it. That is never earlier than the write itself. A body
+read from a replica only gets validators once its versions are older than
+`REPLICA_PIN_SECONDS`; until then the replica might not have caught up and the
+client is made to fetch it again.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from .metrics import CACHE_LOOKUPS
+from .routers import reading_from_replica
+from .versioning import get_versions
+
+STAMP_TTL = 60 * 60 * 24
+
+
+def _etag(request, versions):
+    parts = [request.path, request.META.get('QUERY_STRING', ''), request.accepted_renderer.format]
+    parts += [f"{name}={version}" for name, version in sorted(versions.items())]
+    return '"%s"' % hashlib.blake2b('|'.join(parts).encode(), digest_size=16).hexdigest()
+
+
+def _last_modified(versions):
+    """Unix time of the newest version among `versions`, stamping versions not seen before."""
+    keys = [f"modified:{name}:{version}" for name, version in versions.items()]
+    stamps = cache.get_many(keys)
+    now = int(time.time())
+    for key in keys:
+        if key not in stamps:
+            # Another worker may have stamped it first; keep theirs.
+            cache.add(key, now, STAMP_TTL)
+            stamps[key] = cache.get(key, now)
+    return max(stamps.values(), default=now)
+
+
+def cache_headers(public):
+    if public:
+        return {'public': True, 'max_age': getattr(settings, 'PUBLIC_CACHE_SECONDS', 30)}
+    return {'private': True, 'no_cache': True}
+
+
+def conditional(version_names, public=False):
+    """
+    Decorates an APIView `get` to answer conditional requests from version
+    counters. `version_names(request, *args, **kwargs)` returns the names of the
+    counters the response depends on. `public` responses may be stored by shared
+    caches for `PUBLIC_CACHE_SECONDS`. Other responses are private and must be
+    revalidated on every use.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            versions = get_versions(version_names(request, *args, **kwargs))
+            etag = _etag(request, versions)
+            last_modified = _last_modified(versions)
+
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            CACHE_LOOKUPS.labels('conditional', 'miss' if response is None else 'hit').inc()
+            if response is None:
+                response = method(self, request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                if reading_from_replica() and time.time() - last_modified < getattr(settings, 'REPLICA_PIN_SECONDS', 5):
+                    patch_cache_control(response, **cache_headers(public=False))
+                    return response
+
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, **cache_headers(public))
+            return response
+        return wrapper
+    return decorator
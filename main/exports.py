@@ -0,0 +1,116 @@
+"""
+Streaming exports of vendor booking manifests.
+
+Rows are read with `.iterator(chunk_size=...)` so memory stays flat however many
+bookings are exported. CSV is streamed as it is produced; XLSX is written with
+openpyxl's write-only workbook to a temporary file and then streamed from disk,
+so it is limited to XLSX_MAX_DAYS.
+"""
+import csv
+import tempfile
+
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+from openpyxl import Workbook
+
+CHUNK_SIZE = 2000
+# An XLSX file is a zip whose index is written last, so it cannot be streamed
+# before the whole sheet is built. Larger ranges must be exported as CSV.
+XLSX_MAX_DAYS = 31
+
+BOOKING_HEADERS = [
+    'Booking ID', 'Trip ID', 'Route', 'Departure', 'Customer', 'Phone',
+    'From', 'To', 'Seats', 'Fare', 'Status', 'Booked On',
+]
+
+CAB_BOOKING_HEADERS = [
+    'Booking ID', 'Customer', 'Phone', 'Pickup', 'Dropoff', 'Pickup Time',
+    'Passengers', 'Status', 'Car', 'License Plate', 'Driver', 'Driver No', 'Booked On',
+]
+
+
+class Echo:
+    """File-like object whose `write` returns the value, for streaming csv.writer output."""
+
+    def write(self, value):
+        return value
+
+
+def _format_time(value):
+    return timezone.localtime(value).strftime('%Y-%m-%d %H:%M') if value else ''
+
+
+def booking_rows(bookings):
+    bookings = bookings.select_related(
+        'trip__route', 'customer', 'start_stop__stop', 'end_stop__stop',
+    ).only(
+        'id', 'seats', 'fare', 'status', 'booking_time', 'start_stop_name', 'end_stop_name',
+        'trip__id', 'trip__departure_time', 'trip__route__name',
+        'customer__name', 'customer__contact_number',
+        'start_stop__stop__name', 'end_stop__stop__name',
+    )
+    for booking in bookings.iterator(chunk_size=CHUNK_SIZE):
+        yield [
+            booking.id,
+            booking.trip.id,
+            booking.trip.route.name,
+            _format_time(booking.trip.departure_time),
+            booking.customer.name,
+            booking.customer.contact_number,
+            booking.start_stop_name or booking.start_stop.stop.name,
+            booking.end_stop_name or booking.end_stop.stop.name,
+            booking.seats,
+            booking.fare if booking.fare is not None else '',
+            booking.get_status_display(),
+            _format_time(booking.booking_time),
+        ]
+
+
+def cab_booking_rows(cab_bookings):
+    cab_bookings = cab_bookings.select_related('customer', 'car')
+    for booking in cab_bookings.iterator(chunk_size=CHUNK_SIZE):
+        yield [
+            booking.id,
+            booking.customer.name,
+            booking.customer.contact_number,
+            booking.pickup_location,
+            booking.dropoff_location,
+            _format_time(booking.pickup_time),
+            booking.people_count,
+            booking.get_status_display(),
+            booking.car.name if booking.car else '',
+            booking.car.license_plate if booking.car else '',
+            booking.driver_name or '',
+            booking.driver_no or '',
+            _format_time(booking.booking_time),
+        ]
+
+
+def csv_response(filename, headers, rows):
+    writer = csv.writer(Echo())
+    stream = (writer.writerow(row) for row in _with_headers(headers, rows))
+    response = StreamingHttpResponse(stream, content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    return response
+
+
+def xlsx_response(filename, headers, rows, title):
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=title)
+    for row in _with_headers(headers, rows):
+        sheet.append(row)
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return FileResponse(
+        output,
+        as_attachment=True,
+        filename=f'{filename}.xlsx',
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    )
+
+
+def _with_headers(headers, rows):
+    yield headers
+    yield from rows
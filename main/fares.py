@@ -0,0 +1,78 @@
+"""
+Distance-based segment fares.
+
+Each route's cumulative-distance vector is computed once and cached, so the fare
+for any stop pair is `cost_per_km * (cum[end] - cum[start]) * seats` without an
+aggregate query per trip.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.core.cache import cache
+
+from .metrics import CACHE_LOOKUPS
+from .models import RouteStop
+
+CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def _cache_key(route_id):
+    return f"route-fares:{route_id}"
+
+
+class RouteFares:
+    """Cumulative distances of a route indexed by stop order, RouteStop id and Stop id."""
+
+    def __init__(self, route_id, rows):
+        self.route_id = route_id
+        self.cumulative = {}
+        self.order_by_route_stop = {}
+        self.order_by_stop = {}
+        total = 0
+        for route_stop_id, stop_id, order, distance in rows:
+            total += distance
+            self.cumulative[order] = total
+            self.order_by_route_stop[route_stop_id] = order
+            self.order_by_stop.setdefault(stop_id, order)
+
+    def distance(self, start_order, end_order):
+        """Distance between two stop orders, or None if either order is not on the route."""
+        if start_order not in self.cumulative or end_order not in self.cumulative:
+            return None
+        return self.cumulative[end_order] - self.cumulative[start_order]
+
+    def distance_between_route_stops(self, start_route_stop_id, end_route_stop_id):
+        return self.distance(
+            self.order_by_route_stop.get(start_route_stop_id),
+            self.order_by_route_stop.get(end_route_stop_id),
+        )
+
+    def distance_between_stops(self, start_stop_id, end_stop_id):
+        return self.distance(
+            self.order_by_stop.get(start_stop_id),
+            self.order_by_stop.get(end_stop_id),
+        )
+
+
+def get_route_fares(route_id):
+    """Returns the cached `RouteFares` for a route, building it on a cache miss."""
+    fares = cache.get(_cache_key(route_id))
+    CACHE_LOOKUPS.labels('route_fares', 'miss' if fares is None else 'hit').inc()
+    if fares is None:
+        rows = (
+            RouteStop.objects.filter(route_id=route_id)
+            .order_by('order')
+            .values_list('id', 'stop_id', 'order', 'distance_from_previous_stop')
+        )
+        fares = RouteFares(route_id, rows)
+        cache.set(_cache_key(route_id), fares, CACHE_TIMEOUT)
+    return fares
+
+
+def invalidate_route_fares(route_id):
+    cache.delete(_cache_key(route_id))
+
+
+def quote_fare(cost_per_km, distance, seats=1):
+    """Fare for `seats` seats over `distance` kilometers, rounded to paise."""
+    amount = Decimal(cost_per_km) * distance * seats
+    return amount.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
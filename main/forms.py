@@ -14,7 +14,7 @@ class TravellorForm(forms.ModelForm):
         model = Travellor
         # Include all non-nullable Travellor fields here. `driver` is
         # excluded because it's set in the view (`request.user`).
-        fields = ['route', 'departure_time', 'vehicle_capacity', 'cost_per_km',]
+        fields = ['route', 'departure_time', 'vehicle_capacity', 'cost_per_km', 'assign_seats',]
         widgets = {
             'departure_time': forms.DateTimeInput(attrs={'type': 'datetime-local'}),
         }
@@ -31,7 +31,7 @@ class StopForm(forms.ModelForm):
     """
     class Meta:
         model = Stop
-        fields = ['name', 'description']
+        fields = ['name', 'description', 'latitude', 'longitude']
 
 class RouteForm(forms.ModelForm):
     """
@@ -135,3 +135,14 @@ class BulkTravellorForm(forms.Form):
         month = int(self.cleaned_data['month'])
         year = int(self.cleaned_data['year'])
         return calendar.monthrange(year, month)[1]
+
+
+class FeedImportForm(forms.Form):
+    """
+    Form for uploading a GTFS-style feed: a zip containing stops.txt, routes.txt,
+    stop_times.txt and optionally trips.txt.
+    """
+    feed = forms.FileField(
+        label="Feed (.zip)",
+        widget=forms.ClearableFileInput(attrs={'accept': '.zip'})
+    )
@@ -0,0 +1,549 @@
+"""
+GTFS-style feed import and export.
+
+A feed is a set of CSV files: `stops.txt`, `routes.txt`, `stop_times.txt` and an
+optional `trips.txt`. Files are read row by row, validated in memory, references
+are resolved with dict lookups, and everything is written with batched
+`bulk_create` calls inside one transaction, so a feed is imported completely or
+not at all.
+
+`stop_times.txt` rows are keyed either by `route_id` (one row per stop of the
+route) or, as in GTFS, by `trip_id`, in which case `trips.txt` maps trips to
+routes and the first trip seen on a route defines its stop pattern. Travel times
+come from `arrival_time` (HH:MM:SS) or `minutes_from_previous_stop`, distances
+from `shape_dist_traveled` (cumulative km) or `distance_from_previous_stop`.
+
+Rows of `trips.txt` that carry `departure_time` (YYYY-MM-DD HH:MM),
+`vehicle_capacity` and `cost_per_km` are created as scheduled trips.
+
+`FeedExporter` writes the network's timetable for a date range in the same
+layout (plus `agency.txt` and `calendar_dates.txt`), streamed into a zip. Stop
+times are computed per route as a trips x stops matrix from the route offsets and
+the trips' departure times, and can be cached per route and day so that only the
+routes and dates that changed are regenerated.
+"""
+import csv
+import hashlib
+import io
+import os
+import tempfile
+import time
+import zipfile
+from collections import defaultdict
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+import numpy as np
+from django.conf import settings
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from .journeys import day_bounds, route_version_key, timetable_version_key
+from .models import Route, RouteStop, Stop, Travellor
+from .stop_index import STOPS_VERSION_KEY
+from .stop_times import build_stop_times
+from .versioning import bump_version, get_versions
+
+BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 50
+EXPORT_CHUNK_BYTES = 64 * 1024
+STALE_TEMP_FILE_SECONDS = 3600
+
+
+def open_directory(path):
+    """Returns an `open_file(name)` callable reading feed files from a directory."""
+    def open_file(name):
+        full_path = os.path.join(path, name)
+        if not os.path.exists(full_path):
+            return None
+        return open(full_path, newline='', encoding='utf-8-sig')
+    return open_file
+
+
+def open_zip(file_obj):
+    """Returns an `open_file(name)` callable reading feed files from a zip archive."""
+    archive = zipfile.ZipFile(file_obj)
+    names = {os.path.basename(name): name for name in archive.namelist()}
+
+    def open_file(name):
+        if name not in names:
+            return None
+        return io.TextIOWrapper(archive.open(names[name]), encoding='utf-8-sig', newline='')
+    return open_file
+
+
+def _parse_clock(value):
+    """Seconds since the start of the service day for an `HH:MM[:SS]` value (hours may exceed 24)."""
+    parts = [int(part) for part in value.split(':')]
+    if len(parts) == 2:
+        parts.append(0)
+    hours, minutes, seconds = parts
+    return hours * 3600 + minutes * 60 + seconds
+
+
+class FeedImporter:
+    def __init__(self, driver=None):
+        self.driver = driver
+        self.errors = []
+
+    def error(self, filename, line, message):
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            location = f"{filename} line {line}" if line else filename
+            self.errors.append(f"{location}: {message}")
+
+    def _rows(self, open_file, name, required_columns, any_of=()):
+        stream = open_file(name)
+        if stream is None:
+            return None
+        reader = csv.DictReader(stream)
+        columns = set(reader.fieldnames or ())
+        missing = [column for column in required_columns if column not in columns]
+        missing += [' or '.join(group) for group in any_of if not columns & set(group)]
+        if missing:
+            self.error(name, 1, f"missing column(s): {', '.join(missing)}")
+            stream.close()
+            return iter(())
+        return self._iterate(reader, stream)
+
+    @staticmethod
+    def _iterate(reader, stream):
+        with stream:
+            for line, row in enumerate(reader, start=2):
+                yield line, {key: (value or '').strip() for key, value in row.items() if key}
+
+    def run(self, open_file):
+        """Imports the feed and returns a summary; raises ValidationError without writing anything if it is invalid."""
+        stops = self._read_stops(open_file)
+        routes = self._read_routes(open_file)
+        trip_routes, trips = self._read_trips(open_file, routes)
+        patterns = self._read_stop_times(open_file, stops, routes, trip_routes)
+        route_stops = self._build_route_stops(patterns, stops, routes)
+
+        if self.errors:
+            raise ValidationError(self.errors)
+
+        return self._write(stops, routes, route_stops, trips)
+
+    def _read_stops(self, open_file):
+        existing = dict(Stop.objects.exclude(code='').values_list('code', 'id'))
+        stops = {}
+        rows = self._rows(open_file, 'stops.txt', ['stop_id', 'stop_name'])
+        if rows is None:
+            self.error('stops.txt', 0, "file is required")
+            return stops
+        for line, row in rows:
+            code = row['stop_id']
+            if not code or not row['stop_name']:
+                self.error('stops.txt', line, "stop_id and stop_name are required")
+                continue
+            if code in stops:
+                self.error('stops.txt', line, f"duplicate stop_id '{code}'")
+                continue
+            if code in existing:
+                stops[code] = existing[code]
+                continue
+            try:
+                latitude = float(row['stop_lat']) if row.get('stop_lat') else None
+                longitude = float(row['stop_lon']) if row.get('stop_lon') else None
+            except ValueError:
+                self.error('stops.txt', line, "stop_lat and stop_lon must be numbers")
+                continue
+            stops[code] = Stop(
+                code=code, name=row['stop_name'][:255], description=row.get('stop_desc', ''),
+                latitude=latitude, longitude=longitude,
+            )
+        return stops
+
+    def _read_routes(self, open_file):
+        existing = set(Route.objects.exclude(code='').values_list('code', flat=True))
+        routes = {}
+        rows = self._rows(open_file, 'routes.txt', ['route_id'], any_of=[('route_long_name', 'route_short_name')])
+        if rows is None:
+            self.error('routes.txt', 0, "file is required")
+            return routes
+        for line, row in rows:
+            code = row['route_id']
+            name = row.get('route_long_name') or row.get('route_short_name')
+            if not code or not name:
+                self.error('routes.txt', line, "route_id and a route name are required")
+            elif code in routes:
+                self.error('routes.txt', line, f"duplicate route_id '{code}'")
+            else:
+                # Routes already imported are kept as they are: existing bookings point at their stops.
+                routes[code] = None if code in existing else Route(code=code, name=name[:255], description=row.get('route_desc', ''))
+        return routes
+
+    def _read_trips(self, open_file, routes):
+        trip_routes = {}
+        trips = []
+        rows = self._rows(open_file, 'trips.txt', ['trip_id', 'route_id'])
+        if rows is None:
+            return trip_routes, trips
+        for line, row in rows:
+            if row['route_id'] not in routes:
+                self.error('trips.txt', line, f"unknown route_id '{row['route_id']}'")
+                continue
+            trip_routes[row['trip_id']] = row['route_id']
+            if not row.get('departure_time'):
+                continue
+            if self.driver is None:
+                self.error('trips.txt', line, "a driver is required to create trips")
+                continue
+            try:
+                departure_time = timezone.make_aware(datetime.strptime(row['departure_time'][:16], '%Y-%m-%d %H:%M'))
+                capacity = int(row['vehicle_capacity'])
+                cost_per_km = Decimal(row['cost_per_km'])
+            except (KeyError, ValueError, InvalidOperation):
+                self.error('trips.txt', line, "departure_time (YYYY-MM-DD HH:MM), vehicle_capacity and cost_per_km are required for a trip")
+                continue
+            if capacity < 1 or cost_per_km < 0:
+                self.error('trips.txt', line, "vehicle_capacity must be >= 1 and cost_per_km >= 0")
+                continue
+            trips.append((row['route_id'], departure_time, capacity, cost_per_km))
+        return trip_routes, trips
+
+    def _read_stop_times(self, open_file, stops, routes, trip_routes):
+        patterns = defaultdict(list)
+        pattern_trip = {}
+        sequences = set()
+        rows = self._rows(
+            open_file, 'stop_times.txt', ['stop_id', 'stop_sequence'],
+            any_of=[('route_id', 'trip_id'), ('arrival_time', 'minutes_from_previous_stop'),
+                    ('shape_dist_traveled', 'distance_from_previous_stop')],
+        )
+        if rows is None:
+            self.error('stop_times.txt', 0, "file is required")
+            return patterns
+        for line, row in rows:
+            route_code = row.get('route_id')
+            if not route_code:
+                trip_code = row.get('trip_id')
+                route_code = trip_routes.get(trip_code)
+                if route_code is None:
+                    self.error('stop_times.txt', line, f"unknown trip_id '{trip_code}'")
+                    continue
+                # Only the first trip on each route defines the route's stop pattern.
+                if pattern_trip.setdefault(route_code, trip_code) != trip_code:
+                    continue
+            if route_code not in routes:
+                self.error('stop_times.txt', line, f"unknown route_id '{route_code}'")
+                continue
+            if routes[route_code] is None:
+                continue
+            if row['stop_id'] not in stops:
+                self.error('stop_times.txt', line, f"unknown stop_id '{row['stop_id']}'")
+                continue
+            try:
+                sequence = int(row['stop_sequence'])
+                minutes = int(row['minutes_from_previous_stop']) if row.get('minutes_from_previous_stop') else None
+                clock = _parse_clock(row['arrival_time']) if minutes is None else None
+                distance = int(row['distance_from_previous_stop']) if row.get('distance_from_previous_stop') else None
+                cumulative_distance = float(row['shape_dist_traveled']) if distance is None else None
+            except (KeyError, ValueError):
+                self.error('stop_times.txt', line, "invalid stop_sequence, time or distance")
+                continue
+            if (route_code, sequence) in sequences:
+                self.error('stop_times.txt', line, f"duplicate stop_sequence {sequence} for route '{route_code}'")
+                continue
+            sequences.add((route_code, sequence))
+            patterns[route_code].append((sequence, line, row['stop_id'], minutes, clock, distance, cumulative_distance))
+        return patterns
+
+    def _build_route_stops(self, patterns, stops, routes):
+        """Turns each route's stop rows into (route code, stop code, order, minutes, distance) tuples."""
+        route_stops = []
+        for route_code, route in routes.items():
+            if route is None:
+                continue
+            rows = sorted(patterns.get(route_code, ()))
+            if len(rows) < 2:
+                self.error('stop_times.txt', 0, f"route '{route_code}' needs at least two stops")
+                continue
+            previous = None
+            for order, (sequence, line, stop_code, minutes, clock, distance, cumulative_distance) in enumerate(rows, start=1):
+                if previous is None:
+                    minutes, distance = 0, 0
+                else:
+                    if minutes is None:
+                        minutes = (clock - previous[4]) // 60 if previous[4] is not None else None
+                    if distance is None:
+                        distance = round(cumulative_distance - previous[6]) if previous[6] is not None else None
+                    if not minutes or minutes < 0 or not distance or distance < 0:
+                        self.error('stop_times.txt', line, "every stop after the first needs positive travel minutes and distance")
+                previous = (sequence, line, stop_code, minutes, clock, distance, cumulative_distance)
+                route_stops.append((route_code, stop_code, order, minutes, distance))
+        return route_stops
+
+    def _write(self, stops, routes, route_stops, trips):
+        new_stops = [stop for stop in stops.values() if isinstance(stop, Stop)]
+        new_routes = [route for route in routes.values() if route is not None]
+
+        with transaction.atomic():
+            Stop.objects.bulk_create(new_stops, batch_size=BATCH_SIZE)
+            Route.objects.bulk_create(new_routes, batch_size=BATCH_SIZE)
+            stop_ids = {code: stop.pk if isinstance(stop, Stop) else stop for code, stop in stops.items()}
+            route_ids = {route.code: route.pk for route in new_routes}
+            route_ids.update(Route.objects.filter(code__in=[code for code, route in routes.items() if route is None]).values_list('code', 'id'))
+
+            RouteStop.objects.bulk_create([
+                RouteStop(
+                    route_id=route_ids[route_code], stop_id=stop_ids[stop_code], order=order,
+                    minutes_from_previous_stop=minutes, distance_from_previous_stop=distance,
+                )
+                for route_code, stop_code, order, minutes, distance in route_stops
+            ], batch_size=BATCH_SIZE)
+            new_trips = Travellor.objects.bulk_create([
+                Travellor(
+                    driver=self.driver, route_id=route_ids[route_code], departure_time=departure_time,
+                    vehicle_capacity=capacity, cost_per_km=cost_per_km, status='SCHEDULED',
+                )
+                for route_code, departure_time, capacity, cost_per_km in trips
+            ], batch_size=BATCH_SIZE)
+
+            # bulk_create skips model signals, so write stop times and bump the caches'
+            # version counters directly.
+            build_stop_times(new_trips)
+            service_dates = {timezone.localdate(trip[1]) for trip in trips}
+            transaction.on_commit(lambda: _bump_after_import(bool(new_stops), service_dates))
+
+        return {
+            'stops_created': len(new_stops),
+            'routes_created': len(new_routes),
+            'routes_skipped': len(routes) - len(new_routes),
+            'route_stops_created': len(route_stops),
+            'trips_created': len(trips),
+        }
+
+
+def _bump_after_import(stops_changed, service_dates):
+    if stops_changed:
+        bump_version(STOPS_VERSION_KEY)
+    for service_date in service_dates:
+        bump_version(timetable_version_key(service_date))
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Write-only buffer that a zip is written into and that is drained as the zip grows."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _format_clock(seconds):
+    """GTFS HH:MM:SS for seconds after the service day's midnight; hours run past 24 for late arrivals."""
+    hours, remainder = divmod(int(seconds), 3600)
+    return f"{hours:02d}:{remainder // 60:02d}:{remainder % 60:02d}"
+
+
+def _csv_line(values):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerow(values)
+    return buffer.getvalue()
+
+
+class FeedExporter:
+    """
+    Exports the scheduled timetable between `start_date` and `end_date` (inclusive).
+    With a `cache_dir`, each route's stop times for a day are kept as a fragment
+    keyed by a fingerprint of its trips and route version, and reused while unchanged.
+    Fragments an export no longer needs are deleted when it finishes.
+    """
+
+    def __init__(self, start_date, end_date, cache_dir=None):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.cache_dir = cache_dir
+        self.fragments_generated = 0
+        self.fragments_reused = 0
+        self._fragments_used = set()
+
+    def iter_zip(self):
+        """Yields the zip archive in chunks as it is produced."""
+        buffer = _ChunkBuffer()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for name, lines in self._files():
+                with archive.open(name, 'w', force_zip64=True) as member:
+                    pending = 0
+                    for line in lines:
+                        data = line.encode('utf-8')
+                        member.write(data)
+                        pending += len(data)
+                        if pending >= EXPORT_CHUNK_BYTES:
+                            pending = 0
+                            chunk = buffer.drain()
+                            if chunk:
+                                yield chunk
+                yield buffer.drain()
+        yield buffer.drain()
+
+    def write(self, file_obj):
+        for chunk in self.iter_zip():
+            file_obj.write(chunk)
+
+    def _files(self):
+        start, _ = day_bounds(self.start_date)
+        _, end = day_bounds(self.end_date)
+        trips = list(
+            Travellor.objects.filter(status='SCHEDULED', departure_time__gte=start, departure_time__lt=end)
+            .order_by('route_id', 'departure_time')
+            .values_list('id', 'route_id', 'departure_time', 'vehicle_capacity', 'cost_per_km')
+        )
+        trips_by_route_day = defaultdict(list)
+        for trip in trips:
+            trips_by_route_day[(trip[1], timezone.localdate(trip[2]))].append(trip)
+        route_ids = sorted({route_id for route_id, _ in trips_by_route_day})
+
+        patterns = defaultdict(list)
+        for route_id, stop_id, order, minutes, distance in RouteStop.objects.filter(route_id__in=route_ids).order_by(
+            'route_id', 'order'
+        ).values_list('route_id', 'stop_id', 'order', 'minutes_from_previous_stop', 'distance_from_previous_stop'):
+            patterns[route_id].append((stop_id, order, minutes, distance))
+        stop_ids = {row[0] for rows in patterns.values() for row in rows}
+
+        yield 'agency.txt', self._agency()
+        yield 'stops.txt', self._stops(stop_ids)
+        yield 'routes.txt', self._routes(route_ids)
+        yield 'calendar_dates.txt', self._calendar_dates({day for _, day in trips_by_route_day})
+        yield 'trips.txt', self._trips(trips_by_route_day)
+        yield 'stop_times.txt', self._stop_times(trips_by_route_day, patterns)
+
+    def _agency(self):
+        yield _csv_line(['agency_id', 'agency_name', 'agency_url', 'agency_timezone'])
+        yield _csv_line(['cabportal', 'Cab Portal', 'https://example.com', settings.TIME_ZONE])
+
+    def _stops(self, stop_ids):
+        yield _csv_line(['stop_id', 'stop_code', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon'])
+        stops = Stop.objects.filter(id__in=stop_ids).order_by('id').values_list(
+            'id', 'code', 'name', 'description', 'latitude', 'longitude'
+        )
+        for stop_id, code, name, description, latitude, longitude in stops.iterator(chunk_size=BATCH_SIZE):
+            yield _csv_line([stop_id, code, name, description, '' if latitude is None else latitude, '' if longitude is None else longitude])
+
+    def _routes(self, route_ids):
+        yield _csv_line(['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_desc', 'route_type'])
+        routes = Route.objects.filter(id__in=route_ids).order_by('id').values_list('id', 'code', 'name', 'description')
+        for route_id, code, name, description in routes.iterator(chunk_size=BATCH_SIZE):
+            # route_type 3 is "bus" in GTFS.
+            yield _csv_line([route_id, 'cabportal', code, name, description, 3])
+
+    def _calendar_dates(self, days):
+        yield _csv_line(['service_id', 'date', 'exception_type'])
+        for day in sorted(days):
+            yield _csv_line([day.strftime('%Y%m%d'), day.strftime('%Y%m%d'), 1])
+
+    def _trips(self, trips_by_route_day):
+        # departure_time, vehicle_capacity and cost_per_km are extensions that FeedImporter reads back.
+        yield _csv_line(['route_id', 'service_id', 'trip_id', 'departure_time', 'vehicle_capacity', 'cost_per_km'])
+        for (route_id, day), trips in sorted(trips_by_route_day.items()):
+            service_id = day.strftime('%Y%m%d')
+            for trip_id, _, departure_time, capacity, cost_per_km in trips:
+                local_departure = timezone.localtime(departure_time).strftime('%Y-%m-%d %H:%M')
+                yield _csv_line([route_id, service_id, trip_id, local_departure, capacity, cost_per_km])
+
+    def _stop_times(self, trips_by_route_day, patterns):
+        yield _csv_line(['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence', 'shape_dist_traveled'])
+        versions = get_versions([route_version_key(route_id) for route_id in patterns]) if self.cache_dir else {}
+        for (route_id, day), trips in sorted(trips_by_route_day.items()):
+            pattern = patterns.get(route_id)
+            if not pattern:
+                continue
+            if self.cache_dir:
+                yield self._cached_fragment(route_id, day, trips, pattern, versions[route_version_key(route_id)])
+            else:
+                yield self._stop_times_fragment(day, trips, pattern)
+        if self.cache_dir:
+            self._prune_fragments()
+
+    def _stop_times_fragment(self, day, trips, pattern):
+        midnight, _ = day_bounds(day)
+        offsets = np.cumsum([minutes for _, _, minutes, _ in pattern]) * 60
+        distances = np.cumsum([distance for _, _, _, distance in pattern])
+        departures = np.array([(trip[2] - midnight).total_seconds() for trip in trips])
+        # One row per trip, one column per stop: every ETA in a single outer sum.
+        etas = departures[:, None] + offsets[None, :]
+
+        clocks = [_format_clock(seconds) for seconds in etas.ravel()]
+        lines = []
+        width = len(pattern)
+        for i, trip in enumerate(trips):
+            for j, (stop_id, order, _, _) in enumerate(pattern):
+                clock = clocks[i * width + j]
+                lines.append(f"{trip[0]},{clock},{clock},{stop_id},{order},{distances[j]}\n")
+        return ''.join(lines)
+
+    def _cached_fragment(self, route_id, day, trips, pattern, route_version):
+        fingerprint = hashlib.sha1(repr((route_version, trips)).encode()).hexdigest()[:16]
+        directory = os.path.join(self.cache_dir, 'stop_times', str(route_id))
+        os.makedirs(directory, exist_ok=True)
+        prefix = f"{day.isoformat()}-"
+        path = os.path.join(directory, prefix + fingerprint + '.txt')
+        self._fragments_used.add(path)
+        try:
+            with open(path, encoding='utf-8') as fragment:
+                content = fragment.read()
+            self.fragments_reused += 1
+            return content
+        except FileNotFoundError:
+            pass
+
+        content = self._stop_times_fragment(day, trips, pattern)
+        for name in os.listdir(directory):
+            if name.startswith(prefix):
+                _remove(os.path.join(directory, name))
+        # A private temporary file, so concurrent exports never write into each other's.
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory, suffix='.tmp', delete=False) as fragment:
+            fragment.write(content)
+        os.replace(fragment.name, path)
+        self.fragments_generated += 1
+        return content
+
+    def _prune_fragments(self):
+        """
+        Deletes the fragments of days before the export (or before today, if
+        earlier), fragments of exported days that this export did not use, and
+        temporary files left behind by interrupted exports.
+        """
+        root = os.path.join(self.cache_dir, 'stop_times')
+        if not os.path.isdir(root):
+            return
+        oldest_kept = min(self.start_date, timezone.localdate())
+        for route_dir in os.scandir(root):
+            for entry in os.scandir(route_dir.path):
+                if entry.name.endswith('.tmp'):
+                    stale = entry.stat().st_mtime < time.time() - STALE_TEMP_FILE_SECONDS
+                else:
+                    try:
+                        day = date.fromisoformat(entry.name[:10])
+                    except ValueError:
+                        continue
+                    stale = day < oldest_kept or (
+                        self.start_date <= day <= self.end_date and entry.path not in self._fragments_used
+                    )
+                if stale:
+                    _remove(entry.path)
+            try:
+                os.rmdir(route_dir.path)
+            except OSError:
+                pass  # still holds fragments
+
+
+def _remove(path):
+    # Another export may have removed it first.
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
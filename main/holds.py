@@ -0,0 +1,71 @@
+"""
+Short-lived seat holds for checkout.
+
+A hold is counted by `LegLoads` like a confirmed booking until `expires_at`, so
+seats found at search time are still there after payment. Expiry is lazy:
+readers ignore expired rows, and `sweep_expired_holds` deletes them in one
+indexed pass and hands the freed seats to the waitlist.
+"""
+from datetime import timedelta
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from .metrics import BOOKING_REJECTIONS
+from .models import Booking, SeatHold, WaitlistEntry
+from .seats import LegLoads
+from .waitlist import lock_trip, promote_waitlist
+
+HOLD_TTL = timedelta(minutes=10)
+
+
+def place_hold(customer, trip, start_stop, end_stop, seats):
+    with transaction.atomic():
+        trip = lock_trip(trip.pk)
+        available = LegLoads.for_trip(trip).available(start_stop.order, end_stop.order)
+        if seats > available:
+            BOOKING_REJECTIONS.labels('no_seats').inc()
+            raise ValidationError(f"Not enough seats available. Only {max(available, 0)} seat(s) left for this segment.")
+        return SeatHold.objects.create(
+            trip=trip, customer=customer, start_stop=start_stop, end_stop=end_stop, seats=seats,
+            expires_at=timezone.now() + HOLD_TTL,
+        )
+
+
+def confirm_hold(hold):
+    """Turns a live hold into a confirmed booking; the held seats are never released in between."""
+    with transaction.atomic():
+        lock_trip(hold.trip_id)
+        hold = SeatHold.objects.filter(pk=hold.pk, expires_at__gt=timezone.now()).first()
+        if hold is None:
+            BOOKING_REJECTIONS.labels('hold_expired').inc()
+            raise ValidationError("This hold has expired.")
+        hold.delete()
+        return Booking.objects.create(
+            trip_id=hold.trip_id,
+            customer_id=hold.customer_id,
+            start_stop_id=hold.start_stop_id,
+            end_stop_id=hold.end_stop_id,
+            seats=hold.seats,
+        )
+
+
+def release_hold(hold):
+    with transaction.atomic():
+        trip = lock_trip(hold.trip_id)
+        hold.delete()
+        promote_waitlist(trip)
+
+
+def sweep_expired_holds():
+    """Deletes expired holds and promotes waiting customers on their trips. Returns the number deleted."""
+    expired = SeatHold.objects.filter(expires_at__lte=timezone.now())
+    trip_ids = set(expired.values_list('trip_id', flat=True))
+    deleted, _ = expired.delete()
+
+    waiting = WaitlistEntry.objects.filter(trip_id__in=trip_ids, status='WAITING').values_list('trip_id', flat=True)
+    for trip_id in sorted(set(waiting)):
+        with transaction.atomic():
+            promote_waitlist(lock_trip(trip_id))
+    return deleted
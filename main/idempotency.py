@@ -0,0 +1,100 @@
+"""
+`Idempotency-Key` support for booking endpoints.
+
+The key is claimed by inserting an `IdempotencyKey` row in the same transaction
+that runs the view, so the unique constraint serializes concurrent duplicates:
+the second insert waits for the first transaction and then fails, and the
+duplicate replays the stored response without running the view. If the view
+raises, the claim is rolled back with everything else and the client can retry.
+"""
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+KEY_TTL = timedelta(hours=24)
+
+
+def _fingerprint(data):
+    if hasattr(data, 'lists'):
+        data = dict(data.lists())
+    body = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def _claim(user, endpoint, key, fingerprint):
+    """Returns `(record, claimed)`; `claimed` is False when the key already has a live record."""
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            record = IdempotencyKey.objects.create(
+                user=user, endpoint=endpoint, key=key, fingerprint=fingerprint, expires_at=now + KEY_TTL,
+            )
+            return record, True
+    except IntegrityError:
+        pass
+
+    record = IdempotencyKey.objects.select_for_update().get(user=user, endpoint=endpoint, key=key)
+    if record.expires_at > now:
+        return record, False
+    # An expired key is reusable, as if it had been purged.
+    record.fingerprint = fingerprint
+    record.status_code = None
+    record.response = None
+    record.expires_at = now + KEY_TTL
+    record.save()
+    return record, True
+
+
+def idempotent(endpoint):
+    """Decorates an APIView `post` so requests carrying an `Idempotency-Key` header run at most once."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if key is None:
+                return method(self, request, *args, **kwargs)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                return Response(
+                    {"error": f"{HEADER} must be between 1 and {MAX_KEY_LENGTH} characters."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            fingerprint = _fingerprint(request.data)
+            with transaction.atomic():
+                record, claimed = _claim(request.user, endpoint, key, fingerprint)
+                if not claimed:
+                    if record.fingerprint != fingerprint:
+                        return Response(
+                            {"error": f"This {HEADER} was already used with a different request."},
+                            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        )
+                    response = Response(record.response, status=record.status_code)
+                    response['Idempotent-Replayed'] = 'true'
+                    return response
+
+                response = method(self, request, *args, **kwargs)
+                if response.status_code >= 500:
+                    record.delete()
+                else:
+                    record.status_code = response.status_code
+                    record.response = response.data
+                    record.save(update_fields=['status_code', 'response'])
+                return response
+        return wrapper
+    return decorator
+
+
+def purge_expired_keys():
+    """Deletes expired keys; returns how many were removed."""
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
@@ -0,0 +1,335 @@
+"""
+Multi-leg journey planning across routes.
+
+The day's scheduled trips and their routes' stop offsets are loaded into a compact
+in-memory `Timetable`, which is searched with a round-based earliest-arrival
+algorithm (RAPTOR): round k finds the best arrival at every stop using at most k
+trips. Timetables are kept per process and refreshed incrementally: only routes
+whose trips or stops changed since the last build are reloaded.
+"""
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from copy import copy
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.utils import timezone
+
+from .metrics import CACHE_LOOKUPS
+from .models import Route, RouteStop, Stop, Travellor
+from .seats import occupied_segments
+from .versioning import get_versions
+
+MAX_CACHED_DATES = 7
+
+_timetables = {}
+_lock = threading.Lock()
+
+
+def timetable_version_key(service_date):
+    return f"timetable:{service_date.isoformat()}"
+
+
+def route_version_key(route_id):
+    return f"route:{route_id}"
+
+
+def day_bounds(service_date):
+    tz = timezone.get_current_timezone()
+    start = timezone.make_aware(datetime.combine(service_date, time.min), tz)
+    return start, start + timedelta(days=1)
+
+
+class RoutePattern:
+    """A route's stop sequence plus the day's trips on it, sorted by departure."""
+
+    def __init__(self, route_id, name, rows):
+        self.route_id = route_id
+        self.name = name
+        self.route_stop_ids = []
+        self.stop_ids = []
+        self.orders = []
+        self.offsets = []  # seconds from the trip's departure
+        total = 0
+        for route_stop_id, stop_id, order, minutes in rows:
+            total += minutes
+            self.route_stop_ids.append(route_stop_id)
+            self.stop_ids.append(stop_id)
+            self.orders.append(order)
+            self.offsets.append(total * 60)
+        self.index_by_order = {order: i for i, order in enumerate(self.orders)}
+        self.trips = []
+        self.departures = []
+
+    def with_trips(self, trips):
+        """
+        Returns a copy of the pattern running `trips`, an iterable of
+        `(departure_ts, trip_id, capacity)`. The stop sequence is shared.
+        """
+        pattern = copy(self)
+        pattern.trips = sorted(trips)
+        pattern.departures = [trip[0] for trip in pattern.trips]
+        return pattern
+
+
+class Timetable:
+    """
+    In-memory timetable for one service date. A timetable is never changed once
+    built: `refresh` returns a new one, so searches can read it without locking.
+    """
+
+    def __init__(self, service_date):
+        self.service_date = service_date
+        self.version = None
+        self.route_versions = {}
+        self.trip_rows = {}
+        self.patterns = {}
+        self.trips = {}  # trip_id -> (pattern, capacity)
+        self.stop_routes = {}
+        self.stop_names = {}
+
+    def refresh(self, version):
+        """
+        Returns a timetable with the day's current trips, rebuilding only the
+        routes that changed and reusing the rest of this one.
+        """
+        start, end = day_bounds(self.service_date)
+        rows = Travellor.objects.filter(
+            status='SCHEDULED', departure_time__gte=start, departure_time__lt=end,
+        ).values_list('route_id', 'departure_time', 'delay_minutes', 'id', 'vehicle_capacity')
+
+        trip_rows = defaultdict(list)
+        for route_id, departure_time, delay_minutes, trip_id, capacity in rows:
+            # Journeys are planned on the trip's expected departure, delay included.
+            departure_ts = int(departure_time.timestamp()) + (delay_minutes or 0) * 60
+            trip_rows[route_id].append((departure_ts, trip_id, capacity))
+
+        route_versions = get_versions([route_version_key(route_id) for route_id in trip_rows])
+        stale = [
+            route_id for route_id in trip_rows
+            if route_id not in self.patterns
+            or self.route_versions.get(route_id) != route_versions[route_version_key(route_id)]
+        ]
+
+        timetable = Timetable(self.service_date)
+        timetable.version = version
+        timetable.trip_rows = dict(trip_rows)
+        timetable.stop_names = dict(self.stop_names)
+
+        patterns = {}
+        if stale:
+            names = dict(Route.objects.filter(id__in=stale).values_list('id', 'name'))
+            stop_rows = defaultdict(list)
+            for route_id, *row in RouteStop.objects.filter(route_id__in=stale).order_by('route_id', 'order').values_list(
+                'route_id', 'id', 'stop_id', 'order', 'minutes_from_previous_stop'
+            ):
+                stop_rows[route_id].append(row)
+            for route_id in stale:
+                patterns[route_id] = RoutePattern(route_id, names.get(route_id, ''), stop_rows[route_id])
+        for route_id, trips in trip_rows.items():
+            if route_id in patterns:
+                timetable.patterns[route_id] = patterns[route_id].with_trips(trips)
+                timetable.route_versions[route_id] = route_versions[route_version_key(route_id)]
+            else:
+                pattern = self.patterns[route_id]
+                timetable.patterns[route_id] = pattern if self.trip_rows.get(route_id) == trips else pattern.with_trips(trips)
+                timetable.route_versions[route_id] = self.route_versions[route_id]
+
+        timetable.trips = {
+            trip_id: (pattern, capacity) for pattern in timetable.patterns.values() for _, trip_id, capacity in pattern.trips
+        }
+        if stale or set(self.patterns) != set(timetable.patterns):
+            timetable._index_stops()
+        else:
+            timetable.stop_routes = self.stop_routes
+        return timetable
+
+    def _index_stops(self):
+        stop_routes = defaultdict(list)
+        for pattern in self.patterns.values():
+            for i, stop_id in enumerate(pattern.stop_ids):
+                stop_routes[stop_id].append((pattern.route_id, i))
+        self.stop_routes = dict(stop_routes)
+        missing = set(self.stop_routes) - set(self.stop_names)
+        if missing:
+            self.stop_names.update(Stop.objects.filter(id__in=missing).values_list('id', 'name'))
+
+    def seat_availability(self, trip_ids):
+        """
+        Returns `{trip_id: [available seats per leg]}` for the given trips, built from
+        one query over confirmed bookings and seat holds using per-trip difference arrays.
+        """
+        capacity = {}
+        pattern_of = {}
+        for trip_id in trip_ids:
+            pattern_of[trip_id], capacity[trip_id] = self.trips[trip_id]
+
+        deltas = {trip_id: [0] * len(pattern_of[trip_id].stop_ids) for trip_id in capacity}
+        if capacity:
+            for trip_id, start_order, end_order, seats in occupied_segments(trip_id__in=list(capacity)):
+                index_by_order = pattern_of[trip_id].index_by_order
+                if start_order in index_by_order and end_order in index_by_order:
+                    deltas[trip_id][index_by_order[start_order]] += seats
+                    deltas[trip_id][index_by_order[end_order]] -= seats
+
+        availability = {}
+        for trip_id, delta in deltas.items():
+            occupied = 0
+            legs = []
+            for change in delta[:-1]:
+                occupied += change
+                legs.append(capacity[trip_id] - occupied)
+            availability[trip_id] = legs
+        return availability
+
+
+def get_timetable(service_date):
+    """Returns the up-to-date timetable for a date, refreshing it only if trips or routes changed."""
+    version = get_versions([timetable_version_key(service_date)])[timetable_version_key(service_date)]
+    with _lock:
+        timetable = _timetables.get(service_date)
+        if timetable is None:
+            if len(_timetables) >= MAX_CACHED_DATES:
+                _timetables.pop(min(_timetables))
+            timetable = Timetable(service_date)
+        stale = timetable.version != version or _routes_changed(timetable)
+        CACHE_LOOKUPS.labels('timetable', 'miss' if stale else 'hit').inc()
+        if stale:
+            timetable = timetable.refresh(version)
+        _timetables[service_date] = timetable
+        return timetable
+
+
+def _routes_changed(timetable):
+    if not timetable.route_versions:
+        return False
+    current = get_versions([route_version_key(route_id) for route_id in timetable.route_versions])
+    return any(current[route_version_key(route_id)] != v for route_id, v in timetable.route_versions.items())
+
+
+def plan_journeys(timetable, origin, destination, depart_after, max_transfers=2, min_transfer_minutes=5, seats=1):
+    """
+    Runs RAPTOR from `origin` to `destination` (Stop ids), leaving no earlier than
+    `depart_after` (aware datetime). Returns one itinerary per number of trips that
+    improves on the arrival time found with fewer trips.
+    """
+    if origin not in timetable.stop_routes or destination not in timetable.stop_routes:
+        return []
+
+    availability = {}
+    transfer_seconds = min_transfer_minutes * 60
+    infinity = float('inf')
+
+    best = {origin: int(depart_after.timestamp())}
+    ready = {origin: best[origin]}  # time a rider at the stop can board the next trip
+    labels = [{}]
+    marked = {origin}
+    itineraries = []
+
+    for round_number in range(1, max_transfers + 2):
+        round_labels = dict(labels[-1])
+        round_ready = dict(ready)
+        new_marked = set()
+
+        queue = {}
+        for stop_id in marked:
+            for route_id, index in timetable.stop_routes.get(stop_id, ()):
+                if index < queue.get(route_id, infinity):
+                    queue[route_id] = index
+        _load_availability(timetable, availability, queue, ready)
+
+        for route_id, first_index in queue.items():
+            pattern = timetable.patterns[route_id]
+            trip = None
+            for i in range(first_index, len(pattern.stop_ids)):
+                stop_id = pattern.stop_ids[i]
+                if trip is not None:
+                    departure_ts, trip_id, _ = trip
+                    leg_seats = availability[trip_id][i - 1]
+                    if leg_seats < seats:
+                        trip = None
+                    else:
+                        min_seats = min(min_seats, leg_seats)
+                        arrival = departure_ts + pattern.offsets[i]
+                        if arrival < min(best.get(stop_id, infinity), best.get(destination, infinity)):
+                            best[stop_id] = arrival
+                            round_ready[stop_id] = arrival + transfer_seconds
+                            round_labels[stop_id] = (pattern, trip, board_index, i, board_stop, min_seats)
+                            new_marked.add(stop_id)
+
+                if stop_id in ready and i < len(pattern.stop_ids) - 1:
+                    boardable = _earliest_trip(pattern, i, ready[stop_id], availability, seats)
+                    if boardable is not None and (trip is None or boardable[0] < trip[0]):
+                        trip = boardable
+                        board_index = i
+                        board_stop = stop_id
+                        min_seats = infinity
+
+        labels.append(round_labels)
+        ready = round_ready
+        if destination in new_marked:
+            itineraries.append(_reconstruct(timetable, labels, round_number, origin, destination))
+        marked = new_marked
+        if not marked:
+            break
+
+    return itineraries
+
+
+def _load_availability(timetable, availability, queue, ready):
+    """Adds the seat availability of the trips this round could board to `availability`."""
+    trip_ids = []
+    for route_id, first_index in queue.items():
+        pattern = timetable.patterns[route_id]
+        boardable_from = min(
+            (ready[stop_id] - pattern.offsets[i]
+             for i, stop_id in enumerate(pattern.stop_ids[first_index:-1], first_index) if stop_id in ready),
+            default=None,
+        )
+        if boardable_from is not None:
+            position = bisect_left(pattern.departures, boardable_from)
+            trip_ids.extend(trip_id for _, trip_id, _ in pattern.trips[position:] if trip_id not in availability)
+    if trip_ids:
+        availability.update(timetable.seat_availability(trip_ids))
+
+
+def _earliest_trip(pattern, index, ready_ts, availability, seats):
+    position = bisect_left(pattern.departures, ready_ts - pattern.offsets[index])
+    for trip in pattern.trips[position:]:
+        if availability[trip[1]][index] >= seats:
+            return trip
+    return None
+
+
+def _reconstruct(timetable, labels, round_number, origin, destination):
+    legs = []
+    stop_id = destination
+    for k in range(round_number, 0, -1):
+        if stop_id == origin:
+            break
+        pattern, trip, board_index, alight_index, board_stop, min_seats = labels[k][stop_id]
+        departure_ts, trip_id, _ = trip
+        legs.append({
+            'trip_id': trip_id,
+            'route_id': pattern.route_id,
+            'route_name': pattern.name,
+            'start_stop_id': pattern.route_stop_ids[board_index],
+            'end_stop_id': pattern.route_stop_ids[alight_index],
+            'start_stop_name': timetable.stop_names.get(board_stop, ''),
+            'end_stop_name': timetable.stop_names.get(stop_id, ''),
+            'departure': _to_datetime(departure_ts + pattern.offsets[board_index]),
+            'arrival': _to_datetime(departure_ts + pattern.offsets[alight_index]),
+            'available_seats': min_seats,
+        })
+        stop_id = board_stop
+    legs.reverse()
+    return {
+        'departure': legs[0]['departure'],
+        'arrival': legs[-1]['arrival'],
+        'transfers': len(legs) - 1,
+        'legs': legs,
+    }
+
+
+def _to_datetime(timestamp):
+    return timezone.localtime(datetime.fromtimestamp(timestamp, tz=dt_timezone.utc))
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.models import Booking
+
+
+class Command(BaseCommand):
+    help = "Fills the booking-time snapshot (distance, fare, ETAs, stop names) for existing bookings."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Number of bookings updated per transaction.")
+        parser.add_argument('--all', action='store_true', help="Recompute snapshots for bookings that already have one.")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        bookings = Booking.objects.select_related('trip').order_by('pk')
+        if not options['all']:
+            bookings = bookings.filter(estimated_departure__isnull=True)
+
+        # Route offsets are shared by every booking on the route, so compute them once.
+        offsets_by_route = {}
+        last_pk = 0
+        updated = 0
+        skipped = 0
+
+        while True:
+            chunk = list(bookings.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+
+            to_update = []
+            for booking in chunk:
+                route_id = booking.trip.route_id
+                if route_id not in offsets_by_route:
+                    offsets_by_route[route_id] = booking.trip.route.get_stop_offsets()
+                if booking.capture_snapshot(offsets_by_route[route_id]):
+                    to_update.append(booking)
+                else:
+                    skipped += 1
+
+            with transaction.atomic():
+                Booking.objects.bulk_update(to_update, [
+                    'segment_distance', 'fare', 'estimated_departure', 'estimated_arrival',
+                    'start_stop_name', 'end_stop_name',
+                ])
+            updated += len(to_update)
+            self.stdout.write(f"Processed up to booking {last_pk} ({updated} updated).")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {updated} booking(s), skipped {skipped}."))
@@ -0,0 +1,83 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from main.renderers import FastJSONRenderer
+from main.views import CabBookingView, SearchTravellersView, UserBookingsView
+
+BOOKING_QUERIES = [
+    '',
+    'expand=',
+    'expand=trip',
+    'expand=trip.route_stops',
+    'fields=id,status,estimated_departure,estimated_arrival',
+]
+CAB_BOOKING_QUERIES = ['', 'expand=', 'expand=car']
+SEARCH_QUERIES = ['', 'expand=', 'fields=id,departure_time,price']
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the payload size, query count and time of a customer's booking lists and of a "
+        "trip search for each fields/expand combination, and compares the JSON renderers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('customer', help="Username of the customer whose bookings are listed.")
+        parser.add_argument('--start-stop', type=int, help="Start stop id for the search benchmark.")
+        parser.add_argument('--end-stop', type=int, help="End stop id for the search benchmark.")
+        parser.add_argument('--runs', type=int, default=20, help="Timed runs per request.")
+
+    def handle(self, *args, **options):
+        try:
+            self.user = User.objects.get(username=options['customer'])
+        except User.DoesNotExist:
+            raise CommandError(f"User '{options['customer']}' does not exist.")
+        self.runs = options['runs']
+        self.factory = APIRequestFactory()
+
+        # Admission control would throttle the repeated searches.
+        with override_settings(ADMISSION_CONTROL={}):
+            bookings = [self.measure(UserBookingsView, '/my-bookings/', query) for query in BOOKING_QUERIES]
+            for query in CAB_BOOKING_QUERIES:
+                self.measure(CabBookingView, '/cab-bookings/', query)
+            if options['start_stop'] and options['end_stop']:
+                stops = f"start_stop_id={options['start_stop']}&end_stop_id={options['end_stop']}"
+                for query in SEARCH_QUERIES:
+                    self.measure(SearchTravellersView, '/search-travellers/', '&'.join(filter(None, [stops, query])))
+
+        # Render the full booking list with both renderers.
+        data = bookings[0].data
+        for renderer in (JSONRenderer(), FastJSONRenderer()):
+            start = time.perf_counter()
+            for _ in range(self.runs):
+                body = renderer.render(data)
+            elapsed = (time.perf_counter() - start) / self.runs * 1000
+            self.stdout.write(f"{type(renderer).__name__:70} {len(body):>9,d} B {'':>7} {elapsed:>8.2f} ms")
+
+    def measure(self, view_class, path, query):
+        view = view_class.as_view()
+
+        def get():
+            request = self.factory.get(f"{path}?{query}" if query else path)
+            force_authenticate(request, user=self.user)
+            return view(request).render()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = get()
+        if response.status_code != 200:
+            raise CommandError(f"GET {path}?{query} returned {response.status_code}: {response.content[:200]!r}")
+        start = time.perf_counter()
+        for _ in range(self.runs):
+            get()
+        elapsed = (time.perf_counter() - start) / self.runs * 1000
+
+        label = f"{path}?{query}" if query else path
+        self.stdout.write(f"{label:70} {len(response.content):>9,d} B {len(queries):>5d} q {elapsed:>8.2f} ms")
+        return response
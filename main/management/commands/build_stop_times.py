@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Travellor
+from main.stop_times import build_stop_times
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the materialized stop times that back the per-stop departure boards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--route', type=int, help="Only rebuild trips on this route.")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Number of trips rebuilt per transaction.")
+
+    def handle(self, *args, **options):
+        trips = Travellor.objects.only('id', 'route_id', 'departure_time').order_by('pk')
+        if options['route']:
+            trips = trips.filter(route_id=options['route'])
+
+        last_pk = 0
+        built = 0
+        while True:
+            chunk = list(trips.filter(pk__gt=last_pk)[:options['chunk_size']])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+            built += build_stop_times(chunk)
+            self.stdout.write(f"Processed up to trip {last_pk} ({built} stop times).")
+
+        self.stdout.write(self.style.SUCCESS(f"Built {built} stop time(s)."))
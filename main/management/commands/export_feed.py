@@ -0,0 +1,32 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.gtfs import FeedExporter
+
+
+class Command(BaseCommand):
+    help = "Writes a GTFS feed (zip) of the scheduled timetable for a date range."
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Path of the zip file to write.")
+        parser.add_argument('--from', dest='start', required=True, help="First service date, YYYY-MM-DD.")
+        parser.add_argument('--to', dest='end', required=True, help="Last service date, YYYY-MM-DD.")
+        parser.add_argument('--cache-dir', help="Directory of per-route, per-day stop time fragments; only changed ones are regenerated.")
+
+    def handle(self, *args, **options):
+        try:
+            start = datetime.strptime(options['start'], '%Y-%m-%d').date()
+            end = datetime.strptime(options['end'], '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError("Dates must be in YYYY-MM-DD format.")
+        if end < start:
+            raise CommandError("--to must not be before --from.")
+
+        exporter = FeedExporter(start, end, cache_dir=options['cache_dir'])
+        with open(options['output'], 'wb') as output:
+            exporter.write(output)
+
+        if options['cache_dir']:
+            self.stdout.write(f"Stop time fragments: {exporter.fragments_generated} generated, {exporter.fragments_reused} reused.")
+        self.stdout.write(self.style.SUCCESS(f"Feed written to {options['output']}."))
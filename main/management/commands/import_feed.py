@@ -0,0 +1,38 @@
+import os
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from main.gtfs import FeedImporter, open_directory, open_zip
+
+
+class Command(BaseCommand):
+    help = "Imports stops, routes and trips from a GTFS-style feed (a directory or a .zip of CSV files)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Directory or zip file containing stops.txt, routes.txt, stop_times.txt and optionally trips.txt.")
+        parser.add_argument('--driver', help="Username assigned as the driver of imported trips.")
+
+    def handle(self, *args, **options):
+        driver = None
+        if options['driver']:
+            try:
+                driver = User.objects.get(username=options['driver'])
+            except User.DoesNotExist:
+                raise CommandError(f"User '{options['driver']}' does not exist.")
+
+        path = options['path']
+        importer = FeedImporter(driver=driver)
+        try:
+            if os.path.isdir(path):
+                summary = importer.run(open_directory(path))
+            else:
+                with open(path, 'rb') as feed:
+                    summary = importer.run(open_zip(feed))
+        except ValidationError as e:
+            raise CommandError("Feed rejected:\n" + "\n".join(e.messages))
+
+        for key, value in summary.items():
+            self.stdout.write(f"{key.replace('_', ' ').capitalize()}: {value}")
+        self.stdout.write(self.style.SUCCESS("Feed imported."))
@@ -0,0 +1,30 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from main.rollups import BATCH_SIZE, mark_trips_stale, refresh_rollups
+
+
+class Command(BaseCommand):
+    help = "Recomputes the occupancy and revenue rollups of trips that changed since the last refresh."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--driver', help="Only refresh this vendor's trips (username).")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Number of trips computed per batch.")
+        parser.add_argument('--all', action='store_true', help="Recompute every trip, not only stale ones.")
+
+    def handle(self, *args, **options):
+        driver_id = None
+        if options['driver']:
+            try:
+                driver_id = User.objects.get(username=options['driver']).id
+            except User.DoesNotExist:
+                raise CommandError(f"User '{options['driver']}' does not exist.")
+
+        if options['all']:
+            if driver_id is None:
+                mark_trips_stale()
+            else:
+                mark_trips_stale(driver_id=driver_id)
+
+        refreshed = refresh_rollups(driver_id=driver_id, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Refreshed rollups for {refreshed} trip(s)."))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from main.holds import sweep_expired_holds
+
+
+class Command(BaseCommand):
+    help = "Deletes expired seat holds and promotes waitlisted customers into the freed seats."
+
+    def handle(self, *args, **options):
+        deleted = sweep_expired_holds()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired hold(s)."))
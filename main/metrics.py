@@ -0,0 +1,83 @@
+"""
+Prometheus metrics for requests, seat checks, searches, caches and bookings.
+
+Metrics are plain `prometheus_client` objects updated in process. Under gunicorn,
+`gunicorn.conf.py` points `PROMETHEUS_MULTIPROC_DIR` at a directory it empties
+on start. Each worker then writes its values to memory-mapped files there, and
+`/metrics` adds up every worker's files, including those of workers that have
+exited. Without that variable, as under `runserver`, the process's own registry
+is served.
+"""
+import os
+import time
+from contextlib import ExitStack
+
+from django.db import connections
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Time spent handling a request.', ['view', 'method', 'status'],
+)
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', 'Database queries run while handling a request.', ['view'], buckets=QUERY_BUCKETS,
+)
+SEAT_CHECK_SECONDS = Histogram(
+    'seat_check_duration_seconds', 'Time spent working out seat occupancy.', ['check'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1),
+)
+SEARCH_SECONDS = Histogram(
+    'search_stage_duration_seconds', 'Time spent in each stage of a trip search or journey plan.', ['search', 'stage'],
+)
+CACHE_LOOKUPS = Counter(
+    'cache_lookups_total', 'Lookups of cached data, by outcome.', ['cache', 'result'],
+)
+BOOKING_REJECTIONS = Counter(
+    'booking_rejections_total', 'Bookings, holds and seat claims refused for lack of seats or a conflict.', ['reason'],
+)
+
+
+def record_cache(name, hits, misses=0):
+    if hits:
+        CACHE_LOOKUPS.labels(name, 'hit').inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(name, 'miss').inc(misses)
+
+
+def render_metrics():
+    """Returns `(body, content type)` for the current values of every metric."""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """Records each request's latency and query count, labelled with the view's URL name."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = [0]
+
+        def count_query(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(count_query))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name or match._func_path) if match else 'unresolved'
+        REQUEST_SECONDS.labels(view, request.method, str(response.status_code)).observe(elapsed)
+        REQUEST_QUERIES.labels(view).observe(queries[0])
+        return response
@@ -1,9 +1,12 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.db.models import Sum
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.validators import MinValueValidator, MaxValueValidator
 from datetime import timedelta
 
+from .metrics import BOOKING_REJECTIONS, SEAT_CHECK_SECONDS
+
 # Create your models here.
 
 class Vendor(models.Model):
@@ -37,6 +40,9 @@ class Stop(models.Model):
     """
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True, help_text="e.g., 'Near the main post office'")
+    latitude = models.FloatField(null=True, blank=True, validators=[MinValueValidator(-90), MaxValueValidator(90)])
+    longitude = models.FloatField(null=True, blank=True, validators=[MinValueValidator(-180), MaxValueValidator(180)])
+    code = models.CharField(max_length=64, blank=True, db_index=True, help_text="External id used by feed imports.")
 
     def __str__(self):
         return self.name
@@ -48,10 +54,34 @@ class Route(models.Model):
     name = models.CharField(max_length=255, help_text="e.g., 'City Center to Airport'")
     stops = models.ManyToManyField(Stop, through='RouteStop', related_name='routes')
     description = models.TextField(blank=True)
+    code = models.CharField(max_length=64, blank=True, db_index=True, help_text="External id used by feed imports.")
 
     def __str__(self):
         return self.name
 
+    def get_stop_offsets(self):
+        """
+        Returns the route's stops in order, each with its cumulative travel minutes and
+        distance from the first stop. Used to derive ETAs and segment distances without
+        summing `RouteStop` rows per booking or per trip.
+        """
+        offsets = []
+        total_minutes = 0
+        total_distance = 0
+        route_stops = self.routestop_set.select_related('stop').order_by('order')
+        for rs in route_stops:
+            total_minutes += rs.minutes_from_previous_stop
+            total_distance += rs.distance_from_previous_stop
+            offsets.append({
+                'route_stop_id': rs.id,
+                'stop_id': rs.stop_id,
+                'stop_name': rs.stop.name,
+                'order': rs.order,
+                'minutes_from_start': total_minutes,
+                'distance_from_start': total_distance,
+            })
+        return offsets
+
 class RouteStop(models.Model):
     """
     A 'through' model to link Stops to Routes, defining the order of stops in a route.
@@ -111,46 +141,45 @@ class Travellor(models.Model):
     vehicle_capacity = models.PositiveIntegerField()
     cost_per_km = models.DecimalField(max_digits=6, decimal_places=2, help_text="Cost per kilometer for this trip.")
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='SCHEDULED')
+    assign_seats = models.BooleanField(default=False, help_text="Give every booking on this trip specific seat numbers.")
+    delay_minutes = models.PositiveIntegerField(default=0, help_text="How late the trip is running, from the driver's latest position.")
 
     def __str__(self):
         return f"Trip on {self.route.name} by {self.driver.username} at {self.departure_time.strftime('%Y-%m-%d %H:%M')}"
 
+    @SEAT_CHECK_SECONDS.labels('segment').time()
     def get_booked_seats_for_segment(self, start_stop_order, end_stop_order):
         """
         Calculates the maximum number of concurrent bookings for any part of a given trip segment.
         A segment is defined by the journey between a start and end stop.
         """
-        max_booked = 0
-        # Iterate through each leg of the journey within the requested segment
-        for i in range(start_stop_order, end_stop_order):
-            leg_start_order = i
-            leg_end_order = i + 1
-
-            # Find bookings that are active during this specific leg
-            concurrent_bookings = self.bookings.filter(
-                status='CONFIRMED',
-                start_stop__order__lte=leg_start_order,
-                end_stop__order__gte=leg_end_order
-            ).aggregate(total_seats=Sum('seats'))
-
-            current_leg_seats = concurrent_bookings['total_seats'] or 0
-            if current_leg_seats > max_booked:
-                max_booked = current_leg_seats
-        return max_booked
-
-    def get_schedule(self):
+        from .seats import LegLoads
+
+        return LegLoads.for_trip(self).max_load(start_stop_order, end_stop_order)
+
+    def get_route_stops(self):
+        """
+        The route's stops in order, with their `Stop`s. Uses `route.ordered_route_stops`
+        when a list view prefetched it for many trips at once.
+        """
+        if hasattr(self.route, 'ordered_route_stops'):
+            return self.route.ordered_route_stops
+        return list(self.route.routestop_set.select_related('stop').order_by('order'))
+
+    def get_schedule(self, route_stops=None):
         """
-        Calculates the estimated arrival time for each stop on the trip's route.
+        Calculates the estimated arrival time for each stop on the trip's route,
+        including the trip's current delay.
         Returns a list of dictionaries, each containing the stop and its ETA.
         """
         schedule = []
-        # Fetch related stop objects to avoid N+1 queries in the loop
-        route_stops = self.route.routestop_set.select_related('stop').all().order_by('order')
+        if route_stops is None:
+            route_stops = self.get_route_stops()
         total_travel_minutes = 0
 
         for rs in route_stops:
             total_travel_minutes += rs.minutes_from_previous_stop
-            eta = self.departure_time + timedelta(minutes=total_travel_minutes)
+            eta = self.departure_time + timedelta(minutes=total_travel_minutes + self.delay_minutes)
             schedule.append({
                 'route_stop_id': rs.id,
                 'stop_id': rs.stop.id,
@@ -161,6 +190,37 @@ class Travellor(models.Model):
         return schedule
 
 
+class TripPosition(models.Model):
+    """The latest position reported by a trip's driver; one row per trip, overwritten in batches."""
+    trip = models.OneToOneField(Travellor, on_delete=models.CASCADE, primary_key=True, related_name='position')
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    stop_order = models.PositiveIntegerField(null=True, blank=True, help_text="Order of the last stop reached, if known.")
+    recorded_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Trip {self.trip_id} at ({self.latitude}, {self.longitude})"
+
+
+class StopTime(models.Model):
+    """
+    A trip's scheduled departure from one of its route's stops, materialized from
+    the route's offsets so a stop's departure board is a single index range scan.
+    The route's last stop has no row; nothing departs from it.
+    """
+    trip = models.ForeignKey(Travellor, on_delete=models.CASCADE, related_name='stop_times')
+    stop = models.ForeignKey(Stop, on_delete=models.CASCADE, related_name='+')
+    route_stop = models.ForeignKey(RouteStop, on_delete=models.CASCADE, related_name='+')
+    route_stop_order = models.PositiveIntegerField()
+    eta = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['stop', 'eta'])]
+
+    def __str__(self):
+        return f"Trip {self.trip_id} at stop {self.stop_id} at {self.eta:%Y-%m-%d %H:%M}"
+
+
 class Booking(models.Model):
     """
     Represents a booking made by a customer for a specific trip (Travellor instance).
@@ -168,7 +228,7 @@ class Booking(models.Model):
     STATUS_CHOICES = [
         ('COMPLETED', 'Completed'),
         ('CONFIRMED', 'Confirmed'),
-        
+        ('CANCELLED', 'Cancelled'),
     ]
     trip = models.ForeignKey(Travellor, on_delete=models.CASCADE, related_name='bookings')
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='bookings')
@@ -177,10 +237,50 @@ class Booking(models.Model):
     seats = models.PositiveIntegerField(default=1)
     booking_time = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='CONFIRMED')
+    cancelled_at = models.DateTimeField(null=True, blank=True)
+    seat_numbers = models.JSONField(null=True, blank=True, help_text="Seats claimed on trips that assign seats, numbered from 1.")
+
+    # Snapshot of the segment taken at booking time, so history stays correct
+    # after the route is edited and can be served without joining the route's stops.
+    segment_distance = models.PositiveIntegerField(null=True, blank=True, help_text="Segment distance in kilometers at booking time.")
+    fare = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, help_text="Total fare at booking time.")
+    estimated_departure = models.DateTimeField(null=True, blank=True)
+    estimated_arrival = models.DateTimeField(null=True, blank=True)
+    start_stop_name = models.CharField(max_length=255, blank=True)
+    end_stop_name = models.CharField(max_length=255, blank=True)
+
+    notified_at = models.DateTimeField(null=True, blank=True, help_text="When the confirmation email was sent.")
 
     def __str__(self):
         return f"Booking by {self.customer.name} on trip {self.trip.id} for {self.seats} seat(s)"
 
+    @property
+    def has_snapshot(self):
+        return self.estimated_departure is not None
+
+    def capture_snapshot(self, offsets=None):
+        """
+        Fills the snapshot fields from the trip's current route.
+        `offsets` may be passed in (see `Route.get_stop_offsets`) to avoid a query per booking.
+        """
+        if offsets is None:
+            offsets = self.trip.route.get_stop_offsets()
+        by_route_stop = {item['route_stop_id']: item for item in offsets}
+        start = by_route_stop.get(self.start_stop_id)
+        end = by_route_stop.get(self.end_stop_id)
+        if start is None or end is None:
+            return False
+
+        from .fares import quote_fare
+
+        self.segment_distance = end['distance_from_start'] - start['distance_from_start']
+        self.fare = quote_fare(self.trip.cost_per_km, self.segment_distance, self.seats)
+        self.estimated_departure = self.trip.departure_time + timedelta(minutes=start['minutes_from_start'])
+        self.estimated_arrival = self.trip.departure_time + timedelta(minutes=end['minutes_from_start'])
+        self.start_stop_name = start['stop_name']
+        self.end_stop_name = end['stop_name']
+        return True
+
     def clean(self):
         """
         Custom validation for the booking model.
@@ -200,12 +300,89 @@ class Booking(models.Model):
             max_concurrent_seats = self.trip.get_booked_seats_for_segment(self.start_stop.order, self.end_stop.order)
             available_seats = self.trip.vehicle_capacity - max_concurrent_seats
             if self.seats > available_seats:
+                BOOKING_REJECTIONS.labels('no_seats').inc()
                 raise ValidationError(f"Not enough seats available. Only {available_seats} seat(s) left for this segment.")
 
+        # 4. Requested seat numbers must match the seat count
+        if self.seat_numbers is not None and len(set(self.seat_numbers)) != self.seats:
+            raise ValidationError("Give one distinct seat number per seat booked.")
+
     def save(self, *args, **kwargs):
         self.full_clean()
+        if self.pk is None and not self.has_snapshot:
+            self.capture_snapshot()
+        if self.pk is None and self.status == 'CONFIRMED' and self.trip.assign_seats:
+            from .seatmap import SeatMap
+
+            seat_map = SeatMap.for_trip(self.trip)
+            seat_map.claim(self)
+            seat_map.save()
         super().save(*args, **kwargs)
 
+class TripLeg(models.Model):
+    """
+    Seats taken on one leg of a trip that assigns seats, from the stop with
+    `start_order` to the next. `occupied` is a little-endian bitset; bit `n - 1`
+    is set while seat `n` is claimed by a confirmed booking.
+    """
+    trip = models.ForeignKey(Travellor, on_delete=models.CASCADE, related_name='legs')
+    start_order = models.PositiveIntegerField()
+    occupied = models.BinaryField(default=bytes)
+
+    class Meta:
+        unique_together = ('trip', 'start_order')
+
+    def __str__(self):
+        return f"Trip {self.trip_id} leg from stop {self.start_order}"
+
+
+class SeatHold(models.Model):
+    """
+    Seats on a trip segment reserved for a customer during checkout. A hold counts
+    against availability until it expires or is confirmed into a `Booking`;
+    expired holds are ignored on read and deleted by a periodic sweep.
+    """
+    trip = models.ForeignKey(Travellor, on_delete=models.CASCADE, related_name='holds')
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='seat_holds')
+    start_stop = models.ForeignKey(RouteStop, on_delete=models.CASCADE, related_name='+')
+    end_stop = models.ForeignKey(RouteStop, on_delete=models.CASCADE, related_name='+')
+    seats = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['trip', 'expires_at'])]
+
+    def __str__(self):
+        return f"Hold by {self.customer.name} on trip {self.trip_id} for {self.seats} seat(s)"
+
+
+class WaitlistEntry(models.Model):
+    """
+    A customer's request for a segment of a trip that was full when they asked.
+    Entries are promoted to bookings in arrival order as seats free up.
+    """
+    STATUS_CHOICES = [
+        ('WAITING', 'Waiting'),
+        ('PROMOTED', 'Promoted'),
+        ('WITHDRAWN', 'Withdrawn'),
+    ]
+    trip = models.ForeignKey(Travellor, on_delete=models.CASCADE, related_name='waitlist')
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='waitlist_entries')
+    start_stop = models.ForeignKey(RouteStop, on_delete=models.PROTECT, related_name='+')
+    end_stop = models.ForeignKey(RouteStop, on_delete=models.PROTECT, related_name='+')
+    seats = models.PositiveIntegerField(default=1)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='WAITING')
+    booking = models.OneToOneField(Booking, on_delete=models.SET_NULL, null=True, blank=True, related_name='waitlist_entry')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['trip', 'status', 'created_at'])]
+
+    def __str__(self):
+        return f"Waitlist entry by {self.customer.name} on trip {self.trip_id} for {self.seats} seat(s)"
+
+
 class Car(models.Model):
     name=models.CharField(max_length=100)
     license_plate=models.CharField(max_length=20)
@@ -234,8 +411,83 @@ class CabBooking(models.Model):
     driver_no=models.CharField(max_length=15,null=True,blank=True)
     driver_name=models.CharField(max_length=100,null=True,blank=True)
     car = models.ForeignKey(Car, on_delete=models.CASCADE, related_name='cab_bookings',null=True,blank=True)
+    notified_status = models.CharField(max_length=20, blank=True, help_text="Status the customer was last emailed about.")
 
     def __str__(self):
         return f"Cab booking by {self.customer.name} from {self.pickup_location} to {self.dropoff_location}"
 
 
+
+
+class TripStats(models.Model):
+    """
+    Materialized sales figures for one trip, maintained by `main.rollups`.
+    `revision` is bumped whenever the trip or its bookings change; the row is
+    stale until `refreshed_revision` catches up.
+    """
+    trip = models.OneToOneField(Travellor, on_delete=models.CASCADE, related_name='stats')
+    driver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    route = models.ForeignKey(Route, on_delete=models.CASCADE, related_name='+')
+    service_date = models.DateField()
+    trip_status = models.CharField(max_length=20, choices=Travellor.STATUS_CHOICES)
+    capacity = models.PositiveIntegerField(default=0)
+    bookings = models.PositiveIntegerField(default=0)
+    seats_sold = models.PositiveIntegerField(default=0)
+    seat_km_sold = models.PositiveIntegerField(default=0)
+    capacity_km = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    peak_occupancy = models.PositiveIntegerField(default=0, help_text="Most seats occupied on any leg.")
+    revision = models.PositiveIntegerField(default=0)
+    refreshed_revision = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['driver', 'service_date'])]
+
+    def __str__(self):
+        return f"Stats for trip {self.trip_id} on {self.service_date}"
+
+
+class RouteDailyStats(models.Model):
+    """A vendor's totals for one route and service date, summed from `TripStats`."""
+    driver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    route = models.ForeignKey(Route, on_delete=models.CASCADE, related_name='+')
+    service_date = models.DateField()
+    trips = models.PositiveIntegerField(default=0)
+    bookings = models.PositiveIntegerField(default=0)
+    seats_sold = models.PositiveIntegerField(default=0)
+    seat_km_sold = models.PositiveIntegerField(default=0)
+    capacity_km = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    peak_occupancy = models.PositiveIntegerField(default=0)
+    stale = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('driver', 'route', 'service_date')
+        indexes = [models.Index(fields=['driver', 'service_date'])]
+
+    def __str__(self):
+        return f"{self.route} on {self.service_date}"
+
+    @property
+    def load_factor(self):
+        return self.seat_km_sold / self.capacity_km if self.capacity_km else 0
+
+
+class IdempotencyKey(models.Model):
+    """
+    The stored outcome of a POST made with an `Idempotency-Key` header, so a
+    retried request gets the original response instead of being run again.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    endpoint = models.CharField(max_length=64)
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64, help_text="SHA-256 of the request body.")
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ('user', 'endpoint', 'key')
+
+    def __str__(self):
+        return f"{self.endpoint} {self.key}"
@@ -0,0 +1,94 @@
+"""
+Recurring commuter bookings: one request books the same segment on the same
+daily departure across a date range.
+
+Matching trips are locked, checked against per-leg loads built from a single
+bookings query, and booked with one `bulk_create` in a single transaction.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .journeys import day_bounds
+from .models import Booking, Travellor
+from .rollups import mark_trips_stale
+from .seatmap import SeatMap
+from .seats import LegLoads
+from .tasks import bump_customer_bookings, enqueue
+
+
+def book_recurring(customer, route, start_stop, end_stop, departure_time, start_date, end_date, seats, weekdays):
+    """
+    Books `seats` seats from `start_stop` to `end_stop` on every trip of `route`
+    leaving at `departure_time` (local wall-clock time) on the given weekdays
+    between two dates. On a date with several such trips the first one with room
+    is used. Returns `{'booked': [...], 'full': [...], 'no_trip': [...]}`.
+    """
+    weekdays = set(weekdays)
+    dates = [
+        day for day in (start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1))
+        if day.weekday() in weekdays
+    ]
+    result = {'booked': [], 'full': [], 'no_trip': []}
+    if not dates:
+        return result
+
+    with transaction.atomic():
+        candidates = (
+            Travellor.objects.select_for_update()
+            .filter(
+                route=route,
+                status='SCHEDULED',
+                departure_time__gte=max(day_bounds(dates[0])[0], timezone.now()),
+                departure_time__lt=day_bounds(dates[-1])[1],
+            )
+            .order_by('id')
+        )
+        trips_by_date = defaultdict(list)
+        for trip in candidates:
+            local = timezone.localtime(trip.departure_time)
+            if local.time().replace(second=0, microsecond=0) == departure_time:
+                trips_by_date[local.date()].append(trip)
+
+        loads = LegLoads.for_trips(trip for trips in trips_by_date.values() for trip in trips)
+        seat_maps = SeatMap.for_trips(
+            trip for trips in trips_by_date.values() for trip in trips if trip.assign_seats
+        )
+        offsets = route.get_stop_offsets()
+        bookings = []
+        for day in dates:
+            if not trips_by_date.get(day):
+                result['no_trip'].append(day)
+                continue
+            trip = next(
+                (trip for trip in trips_by_date[day] if loads[trip.pk].fits(start_stop.order, end_stop.order, seats)),
+                None,
+            )
+            if trip is None:
+                result['full'].append(day)
+                continue
+            loads[trip.pk].add(start_stop.order, end_stop.order, seats)
+            booking = Booking(trip=trip, customer=customer, start_stop=start_stop, end_stop=end_stop, seats=seats)
+            booking.capture_snapshot(offsets)
+            if trip.assign_seats:
+                seat_maps[trip.pk].claim(booking)
+            bookings.append(booking)
+
+        # bulk_create skips Booking.save() and the post_save signal, so claim
+        # seats above, then save the seat maps, flag and refresh the rollups and
+        # bump the customer's bookings version by hand.
+        Booking.objects.bulk_create(bookings)
+        for seat_map in seat_maps.values():
+            seat_map.save()
+        mark_trips_stale(trip_id__in=[booking.trip_id for booking in bookings])
+        for driver_id in {booking.trip.driver_id for booking in bookings}:
+            enqueue('refresh_driver_rollups', driver_id=driver_id)
+        bump_customer_bookings([customer.pk])
+
+    result['booked'] = [
+        {'date': timezone.localdate(booking.trip.departure_time), 'trip_id': booking.trip_id, 'booking_id': booking.pk}
+        for booking in bookings
+    ]
+    return result
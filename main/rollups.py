@@ -0,0 +1,334 @@
+"""
+Materialized occupancy and revenue rollups for vendor analytics.
+
+`TripStats` holds one row per trip and `RouteDailyStats` one row per vendor,
+route and service date. Signals bump a trip's `revision` whenever the trip or its
+bookings change; `refresh_rollups` recomputes only the stale trips, in bulk with
+pandas and NumPy, and then re-sums the route days they belong to. The same
+signals queue the `refresh_driver_rollups` task, so reports only read the
+rollup tables.
+"""
+from decimal import Decimal
+from functools import reduce
+from operator import or_
+
+import numpy as np
+import pandas as pd
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.utils import timezone
+
+from .fares import quote_fare
+from .models import Booking, RouteDailyStats, RouteStop, Travellor, TripStats
+
+BATCH_SIZE = 2000
+SOLD_STATUSES = ('CONFIRMED', 'COMPLETED')
+
+TRIP_STAT_FIELDS = [
+    'driver', 'route', 'service_date', 'trip_status', 'capacity', 'bookings',
+    'seats_sold', 'seat_km_sold', 'capacity_km', 'revenue', 'peak_occupancy',
+]
+ROUTE_STAT_FIELDS = [
+    'trips', 'bookings', 'seats_sold', 'seat_km_sold', 'capacity_km', 'revenue', 'peak_occupancy',
+]
+
+
+def mark_trips_stale(**filters):
+    """Flags the rollups of the matching trips for recomputation on the next refresh."""
+    TripStats.objects.filter(**filters).update(revision=F('revision') + 1)
+
+
+def mark_route_day_stale(driver_id, route_id, service_date):
+    RouteDailyStats.objects.filter(
+        driver_id=driver_id, route_id=route_id, service_date=service_date,
+    ).update(stale=True)
+
+
+def compute_trip_stats(trip_ids):
+    """
+    Returns a DataFrame with one row of rollup figures per trip. Peak occupancy
+    comes from difference arrays laid end to end for all trips, so a single
+    cumulative sum gives every trip's per-leg load.
+    """
+    trips = pd.DataFrame.from_records(
+        Travellor.objects.filter(id__in=trip_ids).order_by('id').values_list(
+            'id', 'driver_id', 'route_id', 'departure_time', 'vehicle_capacity', 'cost_per_km', 'status',
+        ),
+        columns=['trip_id', 'driver_id', 'route_id', 'departure_time', 'capacity', 'cost_per_km', 'trip_status'],
+    )
+    if trips.empty:
+        return trips
+
+    stops = pd.DataFrame.from_records(
+        RouteStop.objects.filter(route_id__in=trips['route_id'].unique().tolist())
+        .order_by('route_id', 'order')
+        .values_list('route_id', 'order', 'distance_from_previous_stop'),
+        columns=['route_id', 'order', 'distance'],
+    )
+    stops['index'] = stops.groupby('route_id').cumcount()
+    stops['cumulative'] = stops.groupby('route_id')['distance'].cumsum()
+    routes = stops.groupby('route_id')['cumulative'].agg(['size', 'first', 'last'])
+    routes['route_km'] = routes['last'] - routes['first']
+    trips = trips.join(routes[['size', 'route_km']].rename(columns={'size': 'stop_count'}), on='route_id')
+    trips[['stop_count', 'route_km']] = trips[['stop_count', 'route_km']].fillna(0).astype('int64')
+
+    bookings = pd.DataFrame.from_records(
+        Booking.objects.filter(trip_id__in=trip_ids, status__in=SOLD_STATUSES).values_list(
+            'trip_id', 'start_stop__order', 'end_stop__order', 'seats', 'segment_distance', 'fare',
+        ),
+        columns=['trip_id', 'start_order', 'end_order', 'seats', 'segment_distance', 'fare'],
+    )
+    position = {trip_id: i for i, trip_id in enumerate(trips['trip_id'])}
+    bookings['position'] = bookings['trip_id'].map(position)
+    bookings = bookings.merge(trips[['trip_id', 'route_id', 'cost_per_km']], on='trip_id')
+    located = stops[['route_id', 'order', 'index', 'cumulative']]
+    bookings = bookings.merge(
+        located.rename(columns={'order': 'start_order', 'index': 'start_index', 'cumulative': 'start_km'}),
+        on=['route_id', 'start_order'],
+    ).merge(
+        located.rename(columns={'order': 'end_order', 'index': 'end_index', 'cumulative': 'end_km'}),
+        on=['route_id', 'end_order'],
+    )
+
+    # Snapshotted distances and fares win; older bookings fall back to the current route.
+    distance = bookings['segment_distance'].astype('float64').fillna(bookings['end_km'] - bookings['start_km'])
+    bookings['seat_km'] = (distance * bookings['seats']).astype('int64')
+    bookings['revenue_paise'] = [
+        int((fare if fare is not None else quote_fare(cost_per_km, int(km), seats)) * 100)
+        for fare, cost_per_km, km, seats in zip(bookings['fare'], bookings['cost_per_km'], distance, bookings['seats'])
+    ]
+
+    starts = np.concatenate([[0], np.cumsum(trips['stop_count'].to_numpy())])
+    seats = bookings['seats'].to_numpy(dtype='int64')
+    base = starts[bookings['position'].to_numpy(dtype='int64')]
+    delta = np.zeros(starts[-1], dtype='int64')
+    np.add.at(delta, base + bookings['start_index'].to_numpy(dtype='int64'), seats)
+    np.add.at(delta, base + bookings['end_index'].to_numpy(dtype='int64'), -seats)
+    load = np.cumsum(delta)
+    peak = np.zeros(len(trips), dtype='int64')
+    has_stops = trips['stop_count'].to_numpy() > 0
+    if has_stops.any():
+        peak[has_stops] = np.maximum.reduceat(load, starts[:-1][has_stops])
+    trips['peak_occupancy'] = peak
+
+    sold = bookings.groupby('trip_id').agg(
+        bookings=('seats', 'size'),
+        seats_sold=('seats', 'sum'),
+        seat_km_sold=('seat_km', 'sum'),
+        revenue_paise=('revenue_paise', 'sum'),
+    )
+    trips = trips.join(sold, on='trip_id')
+    trips[sold.columns] = trips[sold.columns].fillna(0).astype('int64')
+    trips['capacity_km'] = trips['capacity'] * trips['route_km']
+    trips['service_date'] = (
+        pd.to_datetime(trips['departure_time'], utc=True)
+        .dt.tz_convert(timezone.get_current_timezone_name())
+        .dt.date
+    )
+    return trips
+
+
+def _refresh_trips(trip_ids):
+    """Rewrites the rollups of `trip_ids`; returns the route days that need re-summing."""
+    previous = {
+        trip_id: (revision, (driver_id, route_id, service_date))
+        for trip_id, revision, driver_id, route_id, service_date in TripStats.objects.filter(
+            trip_id__in=trip_ids,
+        ).values_list('trip_id', 'revision', 'driver_id', 'route_id', 'service_date')
+    }
+    route_days = {route_day for _, route_day in previous.values()}
+
+    rows = []
+    for trip in compute_trip_stats(trip_ids).itertuples(index=False):
+        revision = previous.get(trip.trip_id, (0, None))[0]
+        rows.append(TripStats(
+            trip_id=trip.trip_id,
+            driver_id=trip.driver_id,
+            route_id=trip.route_id,
+            service_date=trip.service_date,
+            trip_status=trip.trip_status,
+            capacity=trip.capacity,
+            bookings=trip.bookings,
+            seats_sold=trip.seats_sold,
+            seat_km_sold=trip.seat_km_sold,
+            capacity_km=trip.capacity_km,
+            revenue=Decimal(int(trip.revenue_paise)).scaleb(-2),
+            peak_occupancy=trip.peak_occupancy,
+            revision=revision,
+            refreshed_revision=revision,
+        ))
+        route_days.add((trip.driver_id, trip.route_id, trip.service_date))
+
+    # Bookings made while this batch was computed bumped `revision` past the value
+    # read above, so those trips stay stale instead of being marked fresh.
+    TripStats.objects.bulk_create(
+        rows, update_conflicts=True, unique_fields=['trip'],
+        update_fields=TRIP_STAT_FIELDS + ['refreshed_revision'],
+    )
+    return route_days
+
+
+def _refresh_route_days(route_days):
+    totals = (
+        TripStats.objects.filter(
+            route_id__in={route_id for _, route_id, _ in route_days},
+            service_date__in={service_date for _, _, service_date in route_days},
+        )
+        .exclude(trip_status='CANCELLED')
+        .values('driver_id', 'route_id', 'service_date')
+        .annotate(
+            trips=Count('id'),
+            total_bookings=Sum('bookings'),
+            total_seats_sold=Sum('seats_sold'),
+            total_seat_km_sold=Sum('seat_km_sold'),
+            total_capacity_km=Sum('capacity_km'),
+            total_revenue=Sum('revenue'),
+            max_peak_occupancy=Max('peak_occupancy'),
+        )
+    )
+    rows = []
+    for total in totals:
+        route_day = (total['driver_id'], total['route_id'], total['service_date'])
+        if route_day not in route_days:
+            continue
+        rows.append(RouteDailyStats(
+            driver_id=total['driver_id'],
+            route_id=total['route_id'],
+            service_date=total['service_date'],
+            trips=total['trips'],
+            bookings=total['total_bookings'],
+            seats_sold=total['total_seats_sold'],
+            seat_km_sold=total['total_seat_km_sold'],
+            capacity_km=total['total_capacity_km'],
+            revenue=total['total_revenue'],
+            peak_occupancy=total['max_peak_occupancy'],
+            stale=False,
+        ))
+
+    emptied = route_days - {(row.driver_id, row.route_id, row.service_date) for row in rows}
+    with transaction.atomic():
+        RouteDailyStats.objects.bulk_create(
+            rows, update_conflicts=True, unique_fields=['driver', 'route', 'service_date'],
+            update_fields=ROUTE_STAT_FIELDS + ['stale'],
+        )
+        if emptied:
+            RouteDailyStats.objects.filter(reduce(or_, (
+                Q(driver_id=driver_id, route_id=route_id, service_date=service_date)
+                for driver_id, route_id, service_date in emptied
+            ))).delete()
+
+
+def refresh_rollups(driver_id=None, batch_size=BATCH_SIZE):
+    """
+    Brings the rollups up to date, optionally for a single vendor. Only trips that
+    have no rollup yet or changed since their last refresh are recomputed.
+    Returns the number of trips refreshed.
+    """
+    trips = Travellor.objects.filter(Q(stats__isnull=True) | Q(stats__revision__gt=F('stats__refreshed_revision')))
+    stale_days = RouteDailyStats.objects.filter(stale=True)
+    if driver_id is not None:
+        trips = trips.filter(driver_id=driver_id)
+        stale_days = stale_days.filter(driver_id=driver_id)
+
+    trip_ids = list(trips.order_by('id').values_list('id', flat=True))
+    route_days = set(stale_days.values_list('driver_id', 'route_id', 'service_date'))
+    for start in range(0, len(trip_ids), batch_size):
+        route_days |= _refresh_trips(trip_ids[start:start + batch_size])
+    if route_days:
+        _refresh_route_days(route_days)
+    return len(trip_ids)
+
+
+def route_occupancy(route_id, trips):
+    """
+    Seats occupied on every leg of every trip in `trips` (Travellor rows on one
+    route), as a trips x legs matrix. Confirmed bookings are read in one query and
+    added to a 2-D difference array (+seats at the boarding stop, -seats at the
+    alighting stop) whose cumulative sum along each row is the per-leg load.
+    """
+    stops = list(RouteStop.objects.filter(route_id=route_id).order_by('order').values_list('order', 'stop__name'))
+    trip_rows = list(trips.order_by('departure_time', 'id').values_list('id', 'departure_time', 'vehicle_capacity'))
+    bookings = np.array(
+        list(Booking.objects.filter(trip__in=trips.values('id'), status='CONFIRMED').values_list(
+            'trip_id', 'start_stop__order', 'end_stop__order', 'seats',
+        )),
+        dtype='int64',
+    ).reshape(-1, 4)
+
+    orders = np.array([order for order, _ in stops], dtype='int64')
+    trip_ids = pd.Index([trip_id for trip_id, _, _ in trip_rows])
+    capacities = np.array([capacity for _, _, capacity in trip_rows], dtype='int64')
+    delta = np.zeros((len(trip_rows), len(orders)), dtype='int64')
+    if len(bookings) and len(orders):
+        rows = trip_ids.get_indexer(bookings[:, 0])
+        start = np.minimum(np.searchsorted(orders, bookings[:, 1]), len(orders) - 1)
+        end = np.minimum(np.searchsorted(orders, bookings[:, 2]), len(orders) - 1)
+        # Bookings whose stops are no longer on the route cannot be placed on a leg.
+        valid = (rows >= 0) & (orders[start] == bookings[:, 1]) & (orders[end] == bookings[:, 2])
+        np.add.at(delta, (rows[valid], start[valid]), bookings[valid, 3])
+        np.add.at(delta, (rows[valid], end[valid]), -bookings[valid, 3])
+    matrix = np.cumsum(delta, axis=1)[:, :-1]
+
+    legs = matrix.shape[1]
+    has_data = len(trip_rows) > 0 and legs > 0
+    peak_by_leg = matrix.max(axis=0) if has_data else np.zeros(legs, dtype='int64')
+    peak_by_trip = matrix.max(axis=1) if has_data else np.zeros(len(trip_rows), dtype='int64')
+    seats_by_leg = matrix.sum(axis=0)
+    total_capacity = capacities.sum()
+    return {
+        'legs': [[stops[i][1], stops[i + 1][1]] for i in range(legs)],
+        'trip_ids': trip_ids.tolist(),
+        'departures': [timezone.localtime(departure_time) for _, departure_time, _ in trip_rows],
+        'capacities': capacities.tolist(),
+        'matrix': matrix.tolist(),
+        'summary': {
+            'peak_by_leg': peak_by_leg.tolist(),
+            'mean_by_leg': np.round(matrix.mean(axis=0), 2).tolist() if len(trip_rows) else [0] * legs,
+            'load_factor_by_leg': np.round(seats_by_leg / total_capacity, 4).tolist() if total_capacity else [0] * legs,
+            'peak_by_trip': peak_by_trip.tolist(),
+            'busiest_leg': int(seats_by_leg.argmax()) if has_data else None,
+            'full_trips': int((peak_by_trip >= capacities).sum()) if has_data else 0,
+        },
+    }
+
+
+def _summary():
+    return {'trips': 0, 'bookings': 0, 'seats_sold': 0, 'seat_km_sold': 0, 'capacity_km': 0, 'revenue': 0, 'peak_occupancy': 0}
+
+
+def _add(summary, row):
+    for field in ROUTE_STAT_FIELDS:
+        if field == 'peak_occupancy':
+            summary[field] = max(summary[field], row[field])
+        else:
+            summary[field] += row[field]
+
+
+def _finish(summary):
+    summary['revenue'] = str(summary['revenue'])
+    summary['load_factor'] = round(summary['seat_km_sold'] / summary['capacity_km'], 4) if summary['capacity_km'] else 0
+    return summary
+
+
+def vendor_report(driver_id, start_date, end_date):
+    """Totals, per-day and per-route figures for a vendor between two dates (inclusive), read from the rollups."""
+    rows = RouteDailyStats.objects.filter(
+        driver_id=driver_id, service_date__gte=start_date, service_date__lte=end_date,
+    ).values('route_id', 'route__name', 'service_date', *ROUTE_STAT_FIELDS)
+
+    totals = _summary()
+    days = {}
+    routes = {}
+    for row in rows:
+        _add(totals, row)
+        _add(days.setdefault(row['service_date'], {'date': row['service_date'], **_summary()}), row)
+        route = routes.setdefault(row['route_id'], {'route_id': row['route_id'], 'route_name': row['route__name'], **_summary()})
+        _add(route, row)
+
+    return {
+        'from': start_date,
+        'to': end_date,
+        'totals': _finish(totals),
+        'days': [_finish(days[day]) for day in sorted(days)],
+        'routes': sorted((_finish(route) for route in routes.values()), key=lambda route: route['route_name']),
+    }
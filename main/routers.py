@@ -0,0 +1,107 @@
+"""
+Read-replica routing.
+
+Views that only list or search data opt in with `ReplicaReadMixin` (API views)
+or `@reads_from_replica` (template views); their reads go to a random alias in
+`settings.DATABASE_REPLICAS`. Everything else, including any read made inside
+`transaction.atomic`, such as the seat checks taken under the trip lock, uses
+the primary. A user who has just written something is pinned to the primary for
+`REPLICA_PIN_SECONDS`, so they never read a replica that has not caught up with
+their own write.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+UNSAFE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+_use_replica = ContextVar('use_replica', default=False)
+
+
+def _pin_key(user_id):
+    return f"replica-pin:{user_id}"
+
+
+def pin_to_primary(user):
+    cache.set(_pin_key(user.pk), True, getattr(settings, 'REPLICA_PIN_SECONDS', 5))
+
+
+def is_pinned(user):
+    return bool(user and user.is_authenticated and cache.get(_pin_key(user.pk)))
+
+
+def reading_from_replica():
+    """Whether reads in the current context are routed to a replica."""
+    return _use_replica.get()
+
+
+def _start_replica_reads(user):
+    return _use_replica.set(bool(getattr(settings, 'DATABASE_REPLICAS', ())) and not is_pinned(user))
+
+
+@contextmanager
+def replica_reads(user):
+    """Sends this block's reads to a replica unless `user` is pinned to the primary."""
+    token = _start_replica_reads(user)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def reads_from_replica(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with replica_reads(request.user):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaReadMixin:
+    """APIView mixin; the user is only known after authentication, so routing starts in `initial`."""
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self._replica_token = _start_replica_reads(request.user)
+
+    def dispatch(self, request, *args, **kwargs):
+        self._replica_token = None
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            if self._replica_token is not None:
+                _use_replica.reset(self._replica_token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and not connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return random.choice(settings.DATABASE_REPLICAS)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        return True
+
+
+class ReplicaPinMiddleware:
+    """Pins users to the primary for a short while after any successful write request."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        # DRF copies the authenticated user back onto the Django request.
+        user = getattr(request, 'user', None)
+        if request.method in UNSAFE_METHODS and response.status_code < 400 and user and user.is_authenticated:
+            pin_to_primary(user)
+        return response
@@ -0,0 +1,169 @@
+"""
+Seat-level assignment for trips with `assign_seats` set.
+
+Each leg of such a trip keeps a bitset of its occupied seats in a `TripLeg` row.
+The seats free over a segment are those free on every leg it crosses, found by
+OR-ing the legs' bitsets and inverting, so claiming or releasing seats costs
+O(legs x capacity / 64) word operations. All changes must be made with the trip
+row locked (see `waitlist.lock_trip`).
+"""
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError
+
+from .metrics import BOOKING_REJECTIONS
+from .models import Booking, RouteStop, TripLeg
+from .tasks import bump_customer_bookings
+
+
+def _to_bytes(bits):
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+
+def _seat_numbers(bits):
+    seats = []
+    while bits:
+        low = bits & -bits
+        seats.append(low.bit_length())
+        bits ^= low
+    return seats
+
+
+def _bits(seat_numbers):
+    bits = 0
+    for seat in seat_numbers:
+        bits |= 1 << (seat - 1)
+    return bits
+
+
+class SeatMap:
+    """Occupied-seat bitsets of one trip, indexed by the leg's start stop order."""
+
+    def __init__(self, trip, orders, legs):
+        self.trip = trip
+        self.orders = sorted(orders)
+        self.legs = legs
+        self.occupied = [int.from_bytes(legs[order].occupied, 'little') for order in self.orders[:-1]]
+        self.changed = set()
+
+    @classmethod
+    def for_trip(cls, trip):
+        return cls.for_trips([trip])[trip.pk]
+
+    @classmethod
+    def for_trips(cls, trips):
+        """Returns `{trip_id: SeatMap}` with one stops query and one legs query, rebuilding stale maps."""
+        trips = list(trips)
+        orders = defaultdict(list)
+        for route_id, order in RouteStop.objects.filter(
+            route_id__in={trip.route_id for trip in trips},
+        ).values_list('route_id', 'order'):
+            orders[route_id].append(order)
+        legs = defaultdict(dict)
+        for leg in TripLeg.objects.filter(trip_id__in=[trip.pk for trip in trips]):
+            legs[leg.trip_id][leg.start_order] = leg
+
+        seat_maps = {}
+        for trip in trips:
+            route_orders = sorted(orders[trip.route_id])
+            if set(legs[trip.pk]) != set(route_orders[:-1]):
+                seat_maps[trip.pk] = cls._rebuild(trip, route_orders)
+            else:
+                seat_maps[trip.pk] = cls(trip, route_orders, legs[trip.pk])
+        return seat_maps
+
+    @classmethod
+    def _rebuild(cls, trip, route_orders):
+        """
+        Recreates a trip's legs from its confirmed bookings, for trips that just
+        started assigning seats or whose route's stops changed. Bookings made
+        before seats were assigned get the lowest seats free on their segment.
+        """
+        TripLeg.objects.filter(trip=trip).delete()
+        seat_map = cls(trip, route_orders, {
+            order: TripLeg(trip=trip, start_order=order) for order in route_orders[:-1]
+        })
+
+        bookings = Booking.objects.filter(trip=trip, status='CONFIRMED').select_related('start_stop', 'end_stop')
+        unassigned = []
+        for booking in sorted(bookings, key=lambda booking: (not booking.seat_numbers, booking.booking_time, booking.pk)):
+            start_order, end_order = booking.start_stop.order, booking.end_stop.order
+            if not (booking.seat_numbers and seat_map.is_free(start_order, end_order, booking.seat_numbers)):
+                free = seat_map.free_seats(start_order, end_order)
+                booking.seat_numbers = free[:booking.seats] if len(free) >= booking.seats else None
+                unassigned.append(booking)
+            if booking.seat_numbers:
+                seat_map.take(start_order, end_order, booking.seat_numbers)
+        Booking.objects.bulk_update(unassigned, ['seat_numbers'])
+        bump_customer_bookings(booking.customer_id for booking in unassigned)
+
+        for i, order in enumerate(seat_map.orders[:-1]):
+            seat_map.legs[order].occupied = _to_bytes(seat_map.occupied[i])
+        TripLeg.objects.bulk_create(seat_map.legs.values())
+        seat_map.changed.clear()
+        return seat_map
+
+    def _legs(self, start_order, end_order):
+        return range(bisect_left(self.orders, start_order), bisect_left(self.orders, end_order))
+
+    def _free_bits(self, start_order, end_order):
+        occupied = 0
+        for i in self._legs(start_order, end_order):
+            occupied |= self.occupied[i]
+        return ((1 << self.trip.vehicle_capacity) - 1) & ~occupied
+
+    def free_seats(self, start_order, end_order):
+        return _seat_numbers(self._free_bits(start_order, end_order))
+
+    def occupied_seats(self):
+        """`[(start_order, end_order, [seat numbers])]` for every leg."""
+        return [
+            (self.orders[i], self.orders[i + 1], _seat_numbers(bits))
+            for i, bits in enumerate(self.occupied)
+        ]
+
+    def is_free(self, start_order, end_order, seat_numbers):
+        bits = _bits(seat_numbers)
+        return bits & self._free_bits(start_order, end_order) == bits
+
+    def take(self, start_order, end_order, seat_numbers):
+        bits = _bits(seat_numbers)
+        for i in self._legs(start_order, end_order):
+            self.occupied[i] |= bits
+            self.changed.add(i)
+
+    def claim(self, booking):
+        """
+        Claims `booking.seat_numbers`, or the lowest free seats if none were
+        requested, on every leg of the booking's segment.
+        """
+        start_order, end_order = booking.start_stop.order, booking.end_stop.order
+        if booking.seat_numbers:
+            if max(booking.seat_numbers) > self.trip.vehicle_capacity or min(booking.seat_numbers) < 1:
+                raise ValidationError(f"Seat numbers must be between 1 and {self.trip.vehicle_capacity}.")
+            if not self.is_free(start_order, end_order, booking.seat_numbers):
+                BOOKING_REJECTIONS.labels('seat_taken').inc()
+                raise ValidationError("Some of the requested seats are already taken for this segment.")
+        else:
+            free = self.free_seats(start_order, end_order)
+            if len(free) < booking.seats:
+                BOOKING_REJECTIONS.labels('no_seats').inc()
+                raise ValidationError(f"Not enough seats available. Only {len(free)} seat(s) left for this segment.")
+            booking.seat_numbers = free[:booking.seats]
+        self.take(start_order, end_order, booking.seat_numbers)
+
+    def release(self, booking):
+        bits = _bits(booking.seat_numbers or [])
+        for i in self._legs(booking.start_stop.order, booking.end_stop.order):
+            self.occupied[i] &= ~bits
+            self.changed.add(i)
+
+    def save(self):
+        legs = []
+        for i in self.changed:
+            leg = self.legs[self.orders[i]]
+            leg.occupied = _to_bytes(self.occupied[i])
+            legs.append(leg)
+        TripLeg.objects.bulk_update(legs, ['occupied'])
+        self.changed.clear()
@@ -0,0 +1,86 @@
+"""
+Per-leg seat occupancy of a single trip.
+
+`LegLoads` is built from one query over the trip's confirmed bookings and
+unexpired seat holds with a difference array, then answers "how full is the
+fullest leg of this segment" and "does this request fit" without further
+queries, so a waitlist can be scanned against it and updated as entries are
+promoted.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import accumulate
+
+from django.utils import timezone
+
+from .metrics import SEAT_CHECK_SECONDS
+from .models import Booking, RouteStop, SeatHold
+
+
+def occupied_segments(**filters):
+    """
+    `(trip_id, start_order, end_order, seats)` for confirmed bookings and live
+    holds matching `filters`, fetched together in one query.
+    """
+    fields = ('trip_id', 'start_stop__order', 'end_stop__order', 'seats')
+    bookings = Booking.objects.filter(status='CONFIRMED', **filters).values_list(*fields)
+    holds = SeatHold.objects.filter(expires_at__gt=timezone.now(), **filters).values_list(*fields)
+    return bookings.union(holds, all=True)
+
+
+class LegLoads:
+    """Seats occupied on each leg of a trip; leg `i` runs from `orders[i]` to `orders[i + 1]`."""
+
+    def __init__(self, capacity, orders, bookings):
+        self.capacity = capacity
+        self.orders = sorted(orders)
+        index = {order: i for i, order in enumerate(self.orders)}
+        delta = [0] * (len(self.orders) + 1)
+        for start_order, end_order, seats in bookings:
+            if start_order in index and end_order in index:
+                delta[index[start_order]] += seats
+                delta[index[end_order]] -= seats
+        self.loads = list(accumulate(delta))[:len(self.orders) - 1]
+
+    @classmethod
+    def for_trip(cls, trip):
+        orders = RouteStop.objects.filter(route_id=trip.route_id).values_list('order', flat=True)
+        bookings = [row[1:] for row in occupied_segments(trip_id=trip.pk)]
+        return cls(trip.vehicle_capacity, orders, bookings)
+
+    @classmethod
+    @SEAT_CHECK_SECONDS.labels('leg_loads').time()
+    def for_trips(cls, trips):
+        """Returns `{trip_id: LegLoads}` for many trips with one stops query and one bookings query."""
+        trips = list(trips)
+        orders = defaultdict(list)
+        for route_id, order in RouteStop.objects.filter(
+            route_id__in={trip.route_id for trip in trips},
+        ).values_list('route_id', 'order'):
+            orders[route_id].append(order)
+        bookings = defaultdict(list)
+        for trip_id, *row in occupied_segments(trip_id__in=[trip.pk for trip in trips]):
+            bookings[trip_id].append(row)
+        return {
+            trip.pk: cls(trip.vehicle_capacity, orders[trip.route_id], bookings[trip.pk])
+            for trip in trips
+        }
+
+    def _legs(self, start_order, end_order):
+        return bisect_left(self.orders, start_order), bisect_left(self.orders, end_order)
+
+    def max_load(self, start_order, end_order):
+        """Most seats occupied on any leg between two stop orders."""
+        first, last = self._legs(start_order, end_order)
+        return max(self.loads[first:last], default=0)
+
+    def available(self, start_order, end_order):
+        return self.capacity - self.max_load(start_order, end_order)
+
+    def fits(self, start_order, end_order, seats):
+        return seats <= self.available(start_order, end_order)
+
+    def add(self, start_order, end_order, seats):
+        first, last = self._legs(start_order, end_order)
+        for i in range(first, last):
+            self.loads[i] += seats
@@ -1,31 +1,61 @@
-from datetime import timezone,datetime
+from copy import copy
+from datetime import datetime, timedelta
+from django.utils import timezone
 from rest_framework import serializers
-from .models import Booking, Travellor, Stop, RouteStop, Customer, Car, CabBooking, Route, Vendor
+from .models import Booking, Travellor, Stop, RouteStop, Customer, Car, CabBooking, Route, Vendor, WaitlistEntry, SeatHold
 from django.contrib.auth.models import User
 from django.db.models import Sum
+from .fares import get_route_fares, quote_fare
 
 
 class BookingSerializer(serializers.ModelSerializer):
     start_stop = serializers.PrimaryKeyRelatedField(queryset=RouteStop.objects.all())
     end_stop = serializers.PrimaryKeyRelatedField(queryset=RouteStop.objects.all())
+    seat_numbers = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, allow_null=True)
 
     class Meta:
         model = Booking
-        fields = ['id', 'trip', 'customer', 'start_stop', 'end_stop', 'seats', 'status', 'booking_time']
+        fields = ['id', 'trip', 'customer', 'start_stop', 'end_stop', 'seats', 'seat_numbers', 'status', 'booking_time']
         read_only_fields = ('id', 'customer', 'status', 'booking_time')
 
     def validate(self, data):
         """
-        Check that the start stop is before the end stop.
+        Check that the start stop is before the end stop, and that requested
+        seat numbers are on a trip that assigns seats, one per seat booked.
         """
-        if data['start_stop'].order >= data['end_stop'].order:
-            raise serializers.ValidationError("End stop must be after start stop.")
-        if data['trip'].departure_time < timezone.now():
-            raise serializers.ValidationError("Cannot book a trip that has already departed.")
-        if data['start_stop'].route != data['trip'].route or data['end_stop'].route != data['trip'].route:
-            raise serializers.ValidationError("Stops must be on the trip's route.")
+        seat_numbers = data.get('seat_numbers')
+        if seat_numbers:
+            if not data['trip'].assign_seats:
+                raise serializers.ValidationError("This trip does not assign seat numbers.")
+            if len(set(seat_numbers)) != data.get('seats', 1):
+                raise serializers.ValidationError("Give one distinct seat number per seat booked.")
+        return validate_segment(data)
 
-        return data
+
+def validate_segment(data):
+    """Shared checks for requests that reserve a segment of a trip (bookings and waitlist entries)."""
+    if data['start_stop'].order >= data['end_stop'].order:
+        raise serializers.ValidationError("End stop must be after start stop.")
+    if data['trip'].departure_time < timezone.now():
+        raise serializers.ValidationError("Cannot book a trip that has already departed.")
+    if data['start_stop'].route != data['trip'].route or data['end_stop'].route != data['trip'].route:
+        raise serializers.ValidationError("Stops must be on the trip's route.")
+
+    return data
+
+
+class WaitlistEntrySerializer(serializers.ModelSerializer):
+    start_stop = serializers.PrimaryKeyRelatedField(queryset=RouteStop.objects.all())
+    end_stop = serializers.PrimaryKeyRelatedField(queryset=RouteStop.objects.all())
+    seats = serializers.IntegerField(min_value=1)
+
+    class Meta:
+        model = WaitlistEntry
+        fields = ['id', 'trip', 'start_stop', 'end_stop', 'seats', 'status', 'booking', 'created_at']
+        read_only_fields = ('id', 'status', 'booking', 'created_at')
+
+    def validate(self, data):
+        return validate_segment(data)
 
 
 class CustomerSerializer(serializers.ModelSerializer):
@@ -37,7 +67,7 @@ class CustomerSerializer(serializers.ModelSerializer):
 class StopSerializer(serializers.ModelSerializer):
     class Meta:
         model = Stop
-        fields = ['id', 'name', 'description']
+        fields = ['id', 'name', 'description', 'latitude', 'longitude']
 
 
 class RouteStopSerializer(serializers.ModelSerializer):
@@ -49,7 +79,65 @@ class RouteStopSerializer(serializers.ModelSerializer):
         fields = ['id', 'stop', 'order', 'minutes_from_previous_stop', 'distance_from_previous_stop', 'estimated_arrival_time']
 
 
-class TravellorSerializer(serializers.ModelSerializer):
+def _paths(value):
+    return {path.strip() for path in value.split(',') if path.strip()} if value is not None else None
+
+
+def sparse_fieldset_context(query_params):
+    """
+    Serializer context for the `fields` and `expand` query parameters, each a
+    comma-separated list of field paths such as `trip.departure_time`.
+    """
+    return {'fields': _paths(query_params.get('fields')), 'expand': _paths(query_params.get('expand'))}
+
+
+class SparseFieldsetMixin:
+    """
+    Trims a serializer's fields to those named by `fields` in its context (all of
+    them if none are named at this level) and, when `expand` is given, collapses
+    each of its `expandable_fields` not named there: a nested object to its
+    primary key, anything else out of the output. Fields are removed before
+    serialization, so dropped values are never computed.
+    """
+    expandable_fields = ()
+
+    def _path(self):
+        names = []
+        node = self
+        while node is not None:
+            if node.field_name:
+                names.append(node.field_name)
+            node = node.parent
+        return '.'.join(reversed(names))
+
+    def get_fields(self):
+        fields = super().get_fields()
+        requested, expand = self.context.get('fields'), self.context.get('expand')
+        path = self._path()
+        prefix = f"{path}." if path else ''
+
+        if expand is not None:
+            # Fields asked for by name, and the parents of expanded fields, count as expanded.
+            expanded = set()
+            for name in expand | (requested or set()):
+                parts = name.split('.')
+                expanded.update('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+            for name in self.expandable_fields:
+                if name in fields and prefix + name not in expanded:
+                    field = fields.pop(name)
+                    if isinstance(field, serializers.BaseSerializer):
+                        source = {'source': field.source} if field.source not in (None, name) else {}
+                        fields[name] = serializers.PrimaryKeyRelatedField(read_only=True, **source)
+
+        if requested:
+            names = {name[len(prefix):].split('.')[0] for name in requested if name.startswith(prefix)}
+            if names:
+                fields = {name: field for name, field in fields.items() if name in names}
+        return fields
+
+
+class TravellorSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    expandable_fields = ('route_stops',)
     route_stops = serializers.SerializerMethodField()
     driver_name = serializers.CharField(source='driver.username', read_only=True)
     route_name = serializers.CharField(source='route.name', read_only=True)
@@ -57,51 +145,37 @@ class TravellorSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Travellor
-        fields = ['id', 'driver_name', 'route_name', 'departure_time', 'vehicle_capacity', 'status', 'route_stops', 'cost_per_km', 'price']
+        fields = ['id', 'driver_name', 'route_name', 'departure_time', 'delay_minutes', 'vehicle_capacity', 'status', 'route_stops', 'cost_per_km', 'price']
 
     def get_route_stops(self, obj):
-        schedule = obj.get_schedule()
-        route_stop_ids = [item['route_stop_id'] for item in schedule]
-        route_stops = RouteStop.objects.filter(id__in=route_stop_ids).order_by('order')
-        
-        for rs in route_stops:
-            for item in schedule:
-                if rs.id == item['route_stop_id']:
-                    rs.estimated_arrival_time = item['estimated_arrival_time']
-                    break
-        
+        # Prefetched route stops are shared by every trip on the route, so each
+        # trip's ETAs go on copies.
+        route_stops = [copy(rs) for rs in obj.get_route_stops()]
+        for rs, item in zip(route_stops, obj.get_schedule(route_stops)):
+            rs.estimated_arrival_time = item['estimated_arrival_time']
         return RouteStopSerializer(route_stops, many=True).data
 
     def get_price(self, obj):
-        # start_stop_id = self.context.get('start_stop_id')
-        # end_stop_id = self.context.get('end_stop_id')
-
-        # if not start_stop_id or not end_stop_id:
-        #     return None
-
-        # try:
-        #     start_stop = RouteStop.objects.get(route=obj.route, stop_id=start_stop_id)
-        #     end_stop = RouteStop.objects.get(route=obj.route, stop_id=end_stop_id)
-        # except RouteStop.DoesNotExist:
-        #     return None
+        start_stop_id = self.context.get('start_stop_id')
+        end_stop_id = self.context.get('end_stop_id')
 
-        # if start_stop.order >= end_stop.order:
-        #     return None
+        if not start_stop_id or not end_stop_id:
+            return int(obj.cost_per_km)
 
-        # total_distance = RouteStop.objects.filter(
-        #     route=obj.route,
-        #     order__gt=start_stop.order,
-        #     order__lte=end_stop.order
-        # ).aggregate(total=Sum('distance_from_previous_stop'))['total'] or 0
-
-        return int(obj.cost_per_km)
+        distance = get_route_fares(obj.route_id).distance_between_stops(start_stop_id, end_stop_id)
+        if distance is None or distance <= 0:
+            return None
 
+        return quote_fare(obj.cost_per_km, distance)
 
 
-class BookingDetailSerializer(serializers.ModelSerializer):
+class BookingDetailSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    expandable_fields = ('trip',)
     trip = TravellorSerializer(read_only=True)
-    start_stop = StopSerializer(source='start_stop.stop', read_only=True)
-    end_stop = StopSerializer(source='end_stop.stop', read_only=True)
+    start_stop = serializers.SerializerMethodField()
+    end_stop = serializers.SerializerMethodField()
+    start_stop_name = serializers.SerializerMethodField()
+    end_stop_name = serializers.SerializerMethodField()
     customer_name = serializers.CharField(source='customer.name', read_only=True)
     estimated_departure = serializers.SerializerMethodField()
     estimated_arrival = serializers.SerializerMethodField()
@@ -115,25 +189,52 @@ class BookingDetailSerializer(serializers.ModelSerializer):
             'customer_name', 
             'start_stop', 
             'end_stop', 
+            'start_stop_name',
+            'end_stop_name',
             'seats', 
+            'seat_numbers',
             'status', 
             'booking_time',
             'estimated_departure',
             'estimated_arrival',
-            'price'
+            'price',
+            'segment_distance',
         ]
 
+    # Stop names come from the snapshot; only bookings made before snapshots
+    # existed (see backfill_booking_snapshots) read the route's stops.
+    def get_start_stop_name(self, obj):
+        return obj.start_stop_name or obj.start_stop.stop.name
+
+    def get_end_stop_name(self, obj):
+        return obj.end_stop_name or obj.end_stop.stop.name
+
+    # The booked stops keep their Stop shape, named as they were when booked.
+    def get_start_stop(self, obj):
+        return {**StopSerializer(obj.start_stop.stop).data, 'name': self.get_start_stop_name(obj)}
+
+    def get_end_stop(self, obj):
+        return {**StopSerializer(obj.end_stop.stop).data, 'name': self.get_end_stop_name(obj)}
+
     def get_estimated_departure(self, obj):
+        if obj.has_snapshot:
+            # The snapshot is the scheduled time; the trip's live delay applies on top.
+            return obj.estimated_departure + timedelta(minutes=obj.trip.delay_minutes)
         schedule = obj.trip.get_schedule()
-        start_stop_schedule = next((item for item in schedule if item['route_stop_id'] == obj.start_stop.id), None)
+        start_stop_schedule = next((item for item in schedule if item['route_stop_id'] == obj.start_stop_id), None)
         return start_stop_schedule['estimated_arrival_time'] if start_stop_schedule else None
 
     def get_estimated_arrival(self, obj):
+        if obj.has_snapshot:
+            return obj.estimated_arrival + timedelta(minutes=obj.trip.delay_minutes)
         schedule = obj.trip.get_schedule()
-        end_stop_schedule = next((item for item in schedule if item['route_stop_id'] == obj.end_stop.id), None)
+        end_stop_schedule = next((item for item in schedule if item['route_stop_id'] == obj.end_stop_id), None)
         return end_stop_schedule['estimated_arrival_time'] if end_stop_schedule else None
 
     def get_price(self, obj):
+        if obj.fare is not None:
+            return obj.fare
+
         start_stop = obj.start_stop
         end_stop = obj.end_stop
         trip = obj.trip
@@ -141,8 +242,84 @@ class BookingDetailSerializer(serializers.ModelSerializer):
         if not all([start_stop, end_stop, trip]):
             return None
 
+        distance = get_route_fares(trip.route_id).distance_between_route_stops(start_stop.id, end_stop.id)
+        if distance is None:
+            return None
+        return quote_fare(trip.cost_per_km, distance, obj.seats)
+
 
-        return trip.cost_per_km *obj.seats
+class FareSegmentSerializer(serializers.Serializer):
+    """A single trip segment to be priced."""
+    trip = serializers.IntegerField()
+    start_stop = serializers.IntegerField(help_text="RouteStop id of the boarding stop.")
+    end_stop = serializers.IntegerField(help_text="RouteStop id of the alighting stop.")
+    seats = serializers.IntegerField(min_value=1, default=1)
+
+
+class FareQuoteSerializer(serializers.Serializer):
+    """Serializer for pricing many segments in one request."""
+    segments = FareSegmentSerializer(many=True, allow_empty=False)
+
+    def validate_segments(self, value):
+        if len(value) > 500:
+            raise serializers.ValidationError("At most 500 segments can be quoted at once.")
+        return value
+
+
+class SeatHoldSerializer(serializers.ModelSerializer):
+    start_stop = serializers.PrimaryKeyRelatedField(queryset=RouteStop.objects.all())
+    end_stop = serializers.PrimaryKeyRelatedField(queryset=RouteStop.objects.all())
+    seats = serializers.IntegerField(min_value=1)
+
+    class Meta:
+        model = SeatHold
+        fields = ['id', 'trip', 'start_stop', 'end_stop', 'seats', 'created_at', 'expires_at']
+        read_only_fields = ('id', 'created_at', 'expires_at')
+
+    def validate(self, data):
+        return validate_segment(data)
+
+
+class PositionPingSerializer(serializers.Serializer):
+    """A driver's position on a trip. The view checks that the user drives the trip."""
+    trip = serializers.IntegerField(min_value=1)
+    latitude = serializers.FloatField(min_value=-90, max_value=90)
+    longitude = serializers.FloatField(min_value=-180, max_value=180)
+    stop_order = serializers.IntegerField(min_value=1, required=False, allow_null=True)
+    recorded_at = serializers.DateTimeField(required=False)
+
+    def validate_recorded_at(self, value):
+        # Device clocks drift; a ping cannot be from the future.
+        return min(value, timezone.now())
+
+
+class RecurringBookingSerializer(serializers.Serializer):
+    """A segment booked on the same daily departure across a date range."""
+    MAX_DAYS = 92
+
+    route = serializers.PrimaryKeyRelatedField(queryset=Route.objects.all())
+    start_stop = serializers.PrimaryKeyRelatedField(queryset=RouteStop.objects.all())
+    end_stop = serializers.PrimaryKeyRelatedField(queryset=RouteStop.objects.all())
+    departure_time = serializers.TimeField(help_text="Local departure time of the trip, HH:MM.")
+    start_date = serializers.DateField()
+    end_date = serializers.DateField()
+    seats = serializers.IntegerField(min_value=1, default=1)
+    weekdays = serializers.ListField(
+        child=serializers.IntegerField(min_value=0, max_value=6), default=[0, 1, 2, 3, 4], allow_empty=False,
+        help_text="Days of the week to book, Monday = 0. Defaults to Monday to Friday.",
+    )
+
+    def validate(self, data):
+        if data['start_stop'].route_id != data['route'].id or data['end_stop'].route_id != data['route'].id:
+            raise serializers.ValidationError("Stops must be on the route.")
+        if data['start_stop'].order >= data['end_stop'].order:
+            raise serializers.ValidationError("End stop must be after start stop.")
+        if data['start_date'] < timezone.localdate():
+            raise serializers.ValidationError("The start date cannot be in the past.")
+        if not 0 <= (data['end_date'] - data['start_date']).days < self.MAX_DAYS:
+            raise serializers.ValidationError(f"The date range must cover 1 to {self.MAX_DAYS} days.")
+        data['departure_time'] = data['departure_time'].replace(second=0, microsecond=0)
+        return data
 
 
 class CarSerializer(serializers.ModelSerializer):
@@ -189,7 +366,8 @@ class CabBookingSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class CabBookingDetailSerializer(serializers.ModelSerializer):
+class CabBookingDetailSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    expandable_fields = ('customer', 'car')
     customer = CustomerSerializer(read_only=True)
     car = CarSerializer(read_only=True)
     people_count = serializers.IntegerField(read_only=True)
@@ -358,5 +536,5 @@ class StopCreateSerializer(serializers.ModelSerializer):
     """Serializer for creating stops."""
     class Meta:
         model = Stop
-        fields = ['id', 'name', 'description']
+        fields = ['id', 'name', 'description', 'latitude', 'longitude']
         read_only_fields = ['id']
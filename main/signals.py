@@ -0,0 +1,104 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Booking, CabBooking, Car, Customer, Route, RouteStop, Stop, Travellor
+from .fares import invalidate_route_fares
+from .journeys import route_version_key, timetable_version_key
+from .rollups import mark_route_day_stale, mark_trips_stale
+from .stop_index import STOPS_VERSION_KEY
+from .stop_times import build_stop_times
+from .tasks import bump_customer_bookings, bump_customer_cab_bookings, enqueue
+from .versioning import bump_version
+
+
+@receiver([post_save, post_delete], sender=RouteStop)
+def route_stop_changed(sender, instance, **kwargs):
+    """Drops cached per-route data whenever a route's stops are edited."""
+    invalidate_route_fares(instance.route_id)
+    bump_version(route_version_key(instance.route_id))
+    mark_trips_stale(route_id=instance.route_id)
+    for driver_id in Travellor.objects.filter(route_id=instance.route_id).values_list('driver_id', flat=True).distinct():
+        enqueue('refresh_driver_rollups', driver_id=driver_id)
+    enqueue('rebuild_route_stop_times', route_id=instance.route_id)
+    enqueue('bump_customer_versions', route_ids=[instance.route_id])
+
+
+@receiver(post_save, sender=Route)
+def route_changed(sender, instance, **kwargs):
+    bump_version(route_version_key(instance.pk))
+    enqueue('bump_customer_versions', route_ids=[instance.pk])
+
+
+@receiver([post_save, post_delete], sender=Stop)
+def stop_changed(sender, instance, **kwargs):
+    bump_version(STOPS_VERSION_KEY)
+
+
+@receiver(pre_save, sender=Travellor)
+def remember_trip_date(sender, instance, **kwargs):
+    # An edit can move a trip to another day; both days' timetables must be refreshed,
+    # and its stop times rebuilt if it moved at all.
+    if instance.pk:
+        previous = Travellor.objects.filter(pk=instance.pk).values_list('departure_time', 'route_id').first()
+        if previous:
+            instance._previous_departure_time, instance._previous_route_id = previous
+
+
+@receiver([post_save, post_delete], sender=Travellor)
+def trip_changed(sender, instance, **kwargs):
+    departures = {instance.departure_time, getattr(instance, '_previous_departure_time', None)}
+    for departure_time in departures - {None}:
+        bump_version(timetable_version_key(timezone.localdate(departure_time)))
+
+
+@receiver(post_save, sender=Travellor)
+def trip_saved_for_rollups(sender, instance, **kwargs):
+    mark_trips_stale(trip_id=instance.pk)
+    enqueue('refresh_driver_rollups', driver_id=instance.driver_id)
+
+
+@receiver(post_save, sender=Travellor)
+def trip_saved_for_stop_times(sender, instance, created, **kwargs):
+    previous = (getattr(instance, '_previous_departure_time', None), getattr(instance, '_previous_route_id', None))
+    if created or previous != (instance.departure_time, instance.route_id):
+        build_stop_times([instance])
+
+
+@receiver(post_save, sender=Travellor)
+def trip_saved_for_bookings(sender, instance, created, **kwargs):
+    # Deleting a trip deletes its bookings, which bumps their customers already.
+    if not created:
+        enqueue('bump_customer_versions', trip_ids=[instance.pk])
+
+
+@receiver(post_delete, sender=Travellor)
+def trip_deleted_for_rollups(sender, instance, **kwargs):
+    mark_route_day_stale(instance.driver_id, instance.route_id, timezone.localdate(instance.departure_time))
+    enqueue('refresh_driver_rollups', driver_id=instance.driver_id)
+
+
+@receiver([post_save, post_delete], sender=Booking)
+def booking_changed(sender, instance, **kwargs):
+    mark_trips_stale(trip_id=instance.trip_id)
+    enqueue('refresh_driver_rollups', driver_id=instance.trip.driver_id)
+    bump_customer_bookings([instance.customer_id])
+
+
+@receiver([post_save, post_delete], sender=CabBooking)
+def cab_booking_changed(sender, instance, **kwargs):
+    bump_customer_cab_bookings([instance.customer_id])
+
+
+@receiver(post_save, sender=Customer)
+def customer_changed(sender, instance, created, **kwargs):
+    # Both booking lists show the customer's name.
+    if not created:
+        bump_customer_bookings([instance.pk])
+        bump_customer_cab_bookings([instance.pk])
+
+
+@receiver(post_save, sender=Car)
+def car_changed(sender, instance, created, **kwargs):
+    if not created:
+        enqueue('bump_customer_versions', car_ids=[instance.pk])
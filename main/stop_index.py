@@ -0,0 +1,232 @@
+"""
+In-process indexes over `Stop`: a text index over names and descriptions and a
+grid-hash spatial index over coordinates.
+
+Both are rebuilt lazily whenever the `stops` version counter moves (it is
+bumped by the Stop save/delete signals), so every worker answers lookups from
+memory instead of scanning the table.
+"""
+import heapq
+import math
+import re
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from .metrics import CACHE_LOOKUPS
+from .models import Stop
+from .versioning import get_version
+
+STOPS_VERSION_KEY = 'stops'
+
+_token_re = re.compile(r'\w+')
+
+
+def normalize(text):
+    return ' '.join(_token_re.findall(text.casefold()))
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class StopTextIndex:
+    """Prefix and trigram index used for ranked stop autocomplete."""
+
+    def __init__(self, rows):
+        self.stops = {}
+        self.name_tokens = []
+        self.description_tokens = []
+        self.trigram_postings = defaultdict(set)
+        for stop_id, name, description in rows:
+            normalized_name = normalize(name)
+            self.stops[stop_id] = {'id': stop_id, 'name': name, 'description': description, 'normalized': normalized_name}
+            for token in normalized_name.split():
+                self.name_tokens.append((token, stop_id))
+            for token in normalize(description).split():
+                self.description_tokens.append((token, stop_id))
+            for gram in trigrams(normalized_name):
+                self.trigram_postings[gram].add(stop_id)
+        self.name_tokens.sort()
+        self.description_tokens.sort()
+
+    @staticmethod
+    def _prefix_matches(tokens, prefix):
+        matches = set()
+        i = bisect_left(tokens, (prefix,))
+        while i < len(tokens) and tokens[i][0].startswith(prefix):
+            matches.add(tokens[i][1])
+            i += 1
+        return matches
+
+    def search(self, query, limit=10):
+        """Returns up to `limit` stops ranked by how well they match `query`."""
+        query = normalize(query)
+        if not query:
+            return []
+        words = query.split()
+
+        # Every word must prefix-match a token in the name or description.
+        prefix_hits = None
+        name_hits = None
+        for word in words:
+            in_name = self._prefix_matches(self.name_tokens, word)
+            in_description = self._prefix_matches(self.description_tokens, word)
+            matched = in_name | in_description
+            prefix_hits = matched if prefix_hits is None else prefix_hits & matched
+            name_hits = in_name if name_hits is None else name_hits & in_name
+
+        # Trigram overlap catches typos and matches inside words.
+        query_grams = trigrams(query)
+        overlap = defaultdict(int)
+        for gram in query_grams:
+            for stop_id in self.trigram_postings.get(gram, ()):
+                overlap[stop_id] += 1
+
+        scores = {}
+        threshold = max(1, len(query_grams) // 2)
+        for stop_id in prefix_hits | {stop_id for stop_id, count in overlap.items() if count >= threshold}:
+            normalized_name = self.stops[stop_id]['normalized']
+            similarity = overlap.get(stop_id, 0) / len(query_grams | trigrams(normalized_name))
+            scores[stop_id] = (
+                normalized_name.startswith(query),
+                stop_id in name_hits,
+                stop_id in prefix_hits,
+                similarity,
+                -len(normalized_name),
+            )
+
+        ranked = heapq.nlargest(limit, scores, key=scores.get)
+        return [
+            {key: self.stops[stop_id][key] for key in ('id', 'name', 'description')}
+            for stop_id in ranked
+        ]
+
+
+EARTH_RADIUS_METERS = 6371000
+GRID_CELL_DEGREES = 0.01  # roughly 1.1 km of latitude
+
+
+def haversine_meters(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+class StopSpatialIndex:
+    """Grid hash of stops with coordinates, for nearest and within-radius queries."""
+
+    def __init__(self, rows):
+        self.cells = defaultdict(list)
+        self.size = 0
+        for stop_id, name, description, latitude, longitude in rows:
+            if latitude is None or longitude is None:
+                continue
+            self.cells[self._cell(latitude, longitude)].append((stop_id, name, description, latitude, longitude))
+            self.size += 1
+        if self.cells:
+            cell_rows, cell_cols = zip(*self.cells)
+            self.bounds = (min(cell_rows), max(cell_rows), min(cell_cols), max(cell_cols))
+
+    @staticmethod
+    def _cell(latitude, longitude):
+        return (math.floor(latitude / GRID_CELL_DEGREES), math.floor(longitude / GRID_CELL_DEGREES))
+
+    def _ring(self, center, radius):
+        """Stops in the square ring of cells exactly `radius` cells from `center`."""
+        row, col = center
+        if radius == 0:
+            yield from self.cells.get(center, ())
+            return
+        for c in range(col - radius, col + radius + 1):
+            yield from self.cells.get((row - radius, c), ())
+            yield from self.cells.get((row + radius, c), ())
+        for r in range(row - radius + 1, row + radius):
+            yield from self.cells.get((r, col - radius), ())
+            yield from self.cells.get((r, col + radius), ())
+
+    def _all(self):
+        for stops in self.cells.values():
+            yield from stops
+
+    def nearest(self, latitude, longitude, limit=10, radius_meters=None):
+        """
+        Returns up to `limit` stops ordered by distance, optionally within `radius_meters`.
+        Rings of grid cells are scanned outwards until no unscanned cell can hold a closer stop.
+        """
+        if not self.size:
+            return []
+        center = self._cell(latitude, longitude)
+        # Cells narrow towards the poles; use the narrowest width nearby as a lower bound.
+        cell_meters = math.radians(GRID_CELL_DEGREES) * EARTH_RADIUS_METERS * max(
+            math.cos(math.radians(min(abs(latitude) + GRID_CELL_DEGREES, 90))), 1e-6
+        )
+        max_ring = math.ceil(radius_meters / cell_meters) + 1 if radius_meters is not None else None
+
+        # Rings closer than the nearest occupied cell are empty, so start there.
+        min_row, max_row, min_col, max_col = self.bounds
+        ring = max(min_row - center[0], center[0] - max_row, min_col - center[1], center[1] - max_col, 0)
+        if max_ring is not None and ring > max_ring:
+            return []
+        found = []
+        scanned = 0
+        while True:
+            exhaustive = ring > 0 and 8 * ring > len(self.cells)
+            if exhaustive:
+                # The ring spans more cells than the index holds (a query far from the
+                # network), so checking every stop is cheaper than walking empty cells.
+                found = []
+                candidates = self._all()
+            else:
+                candidates = self._ring(center, ring)
+            for stop_id, name, description, stop_lat, stop_lng in candidates:
+                scanned += 1
+                distance = haversine_meters(latitude, longitude, stop_lat, stop_lng)
+                if radius_meters is None or distance <= radius_meters:
+                    found.append((distance, stop_id, name, description, stop_lat, stop_lng))
+            # Everything outside ring `ring` is at least `ring * cell_meters` away.
+            if len(found) >= limit and heapq.nsmallest(limit, found)[-1][0] <= ring * cell_meters:
+                break
+            if exhaustive or scanned >= self.size or (max_ring is not None and ring >= max_ring):
+                break
+            ring += 1
+
+        return [
+            {'id': stop_id, 'name': name, 'description': description, 'latitude': stop_lat,
+             'longitude': stop_lng, 'distance_meters': round(distance)}
+            for distance, stop_id, name, description, stop_lat, stop_lng in heapq.nsmallest(limit, found)
+        ]
+
+
+_indexes = None
+_indexes_version = None
+_lock = threading.Lock()
+
+
+def _get_indexes():
+    global _indexes, _indexes_version
+    version = get_version(STOPS_VERSION_KEY)
+    with _lock:
+        stale = _indexes is None or _indexes_version != version
+        CACHE_LOOKUPS.labels('stop_index', 'miss' if stale else 'hit').inc()
+        if stale:
+            rows = list(Stop.objects.values_list('id', 'name', 'description', 'latitude', 'longitude'))
+            _indexes = (
+                StopTextIndex(row[:3] for row in rows),
+                StopSpatialIndex(rows),
+            )
+            _indexes_version = version
+        return _indexes
+
+
+def get_stop_index():
+    """Returns the current text index, rebuilding it if stops changed since it was built."""
+    return _get_indexes()[0]
+
+
+def get_spatial_index():
+    """Returns the current spatial index, rebuilding it if stops changed since it was built."""
+    return _get_indexes()[1]
@@ -0,0 +1,198 @@
+"""
+Materialized stop times and the per-stop departure board.
+
+Each trip's ETA at every stop it departs from is stored in `StopTime`, written
+when the trip is created or moved, and rewritten for a route's upcoming trips by
+a background task when its stop offsets change. A board then reads the next departures from a stop in ETA order
+straight off the `(stop, eta)` index and checks seats for just those trips, and
+a windowed search walks the same index keeping only a bounded top-k.
+"""
+from bisect import insort
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .fares import quote_fare
+from .models import RouteStop, StopTime, Travellor
+from .seats import LegLoads
+
+BATCH_SIZE = 2000
+SCAN_PAGE_SIZE = 500
+SORT_KEYS = {
+    'earliest': lambda row: (row['arrival_at_end'], row['trip_id']),
+    'cheapest': lambda row: (row['price'], row['arrival_at_end'], row['trip_id']),
+    'seats': lambda row: (-row['available_seats'], row['arrival_at_end'], row['trip_id']),
+}
+
+def build_stop_times(trips):
+    """Replaces the stop times of `trips` (with `route_id` and `departure_time` loaded)."""
+    trips = list(trips)
+    if not trips:
+        return 0
+    legs = defaultdict(list)
+    minutes = defaultdict(int)
+    for route_id, route_stop_id, stop_id, order, step in RouteStop.objects.filter(
+        route_id__in={trip.route_id for trip in trips},
+    ).order_by('route_id', 'order').values_list('route_id', 'id', 'stop_id', 'order', 'minutes_from_previous_stop'):
+        minutes[route_id] += step
+        legs[route_id].append((route_stop_id, stop_id, order, minutes[route_id]))
+
+    rows = [
+        StopTime(
+            trip_id=trip.pk, stop_id=stop_id, route_stop_id=route_stop_id, route_stop_order=order,
+            eta=trip.departure_time + timedelta(minutes=offset),
+        )
+        for trip in trips
+        for route_stop_id, stop_id, order, offset in legs[trip.route_id][:-1]
+    ]
+    with transaction.atomic():
+        StopTime.objects.filter(trip_id__in=[trip.pk for trip in trips]).delete()
+        StopTime.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    return len(rows)
+
+
+def rebuild_route(route_id):
+    """
+    Rewrites the stop times of a route's trips that have not yet departed. Past
+    trips keep the times they ran to.
+    """
+    trips = Travellor.objects.filter(route_id=route_id, departure_time__gte=timezone.now()).only(
+        'id', 'route_id', 'departure_time',
+    )
+    return build_stop_times(trips)
+
+
+def departure_board(stop_id, after, limit, seats=1):
+    """
+    The next `limit` departures from a stop at or after `after` on scheduled trips
+    with at least `seats` free on the leg leaving the stop, in ETA order.
+    """
+    stop_times = StopTime.objects.filter(
+        stop_id=stop_id, eta__gte=after, trip__status='SCHEDULED',
+    ).select_related('trip__route').order_by('eta', 'trip_id')
+
+    board = []
+    offset = 0
+    while len(board) < limit:
+        # Full trips are skipped, so read ahead in pages until the board is filled.
+        page = list(stop_times[offset:offset + limit * 2])
+        if not page:
+            break
+        offset += len(page)
+        loads = LegLoads.for_trips([stop_time.trip for stop_time in page])
+        for stop_time in page:
+            trip = stop_time.trip
+            available = loads[trip.pk].available(stop_time.route_stop_order, stop_time.route_stop_order + 1)
+            if available < seats:
+                continue
+            board.append({
+                'trip_id': trip.pk,
+                'route_id': trip.route_id,
+                'route_name': trip.route.name,
+                'route_stop_id': stop_time.route_stop_id,
+                'route_stop_order': stop_time.route_stop_order,
+                'departure_time': trip.departure_time,
+                'estimated_departure_time': stop_time.eta + timedelta(minutes=trip.delay_minutes),
+                'available_seats': available,
+                'cost_per_km': trip.cost_per_km,
+            })
+            if len(board) == limit:
+                break
+    return board
+
+
+def _segment_patterns(start_stop_id, end_stop_id):
+    """
+    `{route_id: (start RouteStop, end RouteStop, start order, end order, minutes
+    between them, distance between them)}` for routes that visit the start stop
+    and later the end stop.
+    """
+    rows = defaultdict(list)
+    for route_id, *row in RouteStop.objects.filter(
+        route_id__in=RouteStop.objects.filter(stop_id=start_stop_id).values('route_id'),
+    ).filter(
+        route_id__in=RouteStop.objects.filter(stop_id=end_stop_id).values('route_id'),
+    ).order_by('route_id', 'order').values_list(
+        'route_id', 'id', 'stop_id', 'order', 'minutes_from_previous_stop', 'distance_from_previous_stop',
+    ):
+        rows[route_id].append(row)
+
+    patterns = {}
+    for route_id, route_stops in rows.items():
+        start = None
+        minutes = distance = 0
+        for route_stop_id, stop_id, order, step_minutes, step_distance in route_stops:
+            if start is not None:
+                minutes += step_minutes
+                distance += step_distance
+                if stop_id == end_stop_id:
+                    patterns[route_id] = (start[0], route_stop_id, start[1], order, minutes, distance)
+                    break
+            elif stop_id == start_stop_id:
+                start = (route_stop_id, order)
+    return patterns
+
+
+def search_window(start_stop_id, end_stop_id, after, before, limit, sort='earliest', seats=1):
+    """
+    The best `limit` trips from one stop to another departing the start stop in
+    `[after, before)`, ranked by `sort` (a key of `SORT_KEYS`), with at least
+    `seats` free on the segment.
+
+    Candidates are read as plain rows in ETA order from the `(stop, eta)` index a
+    page at a time; only the current top `limit` are kept. When ranking by
+    earliest arrival the scan stops as soon as no later departure can arrive
+    before the worst result kept; delays only make trips later, so live delays
+    do not change this.
+    """
+    patterns = _segment_patterns(start_stop_id, end_stop_id)
+    if not patterns:
+        return []
+    sort_key = SORT_KEYS[sort]
+    stop_times = StopTime.objects.filter(
+        stop_id=start_stop_id, route_stop_id__in=[pattern[0] for pattern in patterns.values()],
+        eta__gte=after, eta__lt=before, trip__status='SCHEDULED',
+    ).order_by('eta', 'trip_id').values_list(
+        'trip_id', 'eta', 'trip__route_id', 'trip__departure_time', 'trip__vehicle_capacity', 'trip__cost_per_km',
+        'trip__delay_minutes',
+    )
+
+    best = []
+    last = None
+    while True:
+        page = stop_times if last is None else stop_times.filter(
+            Q(eta__gt=last[1]) | Q(eta=last[1], trip_id__gt=last[0]),
+        )
+        page = list(page[:SCAN_PAGE_SIZE])
+        if not page:
+            break
+        last = page[-1]
+        if sort == 'earliest' and len(best) == limit and page[0][1] >= best[-1][1]['arrival_at_end']:
+            break
+
+        loads = LegLoads.for_trips(
+            Travellor(pk=trip_id, route_id=route_id, vehicle_capacity=capacity)
+            for trip_id, _, route_id, _, capacity, _, _ in page
+        )
+        for trip_id, eta, route_id, departure_time, _, cost_per_km, delay_minutes in page:
+            start_route_stop_id, end_route_stop_id, start_order, end_order, minutes, distance = patterns[route_id]
+            available = loads[trip_id].available(start_order, end_order)
+            if available < seats:
+                continue
+            row = {
+                'trip_id': trip_id,
+                'departure_time': departure_time,
+                'departure_from_start': eta + timedelta(minutes=delay_minutes),
+                'arrival_at_end': eta + timedelta(minutes=delay_minutes + minutes),
+                'start_stop_id': start_route_stop_id,
+                'end_stop_id': end_route_stop_id,
+                'available_seats': available,
+                'price': quote_fare(cost_per_km, distance),
+            }
+            insort(best, (sort_key(row), row))
+            if len(best) > limit:
+                best.pop()
+    return [row for _, row in best]
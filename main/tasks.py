@@ -0,0 +1,207 @@
+"""
+Background tasks for side effects of bookings and route edits: notifications,
+rollup refreshes, stop time rebuilds and cache invalidation.
+
+Views and signals call `enqueue(...)` inside their transaction. Payloads are
+collected per task for the whole transaction, duplicates dropped, and handed to
+the backend as one batch when it commits: a bulk booking or a trip edit that
+fires the same signal many times costs one job per task, not one per row, and a
+rolled-back transaction notifies no one. The `celery` backend sends each batch
+to the broker as one message. A failed batch is retried with backoff up to
+`MAX_RETRIES` times, and one whose worker died is redelivered, so tasks must be
+safe to run twice: notifications record what was sent and skip it on the next
+run. The `eager` backend runs each batch as soon as it is committed, for tests
+and local debugging.
+"""
+from functools import partial
+
+from celery import shared_task
+from django.conf import settings
+from django.core.mail import get_connection, send_mail
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Booking, CabBooking
+from .rollups import refresh_rollups
+from .stop_times import rebuild_route
+from .versioning import bump_version
+
+DEFAULTS = {'BACKEND': 'celery', 'MAX_RETRIES': 3, 'RETRY_DELAY': 5}
+
+_tasks = {}
+
+
+def get_setting(name):
+    return getattr(settings, 'TASKS', {}).get(name, DEFAULTS[name])
+
+
+def task(func):
+    """Registers a function taking a list of payloads as a task."""
+    _tasks[func.__name__] = func
+    return func
+
+
+class _Batch:
+    """The distinct payloads enqueued per task in one transaction; sends them when called."""
+
+    def __init__(self):
+        self.payloads = {}
+
+    def add(self, name, payload):
+        self.payloads.setdefault(name, {}).setdefault(repr(sorted(payload.items())), payload)
+
+    def __call__(self):
+        backend = BACKENDS[get_setting('BACKEND')]
+        for name, payloads in self.payloads.items():
+            backend(name, list(payloads.values()))
+
+
+def enqueue(name, **payload):
+    """Runs task `name` with `payload` in the background once the current transaction commits."""
+    if name not in _tasks:
+        raise KeyError(f"Unknown task '{name}'.")
+    connection = transaction.get_connection()
+    batch = getattr(connection, 'task_batch', None)
+    # A batch belongs to the transaction whose commit hooks still hold it. One
+    # from a committed or rolled-back transaction is done with, so start another.
+    # Payloads added inside a savepoint that rolls back are still sent; tasks only
+    # act on what is in the database when they run, so they skip them.
+    if batch is None or not any(hook[1] is batch for hook in connection.run_on_commit):
+        batch = connection.task_batch = _Batch()
+        batch.add(name, payload)
+        transaction.on_commit(batch)
+    else:
+        batch.add(name, payload)
+
+
+@shared_task(bind=True)
+def run_task(self, name, payloads):
+    """Celery entry point for one batch of a registered task."""
+    try:
+        _tasks[name](payloads)
+    except Exception as exc:
+        countdown = get_setting('RETRY_DELAY') * 2 ** self.request.retries
+        raise self.retry(exc=exc, countdown=countdown, max_retries=get_setting('MAX_RETRIES'))
+
+
+def _run_eager(name, payloads):
+    _tasks[name](payloads)
+
+
+def _send_to_celery(name, payloads):
+    run_task.delay(name, payloads)
+
+
+BACKENDS = {'eager': _run_eager, 'celery': _send_to_celery}
+
+
+@task
+def notify_bookings(payloads):
+    """Emails customers their booking confirmations, once per booking."""
+    bookings = Booking.objects.filter(
+        pk__in=[payload['booking_id'] for payload in payloads], notified_at__isnull=True,
+    ).select_related('customer__user', 'trip__route')
+    with get_connection() as mail:
+        for booking in bookings:
+            if not booking.customer.user.email or not booking.estimated_departure:
+                continue
+            send_mail(
+                f"Booking #{booking.pk} confirmed",
+                f"Hi {booking.customer.name},\n\n"
+                f"Your {booking.seats} seat(s) on {booking.trip.route.name} from {booking.start_stop_name} "
+                f"to {booking.end_stop_name} are booked. Departure: {booking.estimated_departure:%Y-%m-%d %H:%M}.",
+                None,
+                [booking.customer.user.email],
+                connection=mail,
+            )
+            # Recorded as soon as it is sent, so a retry skips it.
+            Booking.objects.filter(pk=booking.pk).update(notified_at=timezone.now())
+
+
+@task
+def notify_cab_bookings(payloads):
+    """Emails customers when a cab booking is created or confirmed, once per status."""
+    cab_bookings = CabBooking.objects.filter(
+        pk__in=[payload['cab_booking_id'] for payload in payloads],
+    ).exclude(notified_status=F('status')).select_related('customer__user', 'car')
+    with get_connection() as mail:
+        for booking in cab_bookings:
+            if not booking.customer.user.email:
+                continue
+            if booking.status == 'CONFIRMED':
+                body = f"Your cab for {booking.pickup_time:%Y-%m-%d %H:%M} is confirmed"
+                if booking.car:
+                    body += f": {booking.car.name} ({booking.car.license_plate}), driver {booking.driver_name or ''} {booking.driver_no or ''}"
+            else:
+                body = f"We received your cab request for {booking.pickup_time:%Y-%m-%d %H:%M} and will confirm it shortly"
+            send_mail(
+                f"Cab booking #{booking.pk} {booking.get_status_display().lower()}",
+                f"Hi {booking.customer.name},\n\n{body}.",
+                None,
+                [booking.customer.user.email],
+                connection=mail,
+            )
+            CabBooking.objects.filter(pk=booking.pk).update(notified_status=booking.status)
+
+
+@task
+def refresh_driver_rollups(payloads):
+    """Brings the analytics rollups of the drivers whose trips or bookings changed up to date."""
+    for driver_id in {payload['driver_id'] for payload in payloads}:
+        refresh_rollups(driver_id=driver_id)
+
+
+@task
+def rebuild_route_stop_times(payloads):
+    """Rewrites the stop times of upcoming trips on routes whose stops changed."""
+    for route_id in {payload['route_id'] for payload in payloads}:
+        rebuild_route(route_id)
+
+
+def customer_bookings_version_key(customer_id):
+    return f"bookings:customer:{customer_id}"
+
+
+def customer_cab_bookings_version_key(customer_id):
+    return f"cab-bookings:customer:{customer_id}"
+
+
+def bump_customer_bookings(customer_ids):
+    """Bumps the customers' booking list versions once the current transaction commits."""
+    for customer_id in set(customer_ids):
+        transaction.on_commit(partial(bump_version, customer_bookings_version_key(customer_id)))
+
+
+def bump_customer_cab_bookings(customer_ids):
+    for customer_id in set(customer_ids):
+        transaction.on_commit(partial(bump_version, customer_cab_bookings_version_key(customer_id)))
+
+
+@task
+def bump_customer_versions(payloads):
+    """
+    Bumps the booking lists of every customer with a booking on one of the
+    changed trips or routes, or a cab booking with one of the changed cars.
+    """
+    trip_ids = {trip_id for payload in payloads for trip_id in payload.get('trip_ids', ())}
+    route_ids = {route_id for payload in payloads for route_id in payload.get('route_ids', ())}
+    car_ids = {car_id for payload in payloads for car_id in payload.get('car_ids', ())}
+    if trip_ids or route_ids:
+        for customer_id in Booking.objects.filter(
+            Q(trip_id__in=trip_ids) | Q(trip__route_id__in=route_ids),
+        ).values_list('customer_id', flat=True).distinct():
+            bump_version(customer_bookings_version_key(customer_id))
+    if car_ids:
+        for customer_id in CabBooking.objects.filter(car_id__in=car_ids).values_list('customer_id', flat=True).distinct():
+            bump_version(customer_cab_bookings_version_key(customer_id))
+
+
+def after_booking(booking):
+    """Queues the side effects of a new booking; call inside the booking's transaction."""
+    enqueue('notify_bookings', booking_id=booking.pk)
+
+
+def after_cab_booking(cab_booking):
+    """Queues the side effects of a cab booking being created or confirmed."""
+    enqueue('notify_cab_bookings', cab_booking_id=cab_booking.pk)
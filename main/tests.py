@@ -1,3 +1,799 @@
-from django.test import TestCase
+import io
+import threading
+import zipfile
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from main import routers, tracking, views
+from main.admission import ConcurrencySlots
+from main.gtfs import FeedExporter, FeedImporter, open_zip
+from main.models import (
+    Booking, Customer, IdempotencyKey, Route, RouteDailyStats, RouteStop, SeatHold, Stop, TripPosition, Travellor,
+    Vendor, WaitlistEntry,
+)
+from main.rollups import refresh_rollups
+
+
+def create_trip():
+    """A vendor's trip tomorrow on a three-stop route, and a customer to book it."""
+    vendor = User.objects.create_user('vendor', password='x')
+    Vendor.objects.create(user=vendor, company_name='Vendor')
+    customer = Customer.objects.create(user=User.objects.create_user('customer', password='x'), name='Customer', contact_number='1')
+    route = Route.objects.create(name='Route')
+    route_stops = [
+        RouteStop.objects.create(
+            route=route, stop=Stop.objects.create(name=f"Stop {order}"), order=order,
+            minutes_from_previous_stop=0 if order == 1 else 10, distance_from_previous_stop=0 if order == 1 else 5,
+        )
+        for order in (1, 2, 3)
+    ]
+    trip = Travellor.objects.create(
+        driver=vendor, route=route, departure_time=timezone.now() + timedelta(days=1),
+        vehicle_capacity=4, cost_per_km=Decimal('2.50'),
+    )
+    return customer, route_stops, trip
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class IdempotencyKeyTests(TestCase):
+    def setUp(self):
+        self.customer, route_stops, self.trip = create_trip()
+        self.body = {'trip': self.trip.pk, 'start_stop': route_stops[0].pk, 'end_stop': route_stops[2].pk, 'seats': 1}
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer.user)
+
+    def book(self, body, key='booking-1'):
+        return self.client.post(reverse('book_traveller'), body, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_stored_response(self):
+        first = self.book(self.body)
+        second = self.book(self.body)
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.json(), first.json())
+        self.assertNotIn('Idempotent-Replayed', first)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_key_reused_with_different_body_is_rejected(self):
+        self.assertEqual(self.book(self.body).status_code, 201)
+        response = self.book({**self.body, 'seats': 2})
+
+        self.assertEqual(response.status_code, 422)
+        self.assertIn('error', response.json())
+        self.assertEqual(Booking.objects.get().seats, 1)
+
+    def test_same_key_from_another_user_is_independent(self):
+        other = Customer.objects.create(user=User.objects.create_user('other', password='x'), name='Other', contact_number='2')
+        self.assertEqual(self.book(self.body).status_code, 201)
+        self.client.force_authenticate(other.user)
+
+        self.assertEqual(self.book(self.body).status_code, 201)
+        self.assertEqual(Booking.objects.count(), 2)
+        self.assertEqual(IdempotencyKey.objects.count(), 2)
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class ConcurrentIdempotencyKeyTests(TransactionTestCase):
+    def test_concurrent_duplicate_waits_then_replays(self):
+        customer, route_stops, trip = create_trip()
+        body = {'trip': trip.pk, 'start_stop': route_stops[0].pk, 'end_stop': route_stops[1].pk, 'seats': 1}
+        booked, release = threading.Event(), threading.Event()
+        after_booking = views.after_booking
+
+        def slow_after_booking(booking):
+            # Hold the first request's transaction, and so its claim on the key,
+            # open until the duplicate has reached the unique constraint.
+            after_booking(booking)
+            booked.set()
+            release.wait(5)
+
+        responses = {}
+
+        def post(name):
+            client = APIClient()
+            client.force_authenticate(customer.user)
+            try:
+                responses[name] = client.post(reverse('book_traveller'), body, format='json', HTTP_IDEMPOTENCY_KEY='booking-1')
+            finally:
+                connection.close()
+
+        with mock.patch.object(views, 'after_booking', slow_after_booking):
+            first = threading.Thread(target=post, args=('first',))
+            first.start()
+            self.assertTrue(booked.wait(5))
+            second = threading.Thread(target=post, args=('second',))
+            second.start()
+            second.join(0.5)
+            self.assertTrue(second.is_alive(), "the duplicate should wait for the first request to commit")
+            release.set()
+            first.join(5)
+            second.join(5)
+
+        self.assertEqual(responses['first'].status_code, 201)
+        self.assertEqual(responses['second'].status_code, 201)
+        self.assertEqual(responses['second'].json(), responses['first'].json())
+        self.assertEqual(responses['second']['Idempotent-Replayed'], 'true')
+        self.assertEqual(Booking.objects.count(), 1)
+
+
+REPLICA = next(alias for alias in settings.DATABASES if alias != DEFAULT_DB_ALIAS)
+
+
+@override_settings(TASKS={'BACKEND': 'eager'}, DATABASE_REPLICAS=[REPLICA])
+class ReplicaRouterTests(TransactionTestCase):
+    # TestCase wraps every test in a transaction, which keeps all reads on the primary.
+    databases = '__all__'
+
+    def setUp(self):
+        self.customer, self.route_stops, self.trip = create_trip()
+        self.user = self.customer.user
+        cache.delete(routers._pin_key(self.user.pk))
+
+    def capture(self):
+        return CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]), CaptureQueriesContext(connections[REPLICA])
+
+    def test_reads_go_to_replica(self):
+        primary, replica = self.capture()
+        with routers.replica_reads(self.user), primary, replica:
+            list(Stop.objects.all())
+
+        self.assertEqual(len(primary), 0)
+        self.assertEqual(len(replica), 1)
+
+    def test_reads_outside_replica_views_stay_on_primary(self):
+        primary, replica = self.capture()
+        with primary, replica:
+            list(Stop.objects.all())
+
+        self.assertEqual(len(primary), 1)
+        self.assertEqual(len(replica), 0)
+
+    def test_reads_inside_atomic_stay_on_primary(self):
+        primary, replica = self.capture()
+        with routers.replica_reads(self.user), transaction.atomic(), primary, replica:
+            list(Stop.objects.all())
+
+        self.assertEqual(len(replica), 0)
+        self.assertGreater(len(primary), 0)
+
+    def test_writer_is_pinned_to_primary(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        body = {'trip': self.trip.pk, 'start_stop': self.route_stops[0].pk, 'end_stop': self.route_stops[1].pk, 'seats': 1}
+        self.assertEqual(client.post(reverse('book_traveller'), body, format='json').status_code, 201)
+        self.assertTrue(routers.is_pinned(self.user))
+
+        primary, replica = self.capture()
+        with primary, replica:
+            response = client.get(reverse('my_bookings'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(len(replica), 0)
+
+        cache.delete(routers._pin_key(self.user.pk))
+        primary, replica = self.capture()
+        with primary, replica:
+            self.assertEqual(client.get(reverse('my_bookings')).status_code, 200)
+        self.assertGreater(len(replica), 0)
+        self.assertEqual(len(primary), 0)
+
+
+def book(customer, route_stops, trip, start=0, end=2, seats=1, **fields):
+    return Booking.objects.create(
+        trip=trip, customer=customer, start_stop=route_stops[start], end_stop=route_stops[end], seats=seats, **fields,
+    )
+
+
+def create_customer(username):
+    return Customer.objects.create(user=User.objects.create_user(username, password='x'), name=username.title(), contact_number='2')
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class BookingSnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer, self.route_stops, self.trip = create_trip()
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer.user)
+
+    def test_booking_captures_fare_stops_and_times(self):
+        booking = book(self.customer, self.route_stops, self.trip, seats=2)
+
+        self.assertEqual(booking.segment_distance, 10)
+        self.assertEqual(booking.fare, Decimal('50.00'))
+        self.assertEqual(booking.start_stop_name, 'Stop 1')
+        self.assertEqual(booking.end_stop_name, 'Stop 3')
+        self.assertEqual(booking.estimated_departure, self.trip.departure_time)
+        self.assertEqual(booking.estimated_arrival, self.trip.departure_time + timedelta(minutes=20))
+
+    def test_snapshot_survives_route_edits(self):
+        booking = book(self.customer, self.route_stops, self.trip)
+        Stop.objects.filter(pk=self.route_stops[0].stop_id).update(name='Renamed')
+        RouteStop.objects.filter(pk=self.route_stops[2].pk).update(distance_from_previous_stop=50)
+
+        data = self.client.get(reverse('my_bookings')).json()[0]
+        self.assertEqual(data['id'], booking.pk)
+        self.assertEqual(data['start_stop']['name'], 'Stop 1')
+        self.assertEqual(Decimal(data['price']), Decimal('25.00'))
+
+    def test_fare_quote_prices_segments(self):
+        segments = [
+            {'trip': self.trip.pk, 'start_stop': self.route_stops[0].pk, 'end_stop': self.route_stops[2].pk, 'seats': 2},
+            {'trip': self.trip.pk, 'start_stop': self.route_stops[2].pk, 'end_stop': self.route_stops[0].pk, 'seats': 1},
+        ]
+        response = self.client.post(reverse('fare_quote'), {'segments': segments}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        quotes = response.json()['quotes']
+        self.assertEqual(quotes[0]['distance'], 10)
+        self.assertEqual(Decimal(quotes[0]['price']), Decimal('50.00'))
+        self.assertIn('error', quotes[1])
+
+
+@override_settings(TASKS={'BACKEND': 'eager'}, ADMISSION_CONTROL={})
+class JourneyPlannerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer, route_stops, self.trip = create_trip()
+        self.stops = [route_stop.stop for route_stop in route_stops]
+        # A second route from the first route's last stop, leaving after it arrives.
+        self.stops.append(Stop.objects.create(name='Stop 4'))
+        route = Route.objects.create(name='Connection')
+        self.connection_stops = [
+            RouteStop.objects.create(route=route, stop=stop, order=order, minutes_from_previous_stop=minutes, distance_from_previous_stop=minutes)
+            for order, stop, minutes in ((1, self.stops[2], 0), (2, self.stops[3], 15))
+        ]
+        self.connection = Travellor.objects.create(
+            driver=self.trip.driver, route=route, departure_time=self.trip.departure_time + timedelta(minutes=30),
+            vehicle_capacity=2, cost_per_km=Decimal('1.00'),
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer.user)
+
+    def plan(self, **params):
+        query = {
+            'start_stop_id': self.stops[0].pk, 'end_stop_id': self.stops[3].pk,
+            'date': timezone.localdate(self.trip.departure_time).isoformat(), **params,
+        }
+        response = self.client.get(reverse('journey_planner'), query)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_transfer_between_routes(self):
+        itineraries = self.plan()
+
+        self.assertEqual(len(itineraries), 1)
+        self.assertEqual(itineraries[0]['transfers'], 1)
+        self.assertEqual([leg['trip_id'] for leg in itineraries[0]['legs']], [self.trip.pk, self.connection.pk])
+        self.assertEqual(itineraries[0]['legs'][1]['start_stop_name'], 'Stop 3')
+
+    def test_transfer_too_short_or_not_allowed(self):
+        self.assertEqual(self.plan(min_transfer_minutes=15), [])
+        self.assertEqual(self.plan(max_transfers=0), [])
+
+    def test_full_connection_is_skipped(self):
+        book(self.customer, self.connection_stops, self.connection, start=0, end=1, seats=1)
+
+        self.assertEqual(self.plan(seats=1)[0]['legs'][1]['available_seats'], 1)
+        self.assertEqual(self.plan(seats=2), [])
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class StopLookupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer, route_stops, trip = create_trip()
+        self.stops = [route_stop.stop for route_stop in route_stops]
+        for i, stop in enumerate(self.stops):
+            stop.latitude, stop.longitude = 12.97 + i * 0.01, 77.59
+            stop.save()
+        self.client = APIClient()
+
+    def test_autocomplete_ranks_prefix_matches(self):
+        response = self.client.get(reverse('stop_list'), {'q': 'stop 2'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['name'], 'Stop 2')
+        self.assertEqual(len(self.client.get(reverse('stop_list'), {'q': 'sto'}).json()), 3)
+
+    def test_autocomplete_sees_renamed_stops(self):
+        self.client.get(reverse('stop_list'), {'q': 'stop'})
+        self.stops[0].name = 'Harbour'
+        self.stops[0].save()
+
+        self.assertEqual([stop['id'] for stop in self.client.get(reverse('stop_list'), {'q': 'harb'}).json()], [self.stops[0].pk])
+
+    def test_nearby_orders_by_distance_within_radius(self):
+        self.client.force_authenticate(self.customer.user)
+        response = self.client.get(reverse('nearby_stops'), {'lat': 12.991, 'lng': 77.59, 'radius': 1500})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([stop['id'] for stop in response.json()], [self.stops[2].pk, self.stops[1].pk])
+        self.assertLess(response.json()[0]['distance_meters'], response.json()[1]['distance_meters'])
+        self.assertEqual(self.client.get(reverse('nearby_stops'), {'lat': 12.97}).status_code, 400)
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class FeedRoundTripTests(TestCase):
+    def test_exported_feed_imports_as_the_same_network(self):
+        cache.clear()
+        customer, route_stops, trip = create_trip()
+        day = timezone.localdate(trip.departure_time)
+        feed = io.BytesIO()
+        FeedExporter(day, day).write(feed)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            summary = FeedImporter(driver=trip.driver).run(open_zip(feed))
+
+        self.assertEqual(summary['stops_created'], 3)
+        self.assertEqual(summary['routes_created'], 1)
+        self.assertEqual(summary['trips_created'], 1)
+        imported = Route.objects.get(code=str(trip.route_id))
+        self.assertEqual(
+            list(RouteStop.objects.filter(route=imported).order_by('order').values_list('stop__name', 'minutes_from_previous_stop', 'distance_from_previous_stop')),
+            [('Stop 1', 0, 0), ('Stop 2', 10, 5), ('Stop 3', 10, 5)],
+        )
+        copy = Travellor.objects.get(route=imported)
+        self.assertEqual(copy.departure_time, trip.departure_time.replace(second=0, microsecond=0))
+        self.assertEqual((copy.vehicle_capacity, copy.cost_per_km), (4, Decimal('2.50')))
+
+    def test_invalid_feed_writes_nothing(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as feed:
+            feed.writestr('stops.txt', 'stop_id,stop_name\nA,Alpha\n')
+            feed.writestr('routes.txt', 'route_id,route_long_name\nR,Route\n')
+            feed.writestr('stop_times.txt', 'route_id,stop_id,stop_sequence,minutes_from_previous_stop,distance_from_previous_stop\nR,A,1,0,0\nR,B,2,5,5\n')
+
+        with self.assertRaises(ValidationError):
+            FeedImporter().run(open_zip(archive))
+        self.assertFalse(Stop.objects.exists())
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class ExportTests(TestCase):
+    def setUp(self):
+        self.customer, route_stops, self.trip = create_trip()
+        book(self.customer, route_stops, self.trip, seats=2)
+        self.client.force_login(self.trip.driver)
+
+    def test_csv_streams_booking_rows(self):
+        response = self.client.get(reverse('export_vendor_bookings'))
+
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(',')[0], 'Booking ID')
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Stop 1,Stop 3,2,50.00,Confirmed', lines[1])
+
+    def test_xlsx_needs_a_short_range(self):
+        day = timezone.localdate(self.trip.departure_time).isoformat()
+        self.assertEqual(self.client.get(reverse('export_vendor_bookings'), {'format': 'xlsx'}).status_code, 400)
+
+        response = self.client.get(reverse('export_vendor_bookings'), {'format': 'xlsx', 'from': day, 'to': day})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'PK'))
+
+    def test_customers_cannot_export(self):
+        self.client.force_login(self.customer.user)
+        self.assertEqual(self.client.get(reverse('export_vendor_bookings')).status_code, 403)
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class VendorAnalyticsTests(TestCase):
+    def setUp(self):
+        self.customer, self.route_stops, self.trip = create_trip()
+        self.bookings = [
+            book(self.customer, self.route_stops, self.trip, start=0, end=2, seats=1),
+            book(self.customer, self.route_stops, self.trip, start=0, end=1, seats=2),
+        ]
+        self.day = timezone.localdate(self.trip.departure_time).isoformat()
+        self.client = APIClient()
+        self.client.force_authenticate(self.trip.driver)
+
+    def test_rollups_total_seats_and_revenue(self):
+        refresh_rollups(driver_id=self.trip.driver_id)
+        totals = self.client.get(reverse('analytics'), {'from': self.day, 'to': self.day}).json()['totals']
+
+        self.assertEqual((totals['trips'], totals['bookings'], totals['seats_sold']), (1, 2, 3))
+        self.assertEqual(totals['seat_km_sold'], 20)
+        self.assertEqual(totals['capacity_km'], 40)
+        self.assertEqual(Decimal(totals['revenue']), Decimal('50.00'))
+        self.assertEqual(totals['load_factor'], 0.5)
+
+    def test_rollups_follow_cancellations(self):
+        refresh_rollups(driver_id=self.trip.driver_id)
+        self.bookings[1].status = 'CANCELLED'
+        self.bookings[1].save()
+        refresh_rollups(driver_id=self.trip.driver_id)
+
+        self.assertEqual(RouteDailyStats.objects.get().seats_sold, 1)
+
+    def test_occupancy_matrix(self):
+        response = self.client.get(reverse('route_occupancy', args=[self.trip.route_id]), {'from': self.day, 'to': self.day})
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['legs'], [['Stop 1', 'Stop 2'], ['Stop 2', 'Stop 3']])
+        self.assertEqual(data['trip_ids'], [self.trip.pk])
+        self.assertEqual(data['matrix'], [[3, 1]])
+        self.assertEqual(data['summary']['busiest_leg'], 0)
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class WaitlistTests(TestCase):
+    def setUp(self):
+        self.customer, self.route_stops, self.trip = create_trip()
+        self.other = create_customer('other')
+        self.body = {'trip': self.trip.pk, 'start_stop': self.route_stops[0].pk, 'end_stop': self.route_stops[1].pk, 'seats': 2}
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer.user)
+
+    def test_cannot_wait_for_free_seats(self):
+        self.assertEqual(self.client.post(reverse('waitlist'), self.body, format='json').status_code, 400)
+
+    def test_cancellation_promotes_waiting_customer(self):
+        full = book(self.other, self.route_stops, self.trip, seats=4)
+        response = self.client.post(reverse('waitlist'), self.body, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        self.client.force_authenticate(self.other.user)
+        response = self.client.post(reverse('cancel_booking', args=[full.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'CANCELLED')
+        entry = WaitlistEntry.objects.get()
+        self.assertEqual(entry.status, 'PROMOTED')
+        self.assertEqual((entry.booking.customer, entry.booking.seats), (self.customer, 2))
+
+    def test_entries_that_still_do_not_fit_keep_waiting(self):
+        book(self.other, self.route_stops, self.trip, seats=3)
+        cancelled = book(self.other, self.route_stops, self.trip, seats=1)
+        self.client.post(reverse('waitlist'), self.body, format='json')
+
+        self.client.force_authenticate(self.other.user)
+        self.client.post(reverse('cancel_booking', args=[cancelled.pk]))
+
+        self.assertEqual(WaitlistEntry.objects.get().status, 'WAITING')
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class RecurringBookingTests(TestCase):
+    def setUp(self):
+        self.customer, self.route_stops, self.trip = create_trip()
+        self.next_trip = Travellor.objects.create(
+            driver=self.trip.driver, route=self.trip.route, departure_time=self.trip.departure_time + timedelta(days=1),
+            vehicle_capacity=2, cost_per_km=Decimal('2.50'),
+        )
+        self.first_day = timezone.localdate(self.trip.departure_time)
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer.user)
+
+    def book_recurring(self, seats=1):
+        body = {
+            'route': self.trip.route_id, 'start_stop': self.route_stops[0].pk, 'end_stop': self.route_stops[2].pk,
+            'departure_time': timezone.localtime(self.trip.departure_time).strftime('%H:%M'),
+            'start_date': self.first_day.isoformat(), 'end_date': (self.first_day + timedelta(days=2)).isoformat(),
+            'seats': seats, 'weekdays': list(range(7)),
+        }
+        return self.client.post(reverse('recurring_bookings'), body, format='json')
+
+    def test_books_every_day_with_a_trip(self):
+        response = self.book_recurring()
+
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual([item['trip_id'] for item in data['booked']], [self.trip.pk, self.next_trip.pk])
+        self.assertEqual(data['no_trip'], [(self.first_day + timedelta(days=2)).isoformat()])
+        self.assertEqual(Booking.objects.filter(customer=self.customer).count(), 2)
+        self.assertEqual(Booking.objects.get(trip=self.next_trip).fare, Decimal('25.00'))
+
+    def test_full_days_are_reported(self):
+        response = self.book_recurring(seats=3)
+
+        self.assertEqual([item['trip_id'] for item in response.json()['booked']], [self.trip.pk])
+        self.assertEqual(response.json()['full'], [(self.first_day + timedelta(days=1)).isoformat()])
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class SeatHoldTests(TestCase):
+    def setUp(self):
+        self.customer, self.route_stops, self.trip = create_trip()
+        self.body = {'trip': self.trip.pk, 'start_stop': self.route_stops[0].pk, 'end_stop': self.route_stops[2].pk, 'seats': 3}
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer.user)
+
+    def hold(self, **body):
+        return self.client.post(reverse('seat_holds'), {**self.body, **body}, format='json')
+
+    def test_held_seats_are_not_sold_twice(self):
+        self.assertEqual(self.hold().status_code, 201)
+
+        self.assertEqual(self.hold(seats=2).status_code, 409)
+        response = self.client.post(reverse('book_traveller'), {**self.body, 'seats': 2}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_confirm_turns_hold_into_booking(self):
+        hold_id = self.hold().json()['id']
+        response = self.client.post(reverse('confirm_seat_hold', args=[hold_id]))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Booking.objects.get().seats, 3)
+        self.assertFalse(SeatHold.objects.exists())
+
+    def test_expired_hold_frees_seats_and_cannot_be_confirmed(self):
+        hold_id = self.hold().json()['id']
+        SeatHold.objects.filter(pk=hold_id).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(self.client.post(reverse('confirm_seat_hold', args=[hold_id])).status_code, 410)
+        self.assertEqual(self.hold(seats=4).status_code, 201)
+
+    def test_release(self):
+        hold_id = self.hold().json()['id']
+
+        self.assertEqual(self.client.delete(reverse('seat_hold', args=[hold_id])).status_code, 204)
+        self.assertFalse(SeatHold.objects.exists())
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class AdmissionControlTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer, route_stops, self.trip = create_trip()
+        self.query = {'start_stop_id': route_stops[0].stop_id, 'end_stop_id': route_stops[2].stop_id}
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer.user)
+
+    def search(self):
+        return self.client.get(reverse('search_travellers'), self.query)
+
+    @override_settings(ADMISSION_CONTROL={'search': {'user_rate': 0.01, 'user_burst': 2}})
+    def test_user_over_burst_gets_429(self):
+        self.assertEqual([self.search().status_code for _ in range(2)], [200, 200])
+
+        response = self.search()
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+        other = create_customer('other')
+        self.client.force_authenticate(other.user)
+        self.assertEqual(self.search().status_code, 200)
+
+    @override_settings(ADMISSION_CONTROL={'search': {'global_rate': 0.01, 'global_burst': 1}})
+    def test_global_limit_sheds_with_503(self):
+        self.assertEqual(self.search().status_code, 200)
+
+        response = self.search()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+    @override_settings(ADMISSION_CONTROL={'search': {'max_concurrent': 1}})
+    def test_slot_is_released_after_each_request(self):
+        self.assertEqual([self.search().status_code for _ in range(3)], [200, 200, 200])
+        with mock.patch.object(ConcurrencySlots, 'acquire', return_value=None):
+            self.assertEqual(self.search().status_code, 503)
+
+    def test_concurrency_slots(self):
+        slots = ConcurrencySlots('test', limit=1)
+        token = slots.acquire()
+
+        self.assertIsNotNone(token)
+        self.assertIsNone(slots.acquire())
+        slots.release(token)
+        self.assertIsNotNone(slots.acquire())
+
+
+@override_settings(TASKS={'BACKEND': 'eager'}, ADMISSION_CONTROL={})
+class WindowSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer, self.route_stops, self.trip = create_trip()
+        self.later = [
+            Travellor.objects.create(
+                driver=self.trip.driver, route=self.trip.route, departure_time=self.trip.departure_time + timedelta(days=days),
+                vehicle_capacity=4, cost_per_km=cost,
+            )
+            for days, cost in ((1, Decimal('1.00')), (2, Decimal('2.00')))
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer.user)
+
+    def search(self, **params):
+        first_day = timezone.localdate(self.trip.departure_time)
+        query = {
+            'start_stop_id': self.route_stops[0].stop_id, 'end_stop_id': self.route_stops[2].stop_id,
+            'date_from': first_day.isoformat(), 'date_to': (first_day + timedelta(days=3)).isoformat(), **params,
+        }
+        response = self.client.get(reverse('search_travellers'), query)
+        self.assertEqual(response.status_code, 200)
+        return [trip['id'] for trip in response.json()]
+
+    def test_ranking_and_limit(self):
+        self.assertEqual(self.search(), [self.trip.pk, self.later[0].pk, self.later[1].pk])
+        self.assertEqual(self.search(sort='cheapest'), [self.later[0].pk, self.later[1].pk, self.trip.pk])
+        self.assertEqual(self.search(limit=1), [self.trip.pk])
+
+    def test_full_trips_are_left_out(self):
+        book(self.customer, self.route_stops, self.later[0], start=1, end=2, seats=3)
+
+        self.assertEqual(self.search(seats=2), [self.trip.pk, self.later[1].pk])
+        self.assertEqual(self.search(sort='seats')[-1], self.later[0].pk)
+
+    def test_window_is_bounded(self):
+        response = self.client.get(reverse('search_travellers'), {
+            'start_stop_id': self.route_stops[0].stop_id, 'end_stop_id': self.route_stops[2].stop_id,
+            'date_from': timezone.localdate().isoformat(), 'date_to': (timezone.localdate() + timedelta(days=40)).isoformat(),
+        })
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class SeatMapTests(TestCase):
+    def setUp(self):
+        self.customer, self.route_stops, self.trip = create_trip()
+        self.trip.assign_seats = True
+        self.trip.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer.user)
+
+    def book(self, start, end, seat_numbers):
+        body = {
+            'trip': self.trip.pk, 'start_stop': self.route_stops[start].pk, 'end_stop': self.route_stops[end].pk,
+            'seats': len(seat_numbers), 'seat_numbers': seat_numbers,
+        }
+        return self.client.post(reverse('book_traveller'), body, format='json')
+
+    def test_seats_are_reused_on_disjoint_legs(self):
+        self.assertEqual(self.book(0, 1, [2]).status_code, 201)
+        self.assertEqual(self.book(1, 2, [2]).status_code, 201)
+        self.assertEqual(self.book(0, 2, [2]).status_code, 400)
+
+        data = self.client.get(reverse('trip_seat_map', args=[self.trip.pk])).json()
+        self.assertEqual([leg['occupied_seats'] for leg in data['legs']], [[2], [2]])
+        self.assertEqual(data['free_seats'], [1, 3, 4])
+
+    def test_unnumbered_bookings_get_lowest_free_seats_and_cancelling_frees_them(self):
+        self.book(0, 2, [1])
+        booking = book(self.customer, self.route_stops, self.trip, seats=2)
+        self.assertEqual(booking.seat_numbers, [2, 3])
+
+        self.client.post(reverse('cancel_booking', args=[booking.pk]))
+        data = self.client.get(reverse('trip_seat_map', args=[self.trip.pk])).json()
+        self.assertEqual(data['free_seats'], [2, 3, 4])
+
+    def test_trips_without_seat_numbers_have_no_map(self):
+        self.trip.assign_seats = False
+        self.trip.save()
+        self.assertEqual(self.client.get(reverse('trip_seat_map', args=[self.trip.pk])).status_code, 404)
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class TripPositionTests(TestCase):
+    def setUp(self):
+        self.customer, self.route_stops, self.trip = create_trip()
+        self.client = APIClient()
+        self.client.force_authenticate(self.trip.driver)
+
+    def ping(self, minutes_ago, latitude, **fields):
+        body = {
+            'trip': self.trip.pk, 'latitude': latitude, 'longitude': 77.59,
+            'recorded_at': (timezone.now() - timedelta(minutes=minutes_ago)).isoformat(), **fields,
+        }
+        return self.client.post(reverse('trip_positions'), body, format='json')
+
+    def test_only_the_trips_driver_may_report(self):
+        other = User.objects.create_user('driver', password='x')
+        Vendor.objects.create(user=other, company_name='Other')
+        self.client.force_authenticate(other)
+
+        self.assertEqual(self.ping(0, 12.9).status_code, 403)
+        self.client.force_authenticate(self.customer.user)
+        self.assertEqual(self.ping(0, 12.9).status_code, 403)
+        self.client.force_authenticate(self.trip.driver)
+        self.assertEqual(self.client.post(reverse('trip_positions'), {'trip': 0, 'latitude': 1, 'longitude': 1}, format='json').status_code, 400)
+        self.assertEqual(self.client.post(reverse('trip_positions'), {'trip': self.trip.pk + 1, 'latitude': 1, 'longitude': 1}, format='json').status_code, 404)
+
+    def test_newest_ping_wins(self):
+        self.assertEqual(self.ping(1, 12.91).status_code, 202)
+        self.ping(3, 12.93)
+        self.assertEqual(tracking.flush(), 1)
+        self.assertEqual(TripPosition.objects.get().latitude, 12.91)
+
+        # A late flush of an older ping does not move the trip back.
+        self.ping(2, 12.92)
+        self.assertEqual(tracking.flush(), 0)
+        self.assertEqual(TripPosition.objects.get().latitude, 12.91)
+
+        self.ping(0, 12.90)
+        tracking.flush()
+        self.assertEqual(TripPosition.objects.get().latitude, 12.90)
+
+
+@override_settings(TASKS={'BACKEND': 'eager'})
+class ConditionalRequestTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer, self.route_stops, self.trip = create_trip()
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer.user)
+
+    def test_my_bookings_revalidates_until_a_booking_changes(self):
+        first = self.client.get(reverse('my_bookings'))
+        self.assertIn('ETag', first)
+        self.assertIn('private', first['Cache-Control'])
+
+        self.assertEqual(self.client.get(reverse('my_bookings'), HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            book(self.customer, self.route_stops, self.trip)
+        response = self.client.get(reverse('my_bookings'), HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+
+    def test_public_stop_search_is_shared(self):
+        client = APIClient()
+        first = client.get(reverse('stop_list'), {'q': 'stop'})
+        self.assertIn('public', first['Cache-Control'])
+
+        self.assertEqual(client.get(reverse('stop_list'), {'q': 'stop'}, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+        Stop.objects.create(name='Stop 4')
+        self.assertEqual(client.get(reverse('stop_list'), {'q': 'stop'}, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200)
+
+    def test_route_detail_changes_with_its_stops(self):
+        url = reverse('route_detail', args=[self.trip.route_id])
+        etag = self.client.get(url)['ETag']
+        self.route_stops[1].minutes_from_previous_stop = 12
+        self.route_stops[1].save()
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+@override_settings(TASKS={'BACKEND': 'eager'}, ADMISSION_CONTROL={})
+class SparseFieldsetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer, self.route_stops, self.trip = create_trip()
+        book(self.customer, self.route_stops, self.trip)
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer.user)
+
+    def test_fields_limits_the_response(self):
+        data = self.client.get(reverse('my_bookings'), {'fields': 'id,status'}).json()
+
+        self.assertEqual(set(data[0]), {'id', 'status'})
+
+    def test_expand_nests_related_objects(self):
+        lightest = self.client.get(reverse('my_bookings'), {'expand': ''}).json()[0]
+        expanded = self.client.get(reverse('my_bookings'), {'expand': 'trip'}).json()[0]
+        full = self.client.get(reverse('my_bookings')).json()[0]
+
+        self.assertEqual(lightest['trip'], self.trip.pk)
+        self.assertEqual(expanded['trip']['id'], self.trip.pk)
+        self.assertNotIn('route_stops', expanded['trip'])
+        self.assertEqual(len(full['trip']['route_stops']), 3)
+
+
+class MetricsEndpointTests(TestCase):
+    def test_off_without_a_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_requires_the_bearer_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'booking_rejections_total', response.content)
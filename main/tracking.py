@@ -0,0 +1,172 @@
+"""
+Driver position pings and live trip delays.
+
+Pings are buffered in process memory, keeping only the newest ping per trip,
+and flushed in batches: once the buffer holds `FLUSH_SIZE` trips or its oldest
+ping is `FLUSH_INTERVAL` seconds old, whichever comes first. A flush upserts
+every buffered trip's `TripPosition` in one statement, then works out how late
+each trip is from the stop it last reached. It writes the new delays to
+`Travellor.delay_minutes` in one more statement, so schedules apply them without
+another query.
+
+A position is only replaced by a ping recorded after it, so a late flush from
+another worker never moves a trip backwards. Workers flush what they still hold
+when they exit (the `worker_exit` hook in gunicorn.conf.py, and `atexit`); one
+that is killed outright loses at most `FLUSH_INTERVAL` seconds of pings, which
+the driver's next ping replaces anyway.
+"""
+import atexit
+import threading
+import time
+from collections import defaultdict
+
+from django.db import connection, transaction
+
+from .models import RouteStop, Travellor, TripPosition
+from .stop_index import haversine_meters
+from .tasks import enqueue
+
+FLUSH_SIZE = 1000
+FLUSH_INTERVAL = 2.0  # seconds
+SNAP_RADIUS_METERS = 300  # pings this close to a route stop count as reaching it
+
+_buffer = {}
+_lock = threading.Lock()
+_timer = None
+_oldest = None
+
+
+def record_ping(user_id, trip_id, latitude, longitude, recorded_at, stop_order=None):
+    """Buffers a ping; older pings for the same trip are dropped."""
+    global _oldest, _timer
+    with _lock:
+        previous = _buffer.get(trip_id)
+        if previous is None or previous[3] <= recorded_at:
+            _buffer[trip_id] = (user_id, latitude, longitude, recorded_at, stop_order)
+        if _oldest is None:
+            _oldest = time.monotonic()
+            # Flush idle buffers too, not only on the next ping.
+            _timer = threading.Timer(FLUSH_INTERVAL, _flush_from_timer)
+            _timer.daemon = True
+            _timer.start()
+        due = len(_buffer) >= FLUSH_SIZE or time.monotonic() - _oldest >= FLUSH_INTERVAL
+    if due:
+        flush()
+
+
+def _flush_from_timer():
+    try:
+        flush()
+    finally:
+        # The timer thread opened its own connection; don't leave it behind.
+        connection.close()
+
+
+def flush():
+    """Writes the buffered pings. Returns the number of positions saved."""
+    global _buffer, _oldest, _timer
+    with _lock:
+        pings, _buffer, _oldest = _buffer, {}, None
+        if _timer is not None:
+            _timer.cancel()
+            _timer = None
+    if not pings:
+        return 0
+
+    trips = {
+        trip.pk: trip
+        for trip in Travellor.objects.filter(pk__in=pings).only('id', 'driver_id', 'route_id', 'departure_time', 'delay_minutes')
+    }
+    # Only the trip's own driver may move it.
+    pings = {
+        trip_id: ping for trip_id, ping in pings.items()
+        if trip_id in trips and trips[trip_id].driver_id == ping[0]
+    }
+    with transaction.atomic():
+        saved = _save_positions(pings)
+        # A ping older than the stored position says nothing new about the delay.
+        pings = {trip_id: ping for trip_id, ping in pings.items() if trip_id in saved}
+        delayed = []
+        for trip_id, delay in _delays(trips, pings).items():
+            if trips[trip_id].delay_minutes != delay:
+                trips[trip_id].delay_minutes = delay
+                delayed.append(trips[trip_id])
+        Travellor.objects.bulk_update(delayed, ['delay_minutes'])
+        if delayed:
+            # bulk_update sends no signals; customers' booking lists show the delay.
+            enqueue('bump_customer_versions', trip_ids=[trip.pk for trip in delayed])
+    return len(saved)
+
+
+def _save_positions(pings):
+    """
+    Upserts the trips' positions in one statement, keeping any stored position
+    recorded later than the ping, e.g. one flushed meanwhile by another worker.
+    Returns the ids of the trips whose position was written.
+    """
+    if not pings:
+        return set()
+    fields = [TripPosition._meta.get_field(name) for name in ('trip', 'latitude', 'longitude', 'stop_order', 'recorded_at')]
+    table = connection.ops.quote_name(TripPosition._meta.db_table)
+    columns = [connection.ops.quote_name(field.column) for field in fields]
+    rows = [
+        (trip_id, latitude, longitude, stop_order, recorded_at)
+        for trip_id, (_, latitude, longitude, recorded_at, stop_order) in pings.items()
+    ]
+    params = [field.get_db_prep_save(value, connection) for row in rows for field, value in zip(fields, row)]
+    placeholders = ', '.join(['(' + ', '.join(['%s'] * len(fields)) + ')'] * len(rows))
+    # ON CONFLICT ... WHERE is understood by both PostgreSQL and SQLite.
+    sql = (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES {placeholders} "
+        f"ON CONFLICT ({columns[0]}) DO UPDATE SET "
+        + ', '.join(f"{column} = EXCLUDED.{column}" for column in columns[1:])
+        + f" WHERE {table}.{columns[4]} < EXCLUDED.{columns[4]} RETURNING {columns[0]}"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return {row[0] for row in cursor.fetchall()}
+
+
+def _delays(trips, pings):
+    """
+    `{trip_id: minutes late}` for pings that place the trip at a stop, either by
+    `stop_order` or by being within SNAP_RADIUS_METERS of one of its route's
+    stops. Trips running early are not held back, so delays never go below zero.
+    """
+    route_ids = {trips[trip_id].route_id for trip_id in pings}
+    route_stops = defaultdict(list)
+    for route_id, order, minutes, latitude, longitude in RouteStop.objects.filter(
+        route_id__in=route_ids,
+    ).order_by('route_id', 'order').values_list(
+        'route_id', 'order', 'minutes_from_previous_stop', 'stop__latitude', 'stop__longitude',
+    ):
+        offset = route_stops[route_id][-1][1] + minutes if route_stops[route_id] else minutes
+        route_stops[route_id].append((order, offset, latitude, longitude))
+
+    delays = {}
+    for trip_id, (_, latitude, longitude, recorded_at, stop_order) in pings.items():
+        trip = trips[trip_id]
+        stops = route_stops[trip.route_id]
+        offset = next((offset for order, offset, *_ in stops if order == stop_order), None)
+        if offset is None:
+            offset = _snap(stops, latitude, longitude)
+        if offset is None:
+            continue
+        late = (recorded_at - trip.departure_time).total_seconds() / 60 - offset
+        delays[trip_id] = max(0, round(late))
+    return delays
+
+
+def _snap(stops, latitude, longitude):
+    """Offset of the nearest stop within SNAP_RADIUS_METERS of a coordinate, if any."""
+    best = None
+    for order, offset, stop_latitude, stop_longitude in stops:
+        if stop_latitude is None or stop_longitude is None:
+            continue
+        distance = haversine_meters(latitude, longitude, stop_latitude, stop_longitude)
+        if distance <= SNAP_RADIUS_METERS and (best is None or distance < best[0]):
+            best = (distance, offset)
+    return best[1] if best else None
+
+
+atexit.register(flush)
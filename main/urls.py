@@ -2,7 +2,10 @@ from django.urls import path
 from django.contrib.auth import views as auth_views
 from . import views
 from .views import GoogleLogin, BookTravellerView, SearchTravellersView, StopListView, UserBookingsView, CustomerSignupView
-from .views import CabBookingView
+from .views import CabBookingView, FareQuoteView, JourneyPlannerView, NearbyStopsView, VendorAnalyticsView
+from .views import RouteOccupancyView, CancelBookingView, WaitlistView, WaitlistEntryView
+from .views import RecurringBookingView, SeatHoldView, SeatHoldDetailView, ConfirmSeatHoldView
+from .views import AdmissionStatsView, DepartureBoardView, TripSeatMapView, TripPositionView, RouteDetailView
 from .views import manage_cars, add_car, vendor_cab_bookings, confirm_cab_booking
 
 urlpatterns = [
@@ -12,15 +15,35 @@ urlpatterns = [
     path('auth/google/', GoogleLogin.as_view(), name='google_login'),
     path('customer-signup/', CustomerSignupView.as_view(), name='customer_signup'),
     path('book-traveller/', BookTravellerView.as_view(), name='book_traveller'),
+    path('bookings/recurring/', RecurringBookingView.as_view(), name='recurring_bookings'),
+    path('trips/<int:trip_id>/seats/', TripSeatMapView.as_view(), name='trip_seat_map'),
+    path('positions/', TripPositionView.as_view(), name='trip_positions'),
+    path('holds/', SeatHoldView.as_view(), name='seat_holds'),
+    path('holds/<int:hold_id>/', SeatHoldDetailView.as_view(), name='seat_hold'),
+    path('holds/<int:hold_id>/confirm/', ConfirmSeatHoldView.as_view(), name='confirm_seat_hold'),
     path('vendor-bookings/', views.vendor_bookings_view, name='vendor_bookings'),
+    path('vendor-bookings/export/', views.export_vendor_bookings, name='export_vendor_bookings'),
+    path('vendor-analytics/', views.vendor_analytics, name='vendor_analytics'),
+    path('analytics/', VendorAnalyticsView.as_view(), name='analytics'),
     path('search-travellers/', SearchTravellersView.as_view(), name='search_travellers'),
+    path('journeys/', JourneyPlannerView.as_view(), name='journey_planner'),
+    path('admission-stats/', AdmissionStatsView.as_view(), name='admission_stats'),
+    path('gtfs/', views.gtfs_feed, name='gtfs_feed'),
+    path('metrics', views.metrics, name='metrics'),
     path('stops/', StopListView.as_view(), name='stop_list'),
+    path('stops/nearby/', NearbyStopsView.as_view(), name='nearby_stops'),
+    path('stops/<int:stop_id>/departures/', DepartureBoardView.as_view(), name='departure_board'),
+    path('fares/quote/', FareQuoteView.as_view(), name='fare_quote'),
     path('cab-bookings/', CabBookingView.as_view(), name='cab_bookings'),
     path('cars/', manage_cars, name='manage_cars'),
     path('cars/add/', add_car, name='add_car'),
     path('', vendor_cab_bookings, name='vendor_cab_bookings'),
     path('cab-bookings/<int:booking_id>/confirm/', confirm_cab_booking, name='confirm_cab_booking'),
+    path('cab-bookings/export/', views.export_vendor_cab_bookings, name='export_vendor_cab_bookings'),
     path('my-bookings/', UserBookingsView.as_view(), name='my_bookings'),
+    path('bookings/<int:booking_id>/cancel/', CancelBookingView.as_view(), name='cancel_booking'),
+    path('waitlist/', WaitlistView.as_view(), name='waitlist'),
+    path('waitlist/<int:entry_id>/', WaitlistEntryView.as_view(), name='waitlist_entry'),
 
     # Traveller (Trip) Management
     path('travellors/add/', views.add_travellor, name='add_travellor'),
@@ -30,8 +53,11 @@ urlpatterns = [
 
     # Route Management
     path('routes/add/', views.manage_route, name='manage_route'),
+    path('routes/import/', views.import_feed, name='import_feed'),
     path('routes/', views.list_routes, name='list_routes'),
+    path('routes/<int:route_id>/', RouteDetailView.as_view(), name='route_detail'),
     path('routes/<int:route_id>/edit/', views.edit_route, name='edit_route'),
+    path('routes/<int:route_id>/occupancy/', RouteOccupancyView.as_view(), name='route_occupancy'),
 
     # Stop Management
     path('stops/add/', views.create_stop, name='create_stop'),
@@ -0,0 +1,44 @@
+"""
+Version counters kept in the cache framework.
+
+Writers bump a named counter; readers compare the counter against the value they
+built their cached data from, and only rebuild what changed. Counters are seeded
+from the clock so an evicted key never reuses a version that was seen before.
+"""
+import time
+
+from django.core.cache import cache
+
+
+def _key(name):
+    return f"version:{name}"
+
+
+def _seed():
+    return int(time.time() * 1000)
+
+
+def get_version(name):
+    return get_versions([name])[name]
+
+
+def get_versions(names):
+    """Returns `{name: version}` for every name, initialising missing counters."""
+    keys = {_key(name): name for name in names}
+    found = cache.get_many(list(keys))
+    versions = {}
+    for key, name in keys.items():
+        if key not in found:
+            cache.add(key, _seed(), None)
+            found[key] = cache.get(key)
+        versions[name] = found[key]
+    return versions
+
+
+def bump_version(name):
+    key = _key(name)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, _seed(), None)
+        return cache.incr(key)
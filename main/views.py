@@ -1,21 +1,56 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse_lazy, reverse
 from django.contrib.auth.decorators import login_required
-from django.http import HttpRequest, HttpResponseForbidden
+from django.http import Http404, HttpRequest, HttpResponse, HttpResponseForbidden, HttpResponseBadRequest, StreamingHttpResponse
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
 from django.db import transaction
+from django.db.models import Prefetch, prefetch_related_objects
 from .forms import TravellorForm, RouteForm, RouteStopFormSet, StopForm
-from .forms import CarForm, CabBookingConfirmForm, BulkTravellorForm
-from .models import Route, Travellor, Stop, Booking, Customer, CabBooking
+from .forms import CarForm, CabBookingConfirmForm, BulkTravellorForm, FeedImportForm
+from .models import Route, RouteStop, Travellor, Stop, Booking, Customer, CabBooking, WaitlistEntry, SeatHold
 from .models import Car
 from .serializers import (
     BookingSerializer,
     TravellorSerializer,
-    StopSerializer,
     BookingDetailSerializer,
     CustomerSerializer,
     CabBookingSerializer,
     CabBookingDetailSerializer,
+    FareQuoteSerializer,
+    WaitlistEntrySerializer,
+    RecurringBookingSerializer,
+    SeatHoldSerializer,
+    PositionPingSerializer,
+    RouteDetailSerializer,
+    sparse_fieldset_context,
 )
+from .fares import get_route_fares, quote_fare
+from .journeys import day_bounds, get_timetable, plan_journeys, route_version_key
+from .stop_index import STOPS_VERSION_KEY, get_spatial_index, get_stop_index
+from .versioning import get_versions
+from .gtfs import FeedExporter, FeedImporter, open_zip
+from .admission import AdmissionControlMixin, stats as admission_stats
+from .conditional import conditional
+from .holds import confirm_hold, place_hold, release_hold
+from .idempotency import idempotent
+from .metrics import SEARCH_SECONDS, record_cache, render_metrics
+from .waitlist import cancel_booking, join_waitlist, lock_trip, promote_waitlist, withdraw
+from .recurring import book_recurring
+from .rollups import route_occupancy, vendor_report
+from .routers import ReplicaReadMixin, reads_from_replica
+from .seatmap import SeatMap
+from .seats import LegLoads
+from .tasks import (
+    after_booking, after_cab_booking, customer_bookings_version_key, customer_cab_bookings_version_key,
+)
+from .tracking import record_ping
+from .stop_times import SORT_KEYS as SEARCH_SORT_KEYS, departure_board, search_window
+from .exports import (
+    BOOKING_HEADERS, CAB_BOOKING_HEADERS, XLSX_MAX_DAYS, booking_rows, cab_booking_rows, csv_response, xlsx_response,
+)
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
@@ -24,12 +59,14 @@ from google.auth.transport import requests
 from django.contrib.auth.models import User
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.conf import settings
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from django.core.exceptions import ValidationError  
 from rest_framework.permissions import IsAuthenticated
 from django.core.exceptions import ValidationError
 from datetime import datetime, timedelta
 import calendar
+import hmac
+import zipfile
 
 # --- Stop Management ---
 
@@ -71,14 +108,46 @@ def add_travellor(request):
     return render(request, 'main/add_travellor.html', {'form': form})
 
 
+def _prepare_stop_strips(fragment_name, routes):
+    """
+    Tags each route with `stops_version`, which its cached stop-strip fragment is
+    keyed on, and prefetches ordered stops only for routes whose fragment is not
+    cached yet, so rendering costs the same number of queries however many rows.
+    """
+    versions = get_versions([STOPS_VERSION_KEY] + [route_version_key(route.id) for route in routes])
+    keyed = []
+    for route in routes:
+        route.stops_version = f"{versions[route_version_key(route.id)]}-{versions[STOPS_VERSION_KEY]}"
+        keyed.append((make_template_fragment_key(fragment_name, [route.id, route.stops_version]), route))
+    cached = cache.get_many({key for key, _ in keyed})
+    record_cache(fragment_name, hits=len(cached), misses=len(keyed) - len(cached))
+    prefetch_related_objects(
+        [route for key, route in keyed if key not in cached],
+        Prefetch('routestop_set', queryset=RouteStop.objects.select_related('stop').order_by('order')),
+    )
+
+
+def _prefetch_route_stops(trips):
+    """Loads the ordered stops of every trip's route in one query, for `Travellor.get_route_stops`."""
+    prefetch_related_objects(
+        [trip.route for trip in trips],
+        Prefetch(
+            'routestop_set', queryset=RouteStop.objects.select_related('stop').order_by('order'),
+            to_attr='ordered_route_stops',
+        ),
+    )
+
+
 @login_required
+@reads_from_replica
 def list_travellors(request):
     """View for a vendor to see all their created trips."""
     if not hasattr(request.user, 'vendor_profile'):
         return HttpResponseForbidden("You do not have permission to view this page.")
     
     # Filter trips to show only those created by the currently logged-in user
-    travellors = Travellor.objects.filter(driver=request.user).order_by('-departure_time')
+    travellors = list(Travellor.objects.filter(driver=request.user).select_related('route').order_by('-departure_time'))
+    _prepare_stop_strips('trip_route_stops', [travellor.route for travellor in travellors])
     return render(request, 'main/list_travellors.html', {'travellors': travellors})
 
 
@@ -94,7 +163,11 @@ def edit_travellor(request, travellor_id):
     if request.method == 'POST':
         form = TravellorForm(request.POST, instance=travellor)
         if form.is_valid():
-            form.save()
+            with transaction.atomic():
+                lock_trip(travellor.pk)
+                travellor = form.save()
+                # A larger vehicle may make room for waiting customers.
+                promote_waitlist(travellor)
             return redirect('list_travellors')
     else:
         form = TravellorForm(instance=travellor)
@@ -176,11 +249,37 @@ def manage_route(request):
 
 
 @login_required
+def import_feed(request):
+    """View for a vendor to upload a GTFS-style feed of stops, routes and trips."""
+    if not hasattr(request.user, 'vendor_profile'):
+        return HttpResponseForbidden("You do not have permission to import routes.")
+
+    errors = []
+    summary = None
+    if request.method == 'POST':
+        form = FeedImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            try:
+                summary = FeedImporter(driver=request.user).run(open_zip(form.cleaned_data['feed']))
+                form = FeedImportForm()
+            except zipfile.BadZipFile:
+                errors = ["The uploaded file is not a zip archive."]
+            except ValidationError as e:
+                errors = e.messages
+    else:
+        form = FeedImportForm()
+
+    return render(request, 'main/import_feed.html', {'form': form, 'errors': errors, 'summary': summary})
+
+
+@login_required
+@reads_from_replica
 def list_routes(request):
     """View for a vendor to see all available routes in the system."""
     if not hasattr(request.user, 'vendor_profile'):
         return HttpResponseForbidden("You do not have permission to view routes.")
-    routes = Route.objects.all().order_by('name')
+    routes = list(Route.objects.all().order_by('name'))
+    _prepare_stop_strips('route_stops', routes)
     return render(request, 'main/list_routes.html', {'routes': routes})
 
 
@@ -247,31 +346,177 @@ class CustomerSignupView(APIView):
 class BookTravellerView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @idempotent('book-traveller')
     def post(self, request):
         customer = get_object_or_404(Customer, user=request.user)
         serializer = BookingSerializer(data=request.data)
         if serializer.is_valid():
             try:
                 with transaction.atomic():
+                    lock_trip(serializer.validated_data['trip'].pk)
                     booking = serializer.save(customer=customer)
+                    after_booking(booking)
                     return Response(BookingSerializer(booking).data, status=status.HTTP_201_CREATED)
             except ValidationError as e:
                 return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class StopListView(APIView):
+class SeatHoldView(APIView):
+    """Holds seats on a segment for the length of checkout."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        customer = get_object_or_404(Customer, user=request.user)
+        serializer = SeatHoldSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            hold = place_hold(customer, **serializer.validated_data)
+        except ValidationError as e:
+            return Response({"error": e.messages[0]}, status=status.HTTP_409_CONFLICT)
+        return Response(SeatHoldSerializer(hold).data, status=status.HTTP_201_CREATED)
+
+
+class SeatHoldDetailView(APIView):
+    """Releases a hold the customer no longer needs."""
+    permission_classes = [IsAuthenticated]
+
+    def delete(self, request, hold_id):
+        customer = get_object_or_404(Customer, user=request.user)
+        hold = get_object_or_404(SeatHold, pk=hold_id, customer=customer)
+        release_hold(hold)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ConfirmSeatHoldView(APIView):
+    """Converts a live hold into a booking."""
     permission_classes = [IsAuthenticated]
+
+    @idempotent('confirm-hold')
+    def post(self, request, hold_id):
+        customer = get_object_or_404(Customer, user=request.user)
+        hold = get_object_or_404(SeatHold, pk=hold_id, customer=customer)
+        try:
+            booking = confirm_hold(hold)
+        except ValidationError as e:
+            return Response({"error": e.messages[0]}, status=status.HTTP_410_GONE)
+        after_booking(booking)
+        return Response(BookingSerializer(booking).data, status=status.HTTP_201_CREATED)
+
+
+class RecurringBookingView(APIView):
+    """Books the same segment on a daily departure across a date range in one transaction."""
+    permission_classes = [IsAuthenticated]
+
+    @idempotent('recurring-bookings')
+    def post(self, request):
+        customer = get_object_or_404(Customer, user=request.user)
+        serializer = RecurringBookingSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        result = book_recurring(customer, **serializer.validated_data)
+        response_status = status.HTTP_201_CREATED if result['booked'] else status.HTTP_200_OK
+        return Response(result, status=response_status)
+
+
+def _customer_id(request):
+    """The requesting user's customer id, looked up once per request."""
+    if not hasattr(request, '_customer_pk'):
+        request._customer_pk = Customer.objects.filter(user=request.user).values_list('pk', flat=True).first()
+    if request._customer_pk is None:
+        raise Http404("No Customer matches the given query.")
+    return request._customer_pk
+
+
+class StopListView(ReplicaReadMixin, APIView):
+    """Ranked stop autocomplete served from the in-memory stop index."""
+    # Public like the GTFS feed, so shared caches can serve one copy to everyone.
+    permission_classes = [AllowAny]
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 50
+
+    @conditional(lambda request: [STOPS_VERSION_KEY], public=True)
     def get(self, request):
-        stops = Stop.objects.all()
-        serializer = StopSerializer(stops, many=True)
-        return Response(serializer.data)
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({"error": "A search term 'q' is required."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(int(request.query_params.get('limit', self.DEFAULT_LIMIT)), self.MAX_LIMIT)
+        except ValueError:
+            return Response({"error": "limit must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(get_stop_index().search(query, limit=max(limit, 1)))
+
+
+class RouteDetailView(APIView):
+    """A route with its stops in order."""
+    permission_classes = [AllowAny]
+
+    @conditional(lambda request, route_id: [route_version_key(route_id), STOPS_VERSION_KEY], public=True)
+    def get(self, request, route_id):
+        route = get_object_or_404(Route, pk=route_id)
+        return Response(RouteDetailSerializer(route).data)
+
+
+class NearbyStopsView(APIView):
+    """Nearest stops to a coordinate, optionally limited to a radius in meters."""
+    permission_classes = [IsAuthenticated]
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 50
+
+    def get(self, request):
+        try:
+            latitude = float(request.query_params['lat'])
+            longitude = float(request.query_params['lng'])
+            limit = min(int(request.query_params.get('limit', self.DEFAULT_LIMIT)), self.MAX_LIMIT)
+            radius = request.query_params.get('radius')
+            radius = float(radius) if radius is not None else None
+        except KeyError:
+            return Response({"error": "Both lat and lng are required."}, status=status.HTTP_400_BAD_REQUEST)
+        except ValueError:
+            return Response({"error": "lat, lng and radius must be numbers and limit an integer."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            return Response({"error": "Coordinates are out of range."}, status=status.HTTP_400_BAD_REQUEST)
+
+        stops = get_spatial_index().nearest(latitude, longitude, limit=max(limit, 1), radius_meters=radius)
+        return Response(stops)
+
+
+class DepartureBoardView(APIView):
+    """Next departures from a stop with seats left, read from the materialized stop times."""
+    permission_classes = [IsAuthenticated]
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 50
+
+    def get(self, request, stop_id):
+        stop = get_object_or_404(Stop, pk=stop_id)
+        try:
+            limit = min(int(request.query_params.get('limit', self.DEFAULT_LIMIT)), self.MAX_LIMIT)
+            seats = int(request.query_params.get('seats', 1))
+        except ValueError:
+            return Response({"error": "limit and seats must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+        if seats < 1:
+            return Response({"error": "seats must be >= 1."}, status=status.HTTP_400_BAD_REQUEST)
+
+        after = timezone.now()
+        if 'after' in request.query_params:
+            after = parse_datetime(request.query_params['after'])
+            if after is None:
+                return Response({"error": "Invalid after. Use an ISO 8601 date and time."}, status=status.HTTP_400_BAD_REQUEST)
+            if timezone.is_naive(after):
+                after = timezone.make_aware(after)
+
+        departures = departure_board(stop.pk, after, max(limit, 1), seats=seats)
+        return Response({'stop_id': stop.pk, 'stop_name': stop.name, 'departures': departures})
 
 
 class CabBookingView(APIView):
     """Create a new cab booking (POST) and list user's cab bookings (GET)."""
     permission_classes = [IsAuthenticated]
 
+    @idempotent('cab-bookings')
     def post(self, request):
         # Create a cab booking; operation must be atomic to avoid double-booking issues
         customer = get_object_or_404(Customer, user=request.user)
@@ -281,16 +526,21 @@ class CabBookingView(APIView):
                 with transaction.atomic():
                     # serializer.create expects customer passed via kwargs
                     cab_booking = serializer.create(serializer.validated_data, customer=customer)
+                    after_cab_booking(cab_booking)
                     return Response(CabBookingDetailSerializer(cab_booking).data, status=status.HTTP_201_CREATED)
             except Exception as e:
                 return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @conditional(lambda request: [customer_cab_bookings_version_key(_customer_id(request))])
     def get(self, request):
         # List current user's cab bookings
-        customer = get_object_or_404(Customer, user=request.user)
-        bookings = CabBooking.objects.filter(customer=customer).order_by('-booking_time')
-        serializer = CabBookingDetailSerializer(bookings, many=True)
+        bookings = (
+            CabBooking.objects.filter(customer_id=_customer_id(request))
+            .select_related('customer', 'car')
+            .order_by('-booking_time')
+        )
+        serializer = CabBookingDetailSerializer(bookings, many=True, context=sparse_fieldset_context(request.query_params))
         return Response(serializer.data)
 
 
@@ -321,13 +571,14 @@ def add_car(request):
 
 
 @login_required
+@reads_from_replica
 def vendor_cab_bookings(request):
     """Server-rendered page showing cab bookings for vendors to review and confirm."""
     if not hasattr(request.user, 'vendor_profile'):
         return HttpResponseForbidden("You do not have permission to view this page.")
 
     # For now, show all unconfirmed/booked cab bookings so vendor can assign cars/drivers
-    bookings = CabBooking.objects.filter().order_by('pickup_time')
+    bookings = CabBooking.objects.select_related('customer').order_by('pickup_time')
     return render(request, 'main/vendor_cab_bookings.html', {'bookings': bookings})
 
 
@@ -342,9 +593,11 @@ def confirm_cab_booking(request, booking_id):
     if request.method == 'POST':
         form = CabBookingConfirmForm(request.POST, instance=booking)
         if form.is_valid():
-            form.save()
-            booking.status = 'CONFIRMED'
-            booking.save()
+            with transaction.atomic():
+                form.save()
+                booking.status = 'CONFIRMED'
+                booking.save()
+                after_cab_booking(booking)
             return redirect('vendor_cab_bookings')
     else:
         form = CabBookingConfirmForm(instance=booking)
@@ -353,24 +606,220 @@ def confirm_cab_booking(request, booking_id):
 
 
 @login_required
+@reads_from_replica
 def vendor_bookings_view(request):
     if not hasattr(request.user, 'vendor_profile'):
         return HttpResponseForbidden("You do not have permission to view this page.")
     
-    bookings = Booking.objects.filter(trip__driver=request.user).order_by('-booking_time')
+    bookings = Booking.objects.filter(trip__driver=request.user).select_related(
+        'trip__route', 'trip__driver', 'customer', 'start_stop__stop', 'end_stop__stop',
+    ).order_by('-booking_time')
     return render(request, 'main/vendor_bookings.html', {'bookings': bookings})
 
 
-class SearchTravellersView(APIView):
+def _export_date_range(request):
+    """Parses the optional `from`/`to` (YYYY-MM-DD) query parameters into an aware datetime range."""
+    bounds = []
+    for param in ('from', 'to'):
+        value = request.GET.get(param)
+        if value:
+            day = datetime.strptime(value, '%Y-%m-%d').date()
+            if param == 'to':
+                day += timedelta(days=1)
+            value = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+        bounds.append(value)
+    return bounds
+
+
+def _export_response(request, filename, headers, rows, title, start, end):
+    if request.GET.get('format', 'csv') == 'xlsx':
+        if not (start and end) or (end - start).days > XLSX_MAX_DAYS:
+            return HttpResponseBadRequest(
+                f"Excel exports need a from/to range of at most {XLSX_MAX_DAYS} days. Use CSV for larger exports."
+            )
+        return xlsx_response(filename, headers, rows, title)
+    return csv_response(filename, headers, rows)
+
+
+@login_required
+def export_vendor_bookings(request):
+    """Streams the vendor's trip bookings, filtered by trip departure date, as CSV or XLSX."""
+    if not hasattr(request.user, 'vendor_profile'):
+        return HttpResponseForbidden("You do not have permission to export bookings.")
+    try:
+        start, end = _export_date_range(request)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid date format. Use YYYY-MM-DD.")
+
+    bookings = Booking.objects.filter(trip__driver=request.user).order_by('trip__departure_time', 'id')
+    if start:
+        bookings = bookings.filter(trip__departure_time__gte=start)
+    if end:
+        bookings = bookings.filter(trip__departure_time__lt=end)
+    return _export_response(request, 'bookings', BOOKING_HEADERS, booking_rows(bookings), 'Bookings', start, end)
+
+
+@login_required
+def export_vendor_cab_bookings(request):
+    """Streams cab bookings, filtered by pickup date, as CSV or XLSX."""
+    if not hasattr(request.user, 'vendor_profile'):
+        return HttpResponseForbidden("You do not have permission to export bookings.")
+    try:
+        start, end = _export_date_range(request)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid date format. Use YYYY-MM-DD.")
+
+    cab_bookings = CabBooking.objects.order_by('pickup_time', 'id')
+    if start:
+        cab_bookings = cab_bookings.filter(pickup_time__gte=start)
+    if end:
+        cab_bookings = cab_bookings.filter(pickup_time__lt=end)
+    return _export_response(request, 'cab_bookings', CAB_BOOKING_HEADERS, cab_booking_rows(cab_bookings), 'Cab Bookings', start, end)
+
+
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_MAX_DAYS = 366
+
+
+def _analytics_range(params):
+    """Parses `from`/`to` (YYYY-MM-DD, inclusive); defaults to the last 30 days. Raises ValueError."""
+    end = datetime.strptime(params['to'], '%Y-%m-%d').date() if params.get('to') else timezone.localdate()
+    start = datetime.strptime(params['from'], '%Y-%m-%d').date() if params.get('from') else end - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    if end < start or (end - start).days >= ANALYTICS_MAX_DAYS:
+        raise ValueError(f"The date range must cover 1 to {ANALYTICS_MAX_DAYS} days.")
+    return start, end
+
+
+@login_required
+def vendor_analytics(request):
+    """Load factor and revenue for the vendor's routes, read from the daily rollups."""
+    if not hasattr(request.user, 'vendor_profile'):
+        return HttpResponseForbidden("You do not have permission to view this page.")
+    try:
+        start, end = _analytics_range(request.GET)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid date range. Use YYYY-MM-DD, at most a year apart.")
+
+    return render(request, 'main/vendor_analytics.html', {'report': vendor_report(request.user.id, start, end)})
+
+
+GTFS_FEED_MAX_DAYS = 31
+
+
+def metrics(request):
+    """
+    Prometheus metrics, summed over every worker. Not routed through nginx;
+    scrape the app directly with `Authorization: Bearer <METRICS_TOKEN>`.
+    Without a METRICS_TOKEN the endpoint is off.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not token:
+        raise Http404()
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return HttpResponseForbidden()
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)
+
+
+def gtfs_feed(request):
+    """Streams the public GTFS timetable feed for a date range (default: the next 7 days)."""
+    try:
+        start = datetime.strptime(request.GET['from'], '%Y-%m-%d').date() if 'from' in request.GET else timezone.localdate()
+        end = datetime.strptime(request.GET['to'], '%Y-%m-%d').date() if 'to' in request.GET else start + timedelta(days=6)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid date format. Use YYYY-MM-DD.")
+    if end < start or (end - start).days >= GTFS_FEED_MAX_DAYS:
+        return HttpResponseBadRequest(f"The date range must cover 1 to {GTFS_FEED_MAX_DAYS} days.")
+
+    exporter = FeedExporter(start, end, cache_dir=getattr(settings, 'GTFS_CACHE_DIR', None))
+    response = StreamingHttpResponse(exporter.iter_zip(), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="gtfs-{start.isoformat()}-{end.isoformat()}.zip"'
+    return response
+
+
+class SearchTravellersView(AdmissionControlMixin, ReplicaReadMixin, APIView):
     permission_classes = [IsAuthenticated]
+    admission_scope = 'search'
+    NEAREST_STOP_RADIUS_METERS = 2000
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 50
+    MAX_WINDOW_DAYS = 31
+
+    def resolve_stop(self, request, prefix):
+        """
+        Returns the stop id given as `<prefix>_stop_id`, or the stop nearest to
+        `<prefix>_lat`/`<prefix>_lng` within NEAREST_STOP_RADIUS_METERS.
+        """
+        stop_id = request.query_params.get(f'{prefix}_stop_id')
+        latitude = request.query_params.get(f'{prefix}_lat')
+        longitude = request.query_params.get(f'{prefix}_lng')
+        if stop_id or latitude is None or longitude is None:
+            return stop_id
+        try:
+            latitude, longitude = float(latitude), float(longitude)
+        except ValueError:
+            raise ValueError(f"{prefix}_lat and {prefix}_lng must be numbers.")
+        nearest = get_spatial_index().nearest(latitude, longitude, limit=1, radius_meters=self.NEAREST_STOP_RADIUS_METERS)
+        if not nearest:
+            raise ValueError(f"No stop found within {self.NEAREST_STOP_RADIUS_METERS} m of the {prefix} coordinates.")
+        return nearest[0]['id']
+
+    def windowed_search(self, request, start_stop, end_stop):
+        """The best `limit` trips departing between `date_from` and `date_to`, ranked by `sort`."""
+        params = request.query_params
+        try:
+            date_from = datetime.strptime(params.get('date_from', ''), '%Y-%m-%d').date()
+            date_to = datetime.strptime(params.get('date_to', ''), '%Y-%m-%d').date()
+        except ValueError:
+            return Response({"error": "date_from and date_to are both required. Format: YYYY-MM-DD."}, status=status.HTTP_400_BAD_REQUEST)
+        if date_to < date_from or date_to < timezone.localdate():
+            return Response({"error": "date_to must be on or after date_from and not in the past."}, status=status.HTTP_400_BAD_REQUEST)
+        if (date_to - date_from).days >= self.MAX_WINDOW_DAYS:
+            return Response({"error": f"The date range may span at most {self.MAX_WINDOW_DAYS} days."}, status=status.HTTP_400_BAD_REQUEST)
+
+        sort = params.get('sort', 'earliest')
+        if sort not in SEARCH_SORT_KEYS:
+            return Response({"error": f"sort must be one of: {', '.join(SEARCH_SORT_KEYS)}."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(int(params.get('limit', self.DEFAULT_LIMIT)), self.MAX_LIMIT)
+            seats = int(params.get('seats', 1))
+        except ValueError:
+            return Response({"error": "limit and seats must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+        if seats < 1:
+            return Response({"error": "seats must be >= 1."}, status=status.HTTP_400_BAD_REQUEST)
+
+        after = max(day_bounds(date_from)[0], timezone.now())
+        with SEARCH_SECONDS.labels('window', 'scan').time():
+            rows = search_window(start_stop.id, end_stop.id, after, day_bounds(date_to)[1], max(limit, 1), sort=sort, seats=seats)
+
+        # Only the ranked trips are loaded and serialized.
+        with SEARCH_SECONDS.labels('window', 'serialize').time():
+            trips = Travellor.objects.select_related('route', 'driver').in_bulk([row['trip_id'] for row in rows])
+            _prefetch_route_stops(trips.values())
+            serializer_context = {
+                'start_stop_id': start_stop.id, 'end_stop_id': end_stop.id, **sparse_fieldset_context(params),
+            }
+            results = []
+            for row in rows:
+                if row['trip_id'] not in trips:
+                    continue
+                traveller_data = TravellorSerializer(trips[row['trip_id']], context=serializer_context).data
+                for field in ('departure_from_start', 'arrival_at_end', 'start_stop_id', 'end_stop_id', 'available_seats'):
+                    traveller_data[field] = row[field]
+                results.append(traveller_data)
+        return Response(results)
+
     def get(self, request):
         cust=get_object_or_404(Customer, user=request.user)
-        start_stop_id = request.query_params.get('start_stop_id')
-        end_stop_id = request.query_params.get('end_stop_id')
         travel_date = request.query_params.get('date')  # Expected format: YYYY-MM-DD
+        try:
+            start_stop_id = self.resolve_stop(request, 'start')
+            end_stop_id = self.resolve_stop(request, 'end')
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         if not start_stop_id or not end_stop_id:
-            return Response({"error": "Both start_stop_id and end_stop_id are required."}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({"error": "Both start_stop_id and end_stop_id (or start_lat/start_lng and end_lat/end_lng) are required."}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
             start_stop = Stop.objects.get(id=start_stop_id)
@@ -378,57 +827,333 @@ class SearchTravellersView(APIView):
         except Stop.DoesNotExist:
             return Response({"error": "Invalid stop ID provided."}, status=status.HTTP_404_NOT_FOUND)
 
+        if 'date_from' in request.query_params or 'date_to' in request.query_params:
+            return self.windowed_search(request, start_stop, end_stop)
+
         # Find routes that contain both stops
         routes = Route.objects.filter(stops=start_stop).filter(stops=end_stop)
 
         # Filter travellers on these routes
-        travellers = Travellor.objects.filter(route__in=routes, status='SCHEDULED', departure_time__gte=datetime.now()).order_by('departure_time')
+        travellers = (
+            Travellor.objects.filter(route__in=routes, status='SCHEDULED', departure_time__gte=timezone.now())
+            .select_related('route', 'driver')
+            .order_by('departure_time')
+        )
 
         # Filter by date if provided
         if travel_date:
             try:
                 date_obj = datetime.strptime(travel_date, '%Y-%m-%d').date()
-                if date_obj < datetime.now().date():
+                if date_obj < timezone.localdate():
                     return Response({"error": "Travel date cannot be in the past."}, status=status.HTTP_400_BAD_REQUEST)
-                day_start = datetime.combine(date_obj, datetime.min.time())
-                day_end = datetime.combine(date_obj, datetime.max.time())
-                travellers = travellers.filter(departure_time__gte=day_start, departure_time__lte=day_end)
+                day_start, day_end = day_bounds(date_obj)
+                travellers = travellers.filter(departure_time__gte=day_start, departure_time__lt=day_end)
             except ValueError:
                 return Response({"error": "Invalid date format. Use YYYY-MM-DD."}, status=status.HTTP_400_BAD_REQUEST)
 
         # Further filter to ensure the stop order is correct and calculate arrival times
         valid_travellers_data = []
-        for traveller in travellers:
-            try:
+        serializer_context = {
+            'start_stop_id': start_stop.id,
+            'end_stop_id': end_stop.id,
+            **sparse_fieldset_context(request.query_params),
+        }
+        with SEARCH_SECONDS.labels('day', 'scan').time():
+            travellers = list(travellers)
+            _prefetch_route_stops(travellers)
+            matches = []
+            for traveller in travellers:
                 schedule = traveller.get_schedule()
                 start_route_stop = next((item for item in schedule if item['stop_id'] == start_stop.id), None)
                 end_route_stop = next((item for item in schedule if item['stop_id'] == end_stop.id), None)
-                available_seats = traveller.vehicle_capacity-traveller.get_booked_seats_for_segment(start_route_stop['order'], end_route_stop['order'])  # To ensure validation
                 if start_route_stop and end_route_stop and start_route_stop['order'] < end_route_stop['order']:
-                    serializer_context = {
-                        'start_stop_id': start_stop.id,
-                        'end_stop_id': end_stop.id
-                    }
-                    traveller_data = TravellorSerializer(traveller, context=serializer_context).data
-                    traveller_data['departure_from_start'] = start_route_stop['estimated_arrival_time']
-                    traveller_data['arrival_at_end'] = end_route_stop['estimated_arrival_time']
-                    traveller_data['start_stop_id'] = start_route_stop['route_stop_id']
-                    traveller_data['end_stop_id'] = end_route_stop['route_stop_id']
-                    traveller_data['available_seats'] = available_seats
-                    valid_travellers_data.append(traveller_data)
-            except Stop.DoesNotExist:
-                continue
+                    matches.append((traveller, start_route_stop, end_route_stop))
+
+            # Seats for the whole page in one read, as in the windowed search.
+            loads = LegLoads.for_trips([traveller for traveller, _, _ in matches])
+            for traveller, start_route_stop, end_route_stop in matches:
+                traveller_data = TravellorSerializer(traveller, context=serializer_context).data
+                traveller_data['departure_from_start'] = start_route_stop['estimated_arrival_time']
+                traveller_data['arrival_at_end'] = end_route_stop['estimated_arrival_time']
+                traveller_data['start_stop_id'] = start_route_stop['route_stop_id']
+                traveller_data['end_stop_id'] = end_route_stop['route_stop_id']
+                traveller_data['available_seats'] = loads[traveller.pk].available(start_route_stop['order'], end_route_stop['order'])
+                valid_travellers_data.append(traveller_data)
 
         return Response(valid_travellers_data)
 
 
-class UserBookingsView(APIView):
+class UserBookingsView(ReplicaReadMixin, APIView):
     permission_classes = [IsAuthenticated]
 
+    @conditional(lambda request: [customer_bookings_version_key(_customer_id(request)), STOPS_VERSION_KEY])
     def get(self, request):
-        customer = get_object_or_404(Customer, user=request.user)
-        bookings = Booking.objects.filter(customer=customer).order_by('-booking_time')
-        serializer = BookingDetailSerializer(bookings, many=True)
+        bookings = list(
+            Booking.objects.filter(customer_id=_customer_id(request))
+            .select_related('customer', 'trip__route', 'trip__driver', 'start_stop__stop', 'end_stop__stop')
+            .order_by('-booking_time')
+        )
+        serializer = BookingDetailSerializer(bookings, many=True, context=sparse_fieldset_context(request.query_params))
+        # Only load the routes' stops when the response shows them.
+        trip = serializer.child.fields.get('trip')
+        if isinstance(trip, TravellorSerializer) and 'route_stops' in trip.fields:
+            _prefetch_route_stops([booking.trip for booking in bookings])
         return Response(serializer.data)
 
 
+
+
+class FareQuoteView(APIView):
+    """Prices many trip segments in one call using the precomputed per-route distances."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = FareQuoteSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        segments = serializer.validated_data['segments']
+        trip_ids = {segment['trip'] for segment in segments}
+        trips = {
+            trip['id']: trip
+            for trip in Travellor.objects.filter(id__in=trip_ids).values('id', 'route_id', 'cost_per_km')
+        }
+
+        quotes = []
+        for segment in segments:
+            trip = trips.get(segment['trip'])
+            if trip is None:
+                quotes.append({**segment, 'error': "Trip not found."})
+                continue
+            distance = get_route_fares(trip['route_id']).distance_between_route_stops(segment['start_stop'], segment['end_stop'])
+            if distance is None or distance <= 0:
+                quotes.append({**segment, 'error': "Stops must be on the trip's route, with the start stop before the end stop."})
+                continue
+            quotes.append({
+                **segment,
+                'distance': distance,
+                'cost_per_km': trip['cost_per_km'],
+                'price': quote_fare(trip['cost_per_km'], distance, segment['seats']),
+            })
+
+        return Response({'quotes': quotes})
+
+
+class JourneyPlannerView(AdmissionControlMixin, APIView):
+    """Finds itineraries between two stops that may change between routes."""
+    permission_classes = [IsAuthenticated]
+    admission_scope = 'journeys'
+    MAX_TRANSFERS_LIMIT = 3
+
+    def get(self, request):
+        start_stop_id = request.query_params.get('start_stop_id')
+        end_stop_id = request.query_params.get('end_stop_id')
+        travel_date = request.query_params.get('date')
+
+        if not start_stop_id or not end_stop_id or not travel_date:
+            return Response({"error": "start_stop_id, end_stop_id and date are required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            start_stop_id = int(start_stop_id)
+            end_stop_id = int(end_stop_id)
+            max_transfers = int(request.query_params.get('max_transfers', 2))
+            min_transfer_minutes = int(request.query_params.get('min_transfer_minutes', 5))
+            seats = int(request.query_params.get('seats', 1))
+        except ValueError:
+            return Response({"error": "Stop ids, max_transfers, min_transfer_minutes and seats must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not 0 <= max_transfers <= self.MAX_TRANSFERS_LIMIT:
+            return Response({"error": f"max_transfers must be between 0 and {self.MAX_TRANSFERS_LIMIT}."}, status=status.HTTP_400_BAD_REQUEST)
+        if min_transfer_minutes < 0 or seats < 1:
+            return Response({"error": "min_transfer_minutes must be >= 0 and seats must be >= 1."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            date_obj = datetime.strptime(travel_date, '%Y-%m-%d').date()
+        except ValueError:
+            return Response({"error": "Invalid date format. Use YYYY-MM-DD."}, status=status.HTTP_400_BAD_REQUEST)
+        if date_obj < timezone.localdate():
+            return Response({"error": "Travel date cannot be in the past."}, status=status.HTTP_400_BAD_REQUEST)
+
+        depart_after = timezone.make_aware(datetime.combine(date_obj, datetime.min.time()))
+        depart_after = max(depart_after, timezone.now())
+
+        with SEARCH_SECONDS.labels('journeys', 'timetable').time():
+            timetable = get_timetable(date_obj)
+        with SEARCH_SECONDS.labels('journeys', 'plan').time():
+            itineraries = plan_journeys(
+                timetable, start_stop_id, end_stop_id, depart_after,
+                max_transfers=max_transfers, min_transfer_minutes=min_transfer_minutes, seats=seats,
+            )
+        return Response(itineraries)
+
+
+class VendorAnalyticsView(APIView):
+    """Occupancy and revenue rollups for the authenticated vendor's trips."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        if not hasattr(request.user, 'vendor_profile'):
+            return Response({"error": "Only vendors can view analytics."}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            start, end = _analytics_range(request.query_params)
+        except ValueError as e:
+            return Response({"error": f"Invalid date range: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(vendor_report(request.user.id, start, end))
+
+
+class RouteOccupancyView(APIView):
+    """Trips x legs matrix of seats occupied on a route, for the authenticated vendor's trips."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, route_id):
+        if not hasattr(request.user, 'vendor_profile'):
+            return Response({"error": "Only vendors can view occupancy."}, status=status.HTTP_403_FORBIDDEN)
+        route = get_object_or_404(Route, pk=route_id)
+        try:
+            start, end = _analytics_range(request.query_params)
+        except ValueError as e:
+            return Response({"error": f"Invalid date range: {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        trips = Travellor.objects.filter(
+            route=route,
+            driver=request.user,
+            departure_time__gte=day_bounds(start)[0],
+            departure_time__lt=day_bounds(end)[1],
+        ).exclude(status='CANCELLED')
+        return Response({
+            'route_id': route.id,
+            'route_name': route.name,
+            'from': start,
+            'to': end,
+            **route_occupancy(route.id, trips),
+        })
+
+
+class TripPositionView(APIView):
+    """
+    Accepts driver position pings, one at a time or as a `pings` batch. Pings are
+    buffered and written in batches, so they are acknowledged with 202.
+    """
+    permission_classes = [IsAuthenticated]
+    MAX_BATCH = 500
+
+    def post(self, request):
+        if not hasattr(request.user, 'vendor_profile'):
+            return Response({"error": "Only drivers can report positions."}, status=status.HTTP_403_FORBIDDEN)
+        pings = request.data.get('pings') if isinstance(request.data, dict) and 'pings' in request.data else [request.data]
+        if not isinstance(pings, list) or len(pings) > self.MAX_BATCH:
+            return Response({"error": f"pings must be a list of at most {self.MAX_BATCH} pings."}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = PositionPingSerializer(data=pings, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        trip_ids = {ping['trip'] for ping in serializer.validated_data}
+        drivers = dict(Travellor.objects.filter(pk__in=trip_ids).values_list('pk', 'driver_id'))
+        missing = sorted(trip_ids - drivers.keys())
+        if missing:
+            return Response({"error": f"Trips not found: {missing}."}, status=status.HTTP_404_NOT_FOUND)
+        others = sorted(trip_id for trip_id, driver_id in drivers.items() if driver_id != request.user.id)
+        if others:
+            return Response({"error": f"You do not drive trips {others}."}, status=status.HTTP_403_FORBIDDEN)
+
+        now = timezone.now()
+        for ping in serializer.validated_data:
+            record_ping(
+                request.user.id, ping['trip'], ping['latitude'], ping['longitude'],
+                ping.get('recorded_at', now), stop_order=ping.get('stop_order'),
+            )
+        return Response({"accepted": len(serializer.validated_data)}, status=status.HTTP_202_ACCEPTED)
+
+
+class TripSeatMapView(APIView):
+    """Seats taken on each leg of a trip that assigns seats, and the seats free over a segment."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, trip_id):
+        trip = get_object_or_404(Travellor, pk=trip_id)
+        if not trip.assign_seats:
+            return Response({"error": "This trip does not assign seat numbers."}, status=status.HTTP_404_NOT_FOUND)
+
+        with transaction.atomic():
+            # Building the map for the first time writes its legs, so take the trip lock.
+            trip = lock_trip(trip.pk)
+            seat_map = SeatMap.for_trip(trip)
+
+        start_order, end_order = min(seat_map.orders, default=0), max(seat_map.orders, default=0)
+        if 'start_stop' in request.query_params or 'end_stop' in request.query_params:
+            orders = dict(RouteStop.objects.filter(route_id=trip.route_id).values_list('id', 'order'))
+            try:
+                start_order = orders[int(request.query_params.get('start_stop'))]
+                end_order = orders[int(request.query_params.get('end_stop'))]
+            except (KeyError, TypeError, ValueError):
+                return Response({"error": "start_stop and end_stop must both be RouteStop ids on the trip's route."}, status=status.HTTP_400_BAD_REQUEST)
+            if start_order >= end_order:
+                return Response({"error": "End stop must be after start stop."}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'trip_id': trip.pk,
+            'vehicle_capacity': trip.vehicle_capacity,
+            'legs': [
+                {'start_order': leg_start, 'end_order': leg_end, 'occupied_seats': seats}
+                for leg_start, leg_end, seats in seat_map.occupied_seats()
+            ],
+            'free_seats': seat_map.free_seats(start_order, end_order),
+        })
+
+
+class CancelBookingView(APIView):
+    """Cancels one of the customer's bookings and promotes waiting customers into the freed seats."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, booking_id):
+        customer = get_object_or_404(Customer, user=request.user)
+        booking = get_object_or_404(Booking, pk=booking_id, customer=customer)
+        try:
+            cancel_booking(booking)
+        except ValidationError as e:
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(BookingSerializer(booking).data)
+
+
+class WaitlistView(APIView):
+    """Joins the waitlist for a full segment (POST) and lists the customer's entries (GET)."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        customer = get_object_or_404(Customer, user=request.user)
+        serializer = WaitlistEntrySerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            entry = join_waitlist(customer, **serializer.validated_data)
+        except ValidationError as e:
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(WaitlistEntrySerializer(entry).data, status=status.HTTP_201_CREATED)
+
+    def get(self, request):
+        customer = get_object_or_404(Customer, user=request.user)
+        entries = WaitlistEntry.objects.filter(customer=customer).order_by('-created_at')
+        return Response(WaitlistEntrySerializer(entries, many=True).data)
+
+
+class WaitlistEntryView(APIView):
+    """Withdraws one of the customer's waiting entries."""
+    permission_classes = [IsAuthenticated]
+
+    def delete(self, request, entry_id):
+        customer = get_object_or_404(Customer, user=request.user)
+        entry = get_object_or_404(WaitlistEntry, pk=entry_id, customer=customer)
+        try:
+            entry = withdraw(entry)
+        except ValidationError as e:
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(WaitlistEntrySerializer(entry).data)
+
+
+class AdmissionStatsView(APIView):
+    """Admission control counters, for monitoring."""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(admission_stats())
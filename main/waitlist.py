@@ -0,0 +1,97 @@
+"""
+Booking cancellation and waitlist promotion.
+
+Every change to a trip's seats here runs with the trip row locked, so a
+cancellation and the promotions it triggers are one transaction and two
+cancellations on the same trip cannot promote into the same freed seats.
+"""
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Booking, Travellor, WaitlistEntry
+from .seatmap import SeatMap
+from .seats import LegLoads
+
+
+def lock_trip(trip_id):
+    """Locks a trip row for the rest of the transaction; every seat change on the trip takes this lock."""
+    return Travellor.objects.select_for_update().get(pk=trip_id)
+
+
+def promote_waitlist(trip):
+    """
+    Books waiting entries, oldest first, whose whole segment fits in the seats
+    now free. Must be called inside a transaction holding the trip lock.
+    Returns the new bookings.
+    """
+    entries = list(
+        WaitlistEntry.objects.filter(trip=trip, status='WAITING')
+        .select_related('start_stop', 'end_stop')
+        .order_by('created_at', 'id')
+    )
+    if not entries:
+        return []
+
+    loads = LegLoads.for_trip(trip)
+    promoted = []
+    for entry in entries:
+        start_order, end_order = entry.start_stop.order, entry.end_stop.order
+        if not loads.fits(start_order, end_order, entry.seats):
+            continue
+        booking = Booking.objects.create(
+            trip=trip,
+            customer_id=entry.customer_id,
+            start_stop=entry.start_stop,
+            end_stop=entry.end_stop,
+            seats=entry.seats,
+        )
+        loads.add(start_order, end_order, entry.seats)
+        entry.status = 'PROMOTED'
+        entry.booking = booking
+        entry.save(update_fields=['status', 'booking'])
+        promoted.append(booking)
+    return promoted
+
+
+def cancel_booking(booking):
+    """Cancels a confirmed booking and promotes whoever now fits. Returns the promoted bookings."""
+    with transaction.atomic():
+        trip = lock_trip(booking.trip_id)
+        booking.refresh_from_db()
+        if booking.status != 'CONFIRMED':
+            raise ValidationError("Only confirmed bookings can be cancelled.")
+        if trip.departure_time <= timezone.now():
+            raise ValidationError("Cannot cancel a booking for a trip that has already departed.")
+
+        booking.status = 'CANCELLED'
+        booking.cancelled_at = timezone.now()
+        booking.save(update_fields=['status', 'cancelled_at'])
+        if trip.assign_seats and booking.seat_numbers:
+            seat_map = SeatMap.for_trip(trip)
+            seat_map.release(booking)
+            seat_map.save()
+        return promote_waitlist(trip)
+
+
+def join_waitlist(customer, trip, start_stop, end_stop, seats):
+    """Adds a waiting entry, refusing requests that could be booked right away."""
+    with transaction.atomic():
+        trip = lock_trip(trip.pk)
+        if seats > trip.vehicle_capacity:
+            raise ValidationError(f"This trip has only {trip.vehicle_capacity} seat(s).")
+        if LegLoads.for_trip(trip).fits(start_stop.order, end_stop.order, seats):
+            raise ValidationError("Seats are available for this segment; book the trip instead.")
+        return WaitlistEntry.objects.create(
+            trip=trip, customer=customer, start_stop=start_stop, end_stop=end_stop, seats=seats,
+        )
+
+
+def withdraw(entry):
+    with transaction.atomic():
+        entry = WaitlistEntry.objects.select_for_update().get(pk=entry.pk)
+        if entry.status != 'WAITING':
+            raise ValidationError("Only waiting entries can be withdrawn.")
+        entry.status = 'WITHDRAWN'
+        entry.save(update_fields=['status'])
+        return entry